@@ -106,6 +106,8 @@ Optional Command Line Arguments:
 --FirstFrameTrack={0,1,...}
 --LastFrameTrack={-1,0,1,...}
 --ResumeTracking={True,False}
+--BgWorkers={0,1,2,...}
+--SingleChannel={0,1,2}
 
 Example:
 Ctrax --Interactive=True --Input=movie1.fmf \\
@@ -118,7 +120,10 @@ By default, Interactive=True, AutoEstimateBackground=True,
 AutoEstimateShape=True, AutoDetectCircularArena=True, 
 FirstFrameTrack=0, LastFrameTrack=-1 
 (meaning to track until the end of the video),
-ResumeTracking=False
+ResumeTracking=False, BgWorkers=1
+(0 meaning one background worker process per CPU)
+and color movies are converted to gray by luminance
+(SingleChannel=0, 1 or 2 uses only the red, green or blue channel)
 
 If not in interactive mode, then Input must be defined.
 
@@ -242,6 +247,26 @@ If DiagnosticsFile is not set, then
             elif name.lower() == '--resumetracking':
                 if value.lower() == 'true':
                     params.noninteractive_resume_tracking = True
+            elif name.lower() == '--bgworkers':
+                try:
+                    bg_nworkers = int(value)
+                    if bg_nworkers < 0:
+                        raise NotImplementedError
+                except:
+                    print "BgWorkers must be an integer greater than or equal to 0"
+                    self.PrintUsage()
+                    raise
+                params.bg_nworkers = bg_nworkers
+            elif name.lower() == '--singlechannel':
+                try:
+                    single_channel = int(value)
+                    if single_channel not in [0,1,2]:
+                        raise NotImplementedError
+                except:
+                    print "SingleChannel must be 0, 1 or 2"
+                    self.PrintUsage()
+                    raise
+                params.movie_single_channel = single_channel
             else:
                 print 'Error parsing command line arguments. Unknown parameter name "%s". Usage: '%name
                 self.PrintUsage()
@@ -88,6 +88,17 @@ class CtraxAlgorithm (settings.AppWithSettings):
                 varying_bg=self.bg_imgs.varying_bg,
                 mean_separator=self.bg_imgs.mean_separator))
         appendBg()
+        rolling = rnf > 0 and params.bg_rolling_update and self.bg_imgs.use_median
+        if rolling:
+            rolling = self.bg_imgs.start_rolling_bg(self.bg_imgs.n_bg_frames,
+                                                    max(1, rnf/self.bg_imgs.n_bg_frames))
+        lookahead = rnf > 0 and not rolling and params.bg_lookahead and os.name == 'posix'
+          # note: the background process is forked from this one
+        def startNextBg(firstframe):
+            if lookahead and nf - firstframe > rnf/2:
+                self.bg_imgs.start_bg_segment(firstframe, firstframe + rnf - 1)
+        startNextBg(self.start_frame + rnf)
+        self.movie.start_prefetch(self.start_frame, min(nf, self.last_frame))
         for self.start_frame in range(self.start_frame, nf):
 
             # KB 20120109 added last_frame command-line option
@@ -113,8 +124,15 @@ class CtraxAlgorithm (settings.AppWithSettings):
                       #  not required for tracking
                     self.bg_imgs.bg_firstframe = self.start_frame
                     self.bg_imgs.bg_lastframe = self.start_frame + rnf - 1
-                    self.OnComputeBg()
+                    if rolling:
+                        self.bg_imgs.publish_rolling_bg()
+                        self.bg_imgs.updateParameters()
+                    elif self.bg_imgs.finish_bg_segment(self.start_frame, self.start_frame + rnf - 1):
+                        self.bg_imgs.updateParameters()
+                    else:
+                        self.OnComputeBg()
                     appendBg()
+                    startNextBg(self.start_frame + rnf)
                 rc = 1
 
             # perform background subtraction
@@ -138,8 +156,19 @@ class CtraxAlgorithm (settings.AppWithSettings):
             if self.break_flag:
                 break
 
+            # predicted positions of the flies that were split from a
+            # connected component in the last frame
+            splitpred = None
+            if params.split_warmstart and len( self.ann_file ) > 1:
+                splitpred = ell.split_predictions( self.ann_file[-2],
+                                                   self.ann_file[-1] )
+            elif params.split_warmstart and len( self.ann_file ) == 1:
+                splitpred = ell.split_predictions( self.ann_file[-1],
+                                                   self.ann_file[-1] )
+
             # find observations
-            self.ellipses = ell.find_ellipses( self.dfore, self.cc, self.ncc )
+            self.ellipses = ell.find_ellipses( self.dfore, self.cc, self.ncc,
+                                               splitpred=splitpred )
 
             # shadow detector
             if params.use_shadow_detector:
@@ -225,6 +254,10 @@ class CtraxAlgorithm (settings.AppWithSettings):
             if (self.start_frame % 100) == 0 and self.has( 'diagnostics_filename' ):
                 self.write_diagnostics() # save ongoing
 
+        self.movie.stop_prefetch()
+        self.bg_imgs.stop_bg_segment()
+        self.bg_imgs.stop_rolling_bg()
+        self.movie.save_metadata()
         self.saveBackgrounds(bgs)
         self.Finish()
 
@@ -18,10 +18,13 @@ import fixbg
 import roi
 import ExpBGFGModel
 import highboostfilter
+import ccstats
+import movies
 from movies import NoMoreFramesException
 from version import DEBUG
 
-import copy, cPickle, scipy.cluster.vq as vq
+import collections, copy, cPickle, tempfile, scipy.cluster.vq as vq
+import ctypes, multiprocessing, Queue
 
 HF_RSRC_FILE = os.path.join(codedir.codedir,'xrc','homomorphic.xrc')
 
@@ -32,6 +35,16 @@ DEBUG_BGBUFFER = False
 if not DEBUG:
     DEBUG_BGBUFFER = False
 
+# number of sampled frames read at a time when estimating the background
+BG_READ_CHUNK = 32
+# frames whose statistics are collected per background frame, for
+# detecting a varying background and choosing the on and off frames
+BG_STATS_PER_FRAME = 4
+# estimate standard deviation assuming a Gaussian distribution
+# from the fact that half the data falls within mad
+# MADTOSTDFACTOR = 1./norminv(.75)
+MADTOSTDFACTOR = 1.482602
+
 
 class HomoFilt:
     """Implements a homomorphic filter and uses it to retrieve filtered
@@ -104,6 +117,286 @@ class HomoFilt:
         img[img < 0.] = 0.
         return img
 
+class HistogramBg:
+    """Per-pixel histograms of uint8 images. Order statistics (median,
+    median absolute deviation, the value of percentile_order()) are read
+    off the histograms in 256 steps per pixel instead of sorting; images
+    are folded in (and taken out) one at a time, so memory does not depend
+    on the number of images. Images can be masked, so that pixels may
+    count different numbers of values."""
+    def __init__( self, shape ):
+        self.shape = tuple(shape)
+        self.npixels = int(num.prod(self.shape))
+        # counts[v,p] is the number of images with value v at pixel p
+        self.counts = num.zeros((256,self.npixels),dtype=num.uint16)
+        # number of values at each pixel
+        self.n = num.zeros(self.npixels,dtype=num.int32)
+        self.pixels = num.arange(self.npixels)
+
+    def add( self, im, mask=None ):
+        """Fold image, or stack of images along the first axis, into the
+        histograms, only where mask is True if given."""
+        self.fold(im,mask,True)
+
+    def remove( self, im, mask=None ):
+        """Take images folded in by add() out of the histograms again."""
+        self.fold(im,mask,False)
+
+    def fold( self, im, mask, isadd ):
+        ims = num.asarray(im,dtype=num.uint8).reshape((-1,self.npixels))
+        if mask is not None:
+            masks = num.asarray(mask,dtype=bool).reshape((-1,self.npixels))
+        flatcounts = self.counts.reshape(-1)
+        for i, frame in enumerate(ims):
+            # indices are distinct, so fancy-indexed += counts each pixel once
+            index = frame.astype(num.intp)*self.npixels + self.pixels
+            pixels = slice(None) if mask is None else masks[i]
+            if isadd:
+                flatcounts[index[pixels]] += 1
+                self.n[pixels] += 1
+            else:
+                flatcounts[index[pixels]] -= 1
+                self.n[pixels] -= 1
+
+    def order_statistic( self, k ):
+        """Return k-th smallest value (counting from 0) at each pixel; k
+        may differ between pixels. Pixels with at most k values (e.g.
+        none) get 255."""
+        hasvalue = self.n > k
+        k = num.where(hasvalue,k,-1)
+        cum = num.zeros(self.npixels,dtype=num.int32)
+        value = num.where(hasvalue,0,255).astype(num.uint8)
+        # a k-th value above 254 is 255
+        for v in range(255):
+            cum += self.counts[v]
+            # pixels whose k-th value is still above v
+            value[cum <= k] = v + 1
+            if (cum > k).all():
+                break
+        return value.reshape(self.shape)
+
+    def median( self ):
+        """Return median at each pixel, averaging the middle two values
+        for an even number of values; pixels without values get 255."""
+        med = self.order_statistic(self.n//2).astype(num.float64).reshape(-1)
+        iseven = (self.n % 2 == 0) & (self.n > 0)
+        if iseven.any():
+            med[iseven] += self.order_statistic(self.n//2-1).reshape(-1)[iseven]
+            med[iseven] /= 2.
+        return med.reshape(self.shape)
+
+    def deviation_order_statistic( self, center, k ):
+        """Return k-th smallest |value - center| at each pixel, where
+        center is an integer or half-integer image. Pixels with at most k
+        values get 255."""
+        # values v at deviation e/2 satisfy 2v = center2 +- e
+        center2 = num.round(2.*num.asarray(center,dtype=num.float64).reshape(-1)).astype(num.int64)
+        hasvalue = self.n > k
+        k = num.where(hasvalue,k,-1)
+        cum = num.zeros(self.npixels,dtype=num.int32)
+        dev = num.where(hasvalue,0.,255.)
+        for e in range(512):
+            for v2 in ((center2 + e,) if e == 0 else (center2 + e,center2 - e)):
+                isvalue = (v2 % 2 == 0) & (v2 >= 0) & (v2 <= 510)
+                cum[isvalue] += self.counts[v2[isvalue]//2,self.pixels[isvalue]]
+            # pixels whose k-th deviation is still above e/2
+            dev[cum <= k] = (e + 1)/2.
+            if (cum > k).all():
+                break
+        return dev.reshape(self.shape)
+
+    def mad( self, center ):
+        """Return median absolute deviation from center at each pixel;
+        pixels without values get 255."""
+        mad = self.deviation_order_statistic(center,self.n//2).reshape(-1)
+        iseven = (self.n % 2 == 0) & (self.n > 0)
+        if iseven.any():
+            mad[iseven] += self.deviation_order_statistic(center,self.n//2-1).reshape(-1)[iseven]
+            mad[iseven] /= 2.
+        return mad.reshape(self.shape)
+
+
+def histogram_bg_nbytes( npixels ):
+    """Return the memory used by a HistogramBg of npixels pixels: 256
+    uint16 counts, a count and an index per pixel."""
+    return npixels*(256*2 + 4 + num.dtype(num.intp).itemsize)
+
+
+def rolling_bg_nbytes( shape, nwindow ):
+    """Return the memory used by a RollingBg of frames of the given shape:
+    the histograms, and each of the nwindow sampled frames with its mask."""
+    npixels = int(num.prod(shape))
+    return histogram_bg_nbytes(npixels) + npixels*nwindow*2
+
+
+def percentile_order( n, pcntl ):
+    """Return which value (counting from 0) of n sorted values, n an int
+    or array, is used as background for params.percentile_for_bg pcntl."""
+    k = num.floor(num.asarray(n)*(100-pcntl)/100.).astype(num.int32)
+    return num.maximum(0,num.minimum(k,num.asarray(n)-1))
+
+
+class RollingBg:
+    """Median background of the frames being tracked: every nskip-th
+    frame is folded into per-pixel histograms, leaving out its foreground
+    pixels, and the oldest of nwindow sampled frames is taken out again.
+    See rolling_bg_nbytes() for its size."""
+    def __init__( self, shape, nwindow, nskip ):
+        self.hist = HistogramBg(shape)
+        self.nwindow = nwindow
+        self.nskip = nskip
+        self.samples = collections.deque()
+        self.lastframe = -1
+
+    def add( self, framenumber, im, isback ):
+        # each frame once, also if it is subtracted again
+        if framenumber <= self.lastframe:
+            return
+        self.lastframe = framenumber
+        if framenumber % self.nskip != 0:
+            return
+        self.hist.add(im,isback)
+        self.samples.append((im,isback))
+        if len(self.samples) > self.nwindow:
+            self.hist.remove(*self.samples.popleft())
+
+    def estimate( self, med, mad ):
+        """Update median (or percentile) and MAD images in place where the
+        window has background values; other pixels keep their value."""
+        pcntl = params.percentile_for_bg
+        if pcntl:
+            newmed = self.hist.order_statistic(percentile_order(self.hist.n,pcntl)).astype(num.float64)
+        else:
+            newmed = self.hist.median()
+        newmad = self.hist.mad(newmed)
+        isseen = (self.hist.n > 0).reshape(self.hist.shape)
+        med[isseen] = newmed[isseen]
+        mad[isseen] = newmad[isseen]*MADTOSTDFACTOR
+
+
+def label_hysteresis( bwhigh, bwlow ):
+    """Return the components of bwlow that contain a pixel of bwhigh
+    (the same as morph.binary_propagation(bwhigh,mask=bwlow)), and their
+    labels and number, numbered as meas.label would number them."""
+    (L,n) = meas.label(bwlow)
+    # components with a pixel above the high threshold
+    keep = num.bincount(L[bwhigh & bwlow],minlength=n+1) > 0
+    keep[0] = False
+    newlabel = num.cumsum(keep).astype(L.dtype)
+    newlabel[keep == False] = 0
+    cc = newlabel[L]
+    return (cc > 0, cc, int(num.count_nonzero(keep)))
+
+
+def masked_median( buf, isback ):
+    """Return median of each row of buf (pixels x frames) over the
+    entries marked in isback, and the number of marked entries per row.
+    The middle two values are averaged for an even number of entries;
+    rows without marked entries get meaningless values."""
+    npixels, nframes = buf.shape
+    rows = num.arange(npixels)[:,num.newaxis]
+    ord = num.argsort(buf,axis=1,kind='mergesort')
+    buf = buf[rows,ord]
+    # number of marked entries up to and including each sorted position
+    cum = num.cumsum(isback[rows,ord],axis=1)
+    Z = cum[:,-1]
+
+    def marked_order_statistic( k ):
+        # the k-th smallest marked entry is at the first position with
+        # k+1 marked entries up to it
+        i = num.minimum(num.sum(cum <= k[:,num.newaxis],axis=1),nframes-1)
+        return buf[rows[:,0],i].astype(float)
+
+    middle1 = Z//2
+    med = marked_order_statistic(middle1)
+    iseven = Z % 2 == 0
+    if iseven.any():
+        med[iseven] += marked_order_statistic(middle1-1)[iseven]
+        med[iseven] /= 2.
+    return med, Z
+
+
+def band_medmad( stack, r0, r1, order=None ):
+    """Return median (or the order-th smallest value, if order is given)
+    and median absolute deviation of rows r0:r1 of the sample stack."""
+    hist = HistogramBg( (r1-r0,) + tuple(stack.shape[2:]) )
+    hist.add( stack[:,r0:r1] )
+    if order is None:
+        med = hist.median()
+    else:
+        med = hist.order_statistic( order ).astype( num.float64 )
+    return med, hist.mad( med )
+
+
+def get_bg_nworkers():
+    """Number of processes computing the median background model."""
+    if params.bg_nworkers > 0:
+        return params.bg_nworkers
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+# sample stack and median, mad images of a background-model process
+_bg_worker = {}
+
+def init_bg_worker( source, shape, med, mad, order ):
+    if isinstance( source, basestring ):
+        # stack did not fit in memory, read it from its temporary file
+        _bg_worker['stack'] = num.memmap( source, dtype=num.uint8, mode='r', shape=shape )
+    else:
+        _bg_worker['stack'] = num.frombuffer( source, dtype=num.uint8 ).reshape( shape )
+    _bg_worker['med'] = num.frombuffer( med, dtype=num.float64 ).reshape( shape[1:] )
+    _bg_worker['mad'] = num.frombuffer( mad, dtype=num.float64 ).reshape( shape[1:] )
+    _bg_worker['order'] = order
+
+def compute_band_into_shared( band ):
+    r0, r1 = band
+    med, mad = band_medmad( _bg_worker['stack'], r0, r1, _bg_worker['order'] )
+    _bg_worker['med'][r0:r1] = med
+    _bg_worker['mad'][r0:r1] = mad
+    return band
+
+
+# attributes of a background model estimated by compute_bg_segment
+# attributes of a background segment estimated in another process; the
+# images derived from the estimate are recomputed by finish_bg_segment()
+BG_SEGMENT_ATTRS = ('bg_firstframe','bg_lastframe','varying_bg','mean_separator',
+                    'bg_frames')
+BG_SEGMENT_MEDIAN_ATTRS = ('med','mad')
+BG_SEGMENT_VARYING_ATTRS = ('meds','mads')
+BG_SEGMENT_MEAN_ATTRS = ('mean','std')
+
+def compute_bg_segment( bg, firstframe, lastframe, fullpath, queue ):
+    """Estimate the background model of frames firstframe..lastframe in a
+    process of its own, and put the estimate on the queue (None if the
+    estimation failed)."""
+    params.interactive = False
+    params.feedback_enabled = False
+    params.movie_prefetch_depth = 0
+    # own reader, the tracking process keeps reading the movie
+    params.movie = movies.Movie( fullpath, interactive=False )
+    # the tracking process writes the movie's metadata cache
+    params.use_movie_metadata_cache = False
+    bg.bg_firstframe = firstframe
+    bg.bg_lastframe = lastframe
+    result = None
+    try:
+        # the background model of an sbfmf is fixed
+        if params.movie.type != 'sbfmf' and bg.est_bg( reestimate=True ):
+            attrs = BG_SEGMENT_ATTRS
+            if not bg.use_median:
+                attrs += BG_SEGMENT_MEAN_ATTRS
+            elif bg.varying_bg:
+                attrs += BG_SEGMENT_MEDIAN_ATTRS + BG_SEGMENT_VARYING_ATTRS
+            else:
+                attrs += BG_SEGMENT_MEDIAN_ATTRS
+            result = dict( [(attr, getattr( bg, attr )) for attr in attrs] )
+    finally:
+        queue.put( result )
+
+
 class BackgroundCalculator (bg_settings.BackgroundSettings):
     def __init__( self, movie,
                   hm_cutoff=None, hm_boost=None, hm_order=None, use_thresh=None):
@@ -119,7 +412,6 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
         self.n_bg_frames = 100
 
         params.movie_size = (params.movie.get_height(), params.movie.get_width())
-        params.GRID.setsize(params.movie_size)
         params.npixels = params.movie_size[0] * params.movie_size[1]
 
         self.show_img_type = params.SHOW_THRESH
@@ -131,6 +423,9 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
         # image of which parts flies are not able to walk in
         self.isarena = num.ones(params.movie_size,dtype=num.bool)
         self.roi = num.ones(params.movie_size,dtype=num.bool)
+
+        # images derived from the model by sub_bg_kernel()
+        self.sub_bg_kernels = {}
         
         # have not set the expbgfgmodel yet
         self.expbgfgmodel = None
@@ -261,6 +556,7 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
             self.dev[self.dev > params.bg_std_max] = params.bg_std_max
 
         self.UpdateIsArena()
+        self.clear_sub_bg_kernels()
 
 
     def meanstd( self, parent=None ):
@@ -299,7 +595,9 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
         else:
             nframesused = 0
 
-        for i in range(self.bg_firstframe,bg_lastframe+1,nframesskip):
+        frms = params.movie.snap_to_keyframes(range(self.bg_firstframe,bg_lastframe+1,nframesskip),
+                                              self.bg_firstframe,bg_lastframe)
+        for i in frms:
 
             if params.feedback_enabled:
                 (keepgoing,skip) = progressbar.Update(value=nframesused+1,newmsg='Reading in frame %d (%d / %d)'%(i+1,nframesused,n_bg_frames))
@@ -372,7 +670,10 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
             bwlow = log_lik_ratio >= params.expbgfgmodel_llr_thresh_low
 
             # do hysteresis
-            bw = morph.binary_propagation(bwhigh,mask=bwlow)
+            if params.bg_label_hysteresis:
+                bw = label_hysteresis(bwhigh,bwlow)[0]
+            else:
+                bw = morph.binary_propagation(bwhigh,mask=bwlow)
             isback = bw == False
 
         else:
@@ -403,19 +704,30 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
 
         return (nframesskip,nframes,bg_lastframe)
 
+    def est_bg_framelist(self):
+        """Frames to estimate the background from: every nframesskip-th
+        frame, moved to keyframes for compressed movies."""
+        (nframesskip,nframes,bg_lastframe) = self.est_bg_selectframes()
+        ff = self.bg_firstframe
+        return params.movie.snap_to_keyframes(range(ff, ff+nframes*nframesskip, nframesskip),
+                                              ff, bg_lastframe)
+
     # relative standard error
     def rse(self, a, mean=None):
         return num.std(a)/(num.mean(a) if mean is None else mean)
 
     # determines whether to use "varying background"
-    # note: uses randomly selected frames
+    # note: uses the frame statistics collected in one pass over the movie
+    #  (keyframes for compressed movies), and a second, finer pass if the
+    #  lights are on (off) in only a few of the frames, so no frames are
+    #  read once they are collected and the choice of frames is deterministic
     def checkForVaryingBg(self):
         nf, lf = self.est_bg_selectframes()[1:]
         ff = self.bg_firstframe
         print "YL: checkForVaryingBg (frames %d - %d)" %(ff, lf)
-        nfC, nfAll = 2*nf, lf - ff + 1
-        frms = num.sort(num.random.choice(nfAll, min(nfC, nfAll), replace=False))
-        means = num.array([num.mean(params.movie.get_frame(f+ff)[0]) for f in frms])
+        stride = max(1, (lf - ff + 1)//(BG_STATS_PER_FRAME*nf))
+        frms, means = params.movie.get_frame_stats(stride, ff, lf)[:2]
+        nfC = means.size
         centrs = vq.kmeans2(means, num.array([means.min(), means.max()]))[0]
           # note: using just min and max instead of k-means probably fine
         ms = self.mean_separator = num.mean(centrs)
@@ -438,15 +750,22 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
         print " varying background: %s" %self.varying_bg
 
         if self.varying_bg:
-            fon = float(num.count_nonzero(on)) / means.size
-            nf1 = int(nf * 1/min(fon, 1-fon) * 1.2)
-            frms = num.sort(num.random.choice(nfAll, min(nf1, nfAll), replace=False))
-            means = num.array([num.mean(params.movie.get_frame(f+ff)[0]) for f in frms])
-            on = means > ms
+            sfss = {False: frms[means <= ms], True: frms[means > ms]}
+            # sample the smaller class again at a finer stride, for about
+            #  1.2*nf frames of it
+            small = sfss[True].size < sfss[False].size
+            if sfss[small].size < nf and stride > 1:
+                finer = max(1, int(stride*sfss[small].size/(1.2*nf)))
+                print " sampling %s frames with stride %d" %("on" if small else "off", finer)
+                frms, means = params.movie.get_frame_stats(finer, ff, lf)[:2]
+                sfss[small] = frms[(means > ms) == small]
             for on in [False, True]:
-                sfs = frms[means > ms if on else means <= ms]
+                # nf frames spread evenly over the on (off) frames
+                sfs = sfss[on]
+                if sfs.size < nf:
+                    print " only %d %s frames for background" %(sfs.size, "on" if on else "off")
                 self.bg_frames[on] = \
-                    num.sort(num.random.choice(sfs, min(sfs.size, nf), replace=False)) + ff
+                    sfs[num.unique(num.linspace(0, sfs.size-1, min(sfs.size, nf)).round().astype(int))]
 
     def flexmedmad(self, parent=None):
         if self.varying_bg:
@@ -459,53 +778,62 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
         else:
             return self.flexmedmad1(parent)
 
+    def alloc_sample_stack(self, shape, dtype):
+        """Return array for the sampled frames; it is kept in a temporary
+        file if larger than params.bg_median_maxbytesallocate."""
+        nbytes = num.prod(shape)*num.dtype(dtype).itemsize
+        if nbytes <= params.bg_median_maxbytesallocate:
+            return num.empty(shape, dtype=dtype)
+        if DEBUG: print 'storing %d sampled frames in a temporary file'%shape[0]
+        return num.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
+
+    def alloc_shared_sample_stack(self, shape):
+        """Return uint8 array for the sampled frames that worker processes
+        can open, and its source for init_bg_worker: a shared memory
+        array or, if larger than params.bg_median_maxbytesallocate, the
+        name of a temporary file. The temporary file object is returned
+        too; the file is deleted when it is closed."""
+        n = int(num.prod(shape))
+        if n <= params.bg_median_maxbytesallocate:
+            source = multiprocessing.RawArray(ctypes.c_uint8, n)
+            return num.frombuffer(source, dtype=num.uint8).reshape(shape), source, None
+        if DEBUG: print 'storing %d sampled frames in a temporary file'%shape[0]
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.bgstack')
+        stack = num.memmap(tmpfile.name, dtype=num.uint8, mode='w+', shape=shape)
+        return stack, tmpfile.name, tmpfile
+
     def flexmedmad1(self, parent=None, on=None):
         if params.use_expbgfgmodel:
             print 'Computing median with ExpBGFGModel'
 
-        # estimate standard deviation assuming a Gaussian distribution
-        # from the fact that half the data falls within mad
-        # MADTOSTDFACTOR = 1./norminv(.75)
-        MADTOSTDFACTOR = 1.482602
-
         # frame size
         nr = params.movie_size[0]
         nc = params.movie_size[1]
 
         # which frames will we sample?
-        (nframesskip,nframes,bg_lastframe) = self.est_bg_selectframes()
+        frms = self.est_bg_framelist() if on is None else self.bg_frames[on]
+        nframes = len(frms)
 
-        # which frame is the middle frame for computing the median?
-        # this will be ignored if use_expbgfgmodel
-        iseven = num.mod(nframes,2) == 0
-        middle1 = num.floor(nframes/2)
-        middle2 = middle1-1
-
-        # number of rows to read in at a time; based on the assumption 
-        # that we comfortably hold 100*(400x400) frames in memory. 
-        nrsmall = num.int(num.floor(params.bg_median_maxbytesallocate/num.double(nc)/num.double(nframes)))
+        # number of rows to compute at a time, so that a band takes at
+        # most bg_median_maxbytesallocate bytes: per-pixel histograms,
+        # whatever the number of frames, or for the ExpBGFGModel path the
+        # values of the pixels in all frames
+        if params.use_expbgfgmodel:
+            nbytesperrow = num.double(nc)*num.double(nframes)
+        else:
+            nbytesperrow = num.double(histogram_bg_nbytes(nc))
+        nrsmall = num.int(num.floor(params.bg_median_maxbytesallocate/nbytesperrow))
         if nrsmall < 1:
             nrsmall = 1
         if nrsmall > nr:
             nrsmall = nr
 
-        # number of rows left in the last iteration might be less than nrsmall 
-        nrsmalllast = num.mod(nr, nrsmall)
-        # if evenly divides,  set last number of rows to nrsmall
-        if nrsmalllast == 0:
-            nrsmalllast = nrsmall
-            
-        # buffer holds the pixels for each frame that are read in. 
-        # it holds nrsmall*nc pixels for each frame of nframes 
-        buffersize = nrsmall*nc*nframes
-        
-        # allocate the buffer(s)
-        buf = num.zeros((nframes,nrsmall,nc),dtype=num.uint8)
-        if params.use_expbgfgmodel:
-            buf_isback = num.zeros((nframes,nrsmall,nc),dtype=bool)
-            Z = num.zeros((nrsmall,nc))
-            idx = num.tile(num.resize(num.arange(nrsmall*nc),(nrsmall*nc,1)),(1,nframes))
-            grid = num.indices((nrsmall,nc))
+        # bands of rows are computed by worker processes; the ExpBGFGModel
+        # path is computed here only
+        nworkers = 1 if params.use_expbgfgmodel else get_bg_nworkers()
+        if nworkers > 1:
+            # a few bands per worker to balance the load
+            nrsmall = max(1,min(nrsmall,int(num.ceil(nr/(4.*nworkers)))))
 
         noffsets = num.ceil(float(nr) / float(nrsmall))
 
@@ -522,21 +850,91 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
             progressbar = \
                 wx.ProgressDialog('Computing Background Model',
                                   'Computing median, median absolute deviation of %d frames to estimate background model'%nframes,
-                                  nframes*noffsets,
+                                  nframes + noffsets,
                                   parent,
                                   wx.PD_AUTO_HIDE|wx.PD_CAN_ABORT|wx.PD_REMAINING_TIME)
 
+            def cancel():
+                progressbar.Destroy()
+                if isbackup:
+                    self.med = med0
+                    self.mad = mad0
+                else:
+                    delattr(self,'med')
+                    delattr(self,'mad')
+                return False
+
 
         # allocate memory for median and mad
         self.med = num.zeros((nr,nc), dtype=num.float64)
         self.mad = num.zeros((nr,nc), dtype=num.float64)
         self.fracframesisback = num.zeros((nr,nc), dtype=num.float64)
 
+        # read each sampled frame once
+        if DEBUG: print 'Reading ...'
+        if nworkers > 1:
+            stack, stacksource, stackfile = self.alloc_shared_sample_stack((nframes,nr,nc))
+        else:
+            stack = self.alloc_sample_stack((nframes,nr,nc),num.uint8)
+        if params.use_expbgfgmodel:
+            isback_stack = self.alloc_sample_stack((nframes,nr,nc),bool)
+        for i0 in range(0,nframes,BG_READ_CHUNK):
+            i1 = min(i0+BG_READ_CHUNK,nframes)
+
+            if params.feedback_enabled:
+                keepgoing = progressbar.Update(value=i0,
+                                               newmsg='Reading in frames %d - %d (%d / %d)'%(frms[i0],frms[i1-1],i1,nframes))[0]
+                if not keepgoing:
+                    return cancel()
+            else:
+                print 'Reading in frames %d - %d (%d / %d)'%(frms[i0],frms[i1-1],i1,nframes)
+
+            params.movie.get_frames(frms[i0:i1],out=stack[i0:i1])
+
+            # which pixels should we use in the background computation?
+            if params.use_expbgfgmodel:
+                for i in range(i0,i1):
+                    isback_stack[i] = self.thresh_expbgfgmodel_llr(stack[i])
+
+        # background value from a percentile instead of the median?
+        pcntl = params.percentile_for_bg
+        order = None
+        if pcntl and not params.use_expbgfgmodel:
+            order = int(percentile_order(nframes,pcntl))
+            print "YL: percentile given (%d) -- using frame %d out of %d" %(pcntl, order, nframes)
+
+        # row offsets to compute in this process
+        rowoffsets = range(0,nr,nrsmall)
+
+        if nworkers > 1:
+            if DEBUG: print 'Computing %d bands in %d processes ...'%(len(rowoffsets),nworkers)
+            medshared = multiprocessing.RawArray(ctypes.c_double, nr*nc)
+            madshared = multiprocessing.RawArray(ctypes.c_double, nr*nc)
+            pool = multiprocessing.Pool(nworkers, initializer=init_bg_worker,
+                                        initargs=(stacksource, (nframes,nr,nc), medshared, madshared, order))
+            try:
+                bands = [(r0, min(r0+nrsmall,nr)) for r0 in rowoffsets]
+                for ndone, (r0, r1) in enumerate(pool.imap_unordered(compute_band_into_shared, bands)):
+                    if params.feedback_enabled:
+                        keepgoing = progressbar.Update(value=nframes + ndone,
+                                                       newmsg='Computed rows %d - %d (%d / %d)'%(r0,r1-1,ndone+1,noffsets))[0]
+                        if not keepgoing:
+                            return cancel()
+            finally:
+                pool.terminate()
+                pool.join()
+                if stackfile is not None:
+                    stackfile.close()
+            self.med[:] = num.frombuffer(medshared, dtype=num.float64).reshape((nr,nc))
+            self.mad[:] = num.frombuffer(madshared, dtype=num.float64).reshape((nr,nc))
+            self.mad *= MADTOSTDFACTOR
+            rowoffsets = []
+
         # which row offset are we on?
         offseti = 0
 
         # loop over row offsets
-        for rowoffset in range(0,nr,nrsmall):
+        for rowoffset in rowoffsets:
 
             if DEBUG: print "row offset = %d."%rowoffset
 
@@ -547,203 +945,54 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
             rowoffsetnext = int(min(rowoffset+nrsmall,nr))
             nrowscurr = rowoffsetnext - rowoffset
 
-            # if this is the last pass, we may need a smaller buffer
-            if nrowscurr < nrsmall:
-                buf = buf[:,:nrowscurr,:]
-                if params.use_expbgfgmodel:
-                    buf_isback = buf_isback[:,:nrowscurr,:]
-                    Z = Z[:nrowscurr]
-                    idx = num.tile(num.resize(num.arange(nrowscurr*nc),(nrowscurr*nc,1)),(1,nframes))
-                    grid = num.indices((nrowscurr,nc))
-
-            if params.use_expbgfgmodel:
-                Z[:] = 0
-
-            if DEBUG: print 'Reading ...'
-            
-            # loop through frames
-            ff, nfs = self.bg_firstframe, nframesskip
-            frms = range(ff, ff+nframes*nfs, nfs) if on is None else self.bg_frames[on]
-            for i, frame in enumerate(frms):
-
-                if params.feedback_enabled:
-                    keepgoing = progressbar.Update(value=offseti*nframes + i,
-                                                   newmsg='Reading in piece of frame %d (%d / %d), offset = %d (%d / %d)'%(frame,i+1,nframes,rowoffset,offseti+1,noffsets))
-                    if not keepgoing:
-                        progressbar.Destroy()
-                        if isbackup:
-                            self.med = med0
-                            self.mad = mad0
-                        else:
-                            delattr(self,'med')
-                            delattr(self,'mad')
-                        return False
-                else:
-                    print 'Reading in piece of frame %d (%d / %d), offset = %d (%d / %d)'%(frame,i+1,nframes,rowoffset,offseti+1,noffsets)
-
-                # read in the entire frame
-                data,stamp = params.movie.get_frame(frame)
-
-                # crop out the rows we are interested in
-                buf[i,:,:]  = data[rowoffset:rowoffsetnext]
-
-                # should we use this frame in the background computation?
-                if params.use_expbgfgmodel:
-                    buf_isback[i,:,:] = self.thresh_expbgfgmodel_llr(data,r0=rowoffset,r1=rowoffsetnext)
-                    Z += buf_isback[i,:,:].astype(float)
-                    
-                frame = frame + nframesskip
+            if params.feedback_enabled:
+                keepgoing = progressbar.Update(value=nframes + offseti,
+                                               newmsg='Computing rows %d - %d (%d / %d)'%(rowoffset,rowoffsetnext-1,offseti+1,noffsets))[0]
+                if not keepgoing:
+                    return cancel()
 
             # compute the median and median absolute difference at each 
             # pixel location
             if DEBUG: print 'Computing ...'
             
-            # permute axes so that it is rows x columns x frames
-            buf = num.transpose(buf,[1,2,0])
-            #buf = num.rollaxis(num.rollaxis(buf,2,0),2,0)
-
             # median computation more complicated if we are ignoring some frames
             if params.use_expbgfgmodel:
-                
-                # permute isback axes as well
-                # buf_isback = num.rollaxis(num.rollaxis(buf_isback,2,0),2,0)
-                buf_isback = num.transpose(buf_isback,[1,2,0])
-                
-                # sort the data
-                
-                # reshape the data for easier indexing
-                buf.shape = (nrowscurr*nc,nframes)
-                buf_isback.shape = (nrowscurr*nc,nframes)
-                
-                # get the sorted order
-                ord = num.argsort(buf,axis=1,kind='mergesort')
-                
-                # apply the order
-                buf = num.reshape(buf[idx.flatten(),ord.flatten()],(nrowscurr,nc,nframes))
-                buf_isback = num.reshape(buf_isback[idx.flatten(),ord.flatten()],(nrowscurr,nc,nframes))
-
-                # which sample(s) of the data should we choose
-                iseven = num.mod(Z,2) == 0
-                middle1 = num.floor(Z/2)
-                middle2 = middle1-1
-
-                # which frame does this correspond to?
-                Zcurr = num.zeros((nrowscurr,nc))
-                frameidx1 = num.zeros((nrowscurr,nc),dtype=num.uint32)
-                frameidx2 = num.zeros((nrowscurr,nc),dtype=num.uint32)
-                for i in range(nframes):
-                    frameidx1[Zcurr == middle1] = i
-                    frameidx2[Zcurr == middle2] = i
-                    Zcurr[buf_isback[:,:,i]] += 1
-                                                
-                # grab data for relevant frames
-                med = num.resize(buf[grid[0].flatten(),grid[1].flatten(),frameidx1.flatten()],(nrowscurr,nc))
-                med2 = num.resize(buf[grid[0].flatten(),grid[1].flatten(),frameidx2.flatten()],(nrowscurr,nc))
-
-                # important to cast to floats, otherwise averaging doesn't work
-                med = med.astype(float)
-                med2 = med2.astype(float)
-
-                # average together two samples for even numbers of samples
-                if iseven.any():
-                    med[iseven] += med2[iseven]
-                    med[iseven] /= 2.
-
-                self.med[rowoffset:rowoffsetnext] = med
 
-                # store how many frames were used                    
-                self.fracframesisback[rowoffset:rowoffsetnext] = Z/float(nframes)
-                
-                # store the absolute difference
-                for j in range(nframes):
-                    # use maximum because buf is uint8s
-                    buf[:,:,j] = num.maximum(buf[:,:,j] - self.med[rowoffset:rowoffsetnext,:],
-                                            self.med[rowoffset:rowoffsetnext,:] - buf[:,:,j])
+                # crop out the rows we are interested in, as
+                # pixels x frames
+                buf = num.array(stack[:,rowoffset:rowoffsetnext,:]).reshape((nframes,-1)).T
+                buf_isback = num.array(isback_stack[:,rowoffset:rowoffsetnext,:]).reshape((nframes,-1)).T
 
-                # sort the data
-                
-                # reshape the data for easier indexing
-                buf.shape = (nrowscurr*nc,nframes)
-                buf_isback.shape = (nrowscurr*nc,nframes)
-
-                # get the sorted order
-                ord = num.argsort(buf,axis=1,kind='mergesort')
-
-                # apply the order
-                buf = num.reshape(buf[idx.flatten(),ord.flatten()],(nrowscurr,nc,nframes))
-                buf_isback = num.reshape(buf_isback[idx.flatten(),ord.flatten()],(nrowscurr,nc,nframes))
-
-                # which sample(s) of the data should we choose
-                Zcurr = num.zeros((nrowscurr,nc))
-                frameidx1 = num.zeros((nrowscurr,nc),dtype=num.uint32)
-                frameidx2 = num.zeros((nrowscurr,nc),dtype=num.uint32)
-                for i in range(nframes):
-                    frameidx1[Zcurr == middle1] = i
-                    frameidx2[Zcurr == middle2] = i
-                    Zcurr[buf_isback[:,:,i]] += 1
-                
-                # prior value
-                bgsigma = self.expbgfgmodel.bg_sigma[rowoffset:rowoffsetnext]
+                # median over the frames in which each pixel is background
+                med, Z = masked_median(buf,buf_isback)
+                self.med[rowoffset:rowoffsetnext] = med.reshape((nrowscurr,nc))
 
-                # grab data for relevant frames
-                grid = num.indices((nrowscurr,nc))
-                mad = num.resize(buf[grid[0].flatten(),grid[1].flatten(),frameidx1.flatten()],(nrowscurr,nc))
-                mad2 = num.resize(buf[grid[0].flatten(),grid[1].flatten(),frameidx2.flatten()],(nrowscurr,nc))
-                
-                # important to cast to floats, otherwise averaging doesn't work
-                mad = mad.astype(float)
-                mad2 = mad2.astype(float)
+                # store how many frames were used                    
+                self.fracframesisback[rowoffset:rowoffsetnext] = Z.reshape((nrowscurr,nc))/float(nframes)
                 
-                if iseven.any():
-                    mad[iseven] += mad2[iseven]
-                    mad[iseven] /= 2.
+                # median of the absolute differences over the same frames
+                # (truncated to uint8, as the differences were stored in
+                # the frame buffer)
+                buf = num.abs(buf - med[:,num.newaxis]).astype(num.uint8)
+                mad, Z = masked_median(buf,buf_isback)
 
                 # estimate standard deviation assuming a Gaussian distribution
                 # from the fact that half the data falls within mad
                 # MADTOSTDFACTOR = 1./norminv(.75)
                 mad *= MADTOSTDFACTOR
-                self.mad[rowoffset:rowoffsetnext] = mad
+                self.mad[rowoffset:rowoffsetnext] = mad.reshape((nrowscurr,nc))
 
             else:  
-                buf.sort(axis=2,kind='mergesort')
-                pcntl = params.percentile_for_bg
-                if pcntl:
-                    idx = num.floor(nframes*(100-pcntl)/100.)
-                    idx = max(0, min(idx, nframes-1))
-                    print "YL: percentile given (%d) -- using frame %d out of %d" %(pcntl, idx, nframes)
-                    self.med[rowoffset:rowoffsetnext,:] = buf[:,:,idx]
-                else:
-                    # store the median
-                    self.med[rowoffset:rowoffsetnext,:] = buf[:,:,middle1]
-                    if iseven:
-                        self.med[rowoffset:rowoffsetnext,:] += buf[:,:,middle2]
-                        self.med[rowoffset:rowoffsetnext,:] /= 2.
-
-                # store the absolute difference
-                buf = num.double(buf)
-                for j in range(nframes):
-                    buf[:,:,j] = num.abs(buf[:,:,j] - self.med[rowoffset:rowoffsetnext,:])
-    
-                # sort
-                buf.sort(axis=2,kind='mergesort')
-    
-                # store the median absolute difference
-                self.mad[rowoffset:rowoffsetnext,:] = buf[:,:,middle1]
-                if iseven:
-                    self.mad[rowoffset:rowoffsetnext,:] += buf[:,:,middle2]
-                    self.mad[rowoffset:rowoffsetnext,:] /= 2.
+                # order statistics from per-pixel histograms; store the
+                # median (or percentile) and median absolute difference
+                self.med[rowoffset:rowoffsetnext,:], self.mad[rowoffset:rowoffsetnext,:] = \
+                    band_medmad(stack, rowoffset, rowoffsetnext, order)
 
                 # estimate standard deviation assuming a Gaussian distribution
                 # from the fact that half the data falls within mad
                 # MADTOSTDFACTOR = 1./norminv(.75)
                 self.mad[rowoffset:rowoffsetnext,:] *= MADTOSTDFACTOR
 
-            # un-transpose buf:
-            # permute axes so that it is frames x rows x columns x frames
-            buf = num.transpose(buf,[2,0,1])
-            if params.use_expbgfgmodel:
-                buf_isback = num.transpose(buf_isback,[2,0,1])
-
             offseti += 1
 
 #        if params.use_expbgfgmodel:
@@ -791,6 +1040,8 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
         
         if num.any(self.dev == 0):
             raise ValueError('After filling in missing values, bg dev has some elements of value 0.')
+
+        self.clear_sub_bg_kernels()
         
     def medmad( self, parent=None ):
 
@@ -836,8 +1087,10 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
         #    madweight2 = madorder-num.double(madorder1)
 
         # number of rows to read in at a time; based on the assumption 
-        # that we comfortably hold 100*(400x400) frames in memory. 
-        nrsmall = num.int(num.floor(100.0*400.0*400.0/num.double(nc)/num.double(nframes)))
+        # that we comfortably hold 100*(400x400) frames in memory, with
+        # the per-pixel histograms of the rows read in
+        nrsmall = num.int(num.floor(100.0*400.0*400.0/num.double(nc)/bytesperpixel/
+                                    num.double(nframes + histogram_bg_nbytes(1))))
         if nrsmall < 1:
             nrsmall = 1
         if nrsmall > nr:
@@ -938,28 +1191,12 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
             # compute the median and median absolute difference at each 
             # pixel location
             if DEBUG: print 'Computing ...'
-            # sort all the histories to get the median
-            buf = buf.transpose()
-            buf.sort(axis=1,kind='mergesort')
+            hist = HistogramBg((nbytescurr,))
+            hist.add(buf)
             # store the median
-            self.med[imageoffset:imageoffsetnext] = buf[:,middle1]
-            if iseven:
-                self.med[imageoffset:imageoffsetnext] += buf[:,middle2]
-                self.med[imageoffset:imageoffsetnext] /= 2.
-                
-            # store the absolute difference
-            buf = num.double(buf)
-            for j in range(nframes):
-                buf[:,j] = num.abs(buf[:,j] - self.med[imageoffset:imageoffsetnext])
-
-            # sort
-            buf.sort(axis=1,kind='mergesort')
-
+            self.med[imageoffset:imageoffsetnext] = hist.median()
             # store the median absolute difference
-            self.mad[imageoffset:imageoffsetnext] = buf[:,middle1]
-            if iseven:
-                self.mad[imageoffset:imageoffsetnext] += buf[:,middle2]
-                self.mad[imageoffset:imageoffsetnext] /= 2.
+            self.mad[imageoffset:imageoffsetnext] = hist.mad(self.med[imageoffset:imageoffsetnext])
 
             #self.mad[imageoffset:imageoffsetnext] = buf[:,madorder1]*madweight1 + \
             #                                        buf[:,madorder2]*madweight2
@@ -1028,7 +1265,7 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
 
         else:
             if params.movie.type == 'fmf' or params.movie.type == 'avi' \
-                    or params.movie.type == 'avbin':
+                    or params.movie.type == 'avbin' or params.movie.type == 'cv':
                 if reestimate or not hasattr(self,'mean'):
                     succeeded = self.meanstd(parent)
                     if not succeeded:
@@ -1051,6 +1288,20 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
                 wx.MessageBox( "Invalid movie type",
                                "Error", wx.ICON_ERROR )
                 return False
+
+        self.finish_bg_model()
+
+        # keep what was learned about the movie for the next run
+        params.movie.save_metadata()
+
+        if hasattr( self, 'frame' ) and params.interactive:
+            self.DoSub()
+
+        return True
+
+    def finish_bg_model( self ):
+        """Check and limit the new center and dev, and compute what is
+        derived from them."""
         if num.any(num.isnan(self.dev)):
             raise ValueError('Computed bg dev has nan values.')
 
@@ -1080,15 +1331,107 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
         self.hfnorm = self.hf.apply(self.center) / tmp
         self.hfnorm[issmall & (self.hfnorm<1.)] = 1.
 
-        if hasattr( self, 'frame' ):
-            self.DoSub()
+        self.clear_sub_bg_kernels()
+
+    def start_rolling_bg( self, nwindow, nskip ):
+        """Start updating the median background model from the frames
+        being tracked: sub_bg() folds every nskip-th frame into a window of
+        nwindow frames, per on/off state for a varying background, and
+        publish_rolling_bg() makes it the current model. Returns False,
+        without starting, if that would take more than
+        params.bg_rolling_maxbytes of memory."""
+        states = [False, True] if self.varying_bg else [None]
+        nbytes = len(states)*rolling_bg_nbytes(params.movie_size,nwindow)
+        if nbytes > params.bg_rolling_maxbytes:
+            print "rolling background update needs %d MB, more than bg_rolling_maxbytes (%d MB); re-estimating the background instead"%(nbytes/1000000,params.bg_rolling_maxbytes/1000000)
+            self.rolling = None
+            return False
+        self.rolling = dict([(on, RollingBg(params.movie_size,nwindow,nskip))
+                             for on in states])
+        return True
+
+    def stop_rolling_bg( self ):
+        self.rolling = None
 
+    def publish_rolling_bg( self ):
+        """Make the background of the frames tracked in the window the
+        current model; pixels that were never background in the window
+        keep their model."""
+        if self.varying_bg:
+            for on in [False, True]:
+                self.rolling[on].estimate(self.meds[on],self.mads[on])
+            self.med, self.mad = self.meds[True], self.mads[True]
+            self.centers = copy.deepcopy(self.meds)
+            self.devs = copy.deepcopy(self.mads)
+        else:
+            self.rolling[None].estimate(self.med,self.mad)
+        self.center = self.med.copy()
+        self.dev = self.mad.copy()
+        self.finish_bg_model()
+
+    def start_bg_segment( self, firstframe, lastframe ):
+        """Start estimating the background model of frames
+        firstframe..lastframe in another process, while this model is
+        still in use. finish_bg_segment() swaps the new model in."""
+        self.stop_bg_segment()
+        if DEBUG: print "estimating background of frames %d - %d ahead"%(firstframe,lastframe)
+        self.segment_frames = (firstframe, lastframe)
+        self.segment_queue = multiprocessing.Queue()
+        self.segment_process = multiprocessing.Process( target=compute_bg_segment,
+            args=(self, firstframe, lastframe, params.movie.fullpath, self.segment_queue) )
+        # no thread may be holding the movie file while forking; the
+        # read-ahead resumes with the next in-order frame
+        params.movie.stop_prefetch_thread()
+        self.segment_process.start()
+
+    def finish_bg_segment( self, firstframe, lastframe ):
+        """Wait for the model of frames firstframe..lastframe started by
+        start_bg_segment() and swap it in. Returns False if there is none
+        or its estimation failed; the caller then estimates it itself."""
+        if getattr( self, 'segment_process', None ) is None or \
+                self.segment_frames != (firstframe, lastframe):
+            self.stop_bg_segment()
+            return False
+        result = None
+        while True:
+            try:
+                result = self.segment_queue.get( timeout=1. )
+                break
+            except Queue.Empty:
+                if not self.segment_process.is_alive():
+                    break
+        self.segment_process.join()
+        self.segment_process = None
+        if result is None:
+            return False
+        # all at once, between two frames
+        self.__dict__.update( result )
+        if not self.use_median:
+            self.center = self.mean.copy()
+            self.dev = self.std.copy()
+        else:
+            self.center = self.med.copy()
+            self.dev = self.mad.copy()
+            if self.varying_bg:
+                self.centers = copy.deepcopy(self.meds)
+                self.devs = copy.deepcopy(self.mads)
+        self.finish_bg_model()
         return True
+
+    def stop_bg_segment( self ):
+        """Abandon the model being estimated by start_bg_segment()."""
+        if getattr( self, 'segment_process', None ) is not None:
+            self.segment_process.terminate()
+            self.segment_process.join()
+            self.segment_process = None
     
 
     def sub_bg(self,framenumber=None,docomputecc=True,dobuffer=False,im=None,stamp=None):
         """Reads image, subtracts background, then thresholds."""
 
+        # connected components, if found while thresholding
+        cc = None
+
         # check to see if frame is in the buffer
         if framenumber is not None and \
                 framenumber >= self.buffer_start and \
@@ -1109,89 +1452,205 @@ class BackgroundCalculator (bg_settings.BackgroundSettings):
             else:
                 self.curr_im = im
 
-            im = self.curr_im.astype( num.float )
             self.curr_stamp = stamp
 
-            dfore = num.zeros(im.shape, dtype=num.float64)
+            on = None
             if self.varying_bg:
-                on = num.mean(im) > self.mean_separator
-                cntr = self.centers[on]
+                on = num.mean(self.curr_im) > self.mean_separator
                 if framenumber is not None and self.on != on:
                     self.on_changes.append([framenumber, on])
                 self.on = on
-            else:
-                cntr = self.center
-            if self.bg_type == 'light_on_dark':
-                # if white flies on a dark background, then we only care about differences
-                # im - bgmodel.center > bgmodel.thresh
-                dfore[self.isarena] = num.maximum(0,im[self.isarena] - cntr[self.isarena])
-
-            elif self.bg_type == 'dark_on_light':
-                # if dark flies on a white background, then we only care about differences
-                # bgmodel.center - im > bgmodel.thresh
-                dfore[self.isarena] = num.maximum(0,cntr[self.isarena] - im[self.isarena])
 
+            if params.bg_sub_fast:
+                (dfore,bwhigh,bwlow) = self.sub_bg_fast(self.curr_im,on)
             else:
-                # otherwise, we care about both directions
-                dfore[self.isarena] = num.abs(im[self.isarena] - cntr[self.isarena])
-                
-            if num.any(num.isnan(dfore)):
-                raise ValueError('Difference between image and bg center has nan values')
+                (dfore,bwhigh,bwlow) = self.sub_bg_float(self.curr_im,on)
 
-            #print "dev.range = [%f,%f]"%(num.min(self.dev),num.max(self.dev))
-            dev = self.devs[on] if self.varying_bg else self.dev
-            dfore[self.isarena] /= dev[self.isarena]
-            
-            if num.any(num.isnan(dfore)):
-                raise ValueError('Normalized distance between image and bg center has nan values')
-            
             if params.n_bg_std_thresh > params.n_bg_std_thresh_low:
-                bwhigh = num.zeros(im.shape,dtype=bool)
-                bwlow = num.zeros(im.shape,dtype=bool)
-                bwhigh[self.isarena] = dfore[self.isarena] > params.n_bg_std_thresh
-                bwlow[self.isarena] = dfore[self.isarena] > params.n_bg_std_thresh_low
-
                 # do hysteresis
-                bw = morph.binary_propagation(bwhigh,mask=bwlow)
+                if params.bg_label_hysteresis:
+                    (bw,cc,ncc) = label_hysteresis(bwhigh,bwlow)
+                else:
+                    bw = morph.binary_propagation(bwhigh,mask=bwlow)
             else:
-                bw = num.zeros(im.shape,dtype=bool)
-                bw[self.isarena] = dfore[self.isarena] > params.n_bg_std_thresh
+                bw = bwhigh.copy()
 
             # do morphology
             if params.do_use_morphology:
                 if params.opening_radius > 0:
                     bw = morph.binary_opening(bw,self.opening_struct)
+                    cc = None
                 if params.closing_radius > 0:
                     bw = morph.binary_closing(bw,self.closing_struct)
+                    cc = None
 
             if dobuffer:
                 # store in buffer
                 self.store_in_buffer(framenumber,dfore,bw)
+
+            if getattr(self,'rolling',None) is not None and framenumber is not None:
+                self.rolling[on].add(framenumber,self.curr_im,bw == False)
         
         if not docomputecc:
             return (dfore,bw)
 
-        [cc,ncc] = meas.label(bw)
+        if cc is None:
+            [cc,ncc] = meas.label(bw)
 
         # make sure there aren't too many connected components
         if ncc > params.max_n_clusters or self.first:
             # sort by area
-            areas = num.zeros( (cc.max(),), dtype=num.float64 )
+            stats = ccstats.get( cc, ncc )
+            areas = stats.area.astype( num.float64 )
             print "%d objects found; determining the largest %d to keep"%(areas.size, params.max_n_clusters)
-            for clust_ind in range( areas.size ):
-                areas[clust_ind] = (cc == clust_ind+1).nonzero()[0].size
             area_order = num.argsort( areas )
             if self.first:
                 print "YL:", areas, area_order
                 self.first = False
             else:
                 for clust_ind in area_order[-params.max_n_clusters:]:
-                    cc[cc == clust_ind] = 0
+                    (r,c) = stats.pixels( clust_ind )
+                    cc[r,c] = 0
+                ccstats.invalidate( cc )
                 ncc = params.max_n_clusters
 
         return (dfore,bw,cc,ncc)
     
 
+    def sub_bg_float(self,im,on):
+        """Return normalized difference from the background and the
+        foreground masks for the high and low thresholds (None if there is
+        no hysteresis), computed in float64."""
+        im = im.astype( num.float )
+        cntr = self.centers[on] if self.varying_bg else self.center
+
+        dfore = num.zeros(im.shape, dtype=num.float64)
+        if self.bg_type == 'light_on_dark':
+            # if white flies on a dark background, then we only care about differences
+            # im - bgmodel.center > bgmodel.thresh
+            dfore[self.isarena] = num.maximum(0,im[self.isarena] - cntr[self.isarena])
+
+        elif self.bg_type == 'dark_on_light':
+            # if dark flies on a white background, then we only care about differences
+            # bgmodel.center - im > bgmodel.thresh
+            dfore[self.isarena] = num.maximum(0,cntr[self.isarena] - im[self.isarena])
+
+        else:
+            # otherwise, we care about both directions
+            dfore[self.isarena] = num.abs(im[self.isarena] - cntr[self.isarena])
+            
+        if num.any(num.isnan(dfore)):
+            raise ValueError('Difference between image and bg center has nan values')
+
+        #print "dev.range = [%f,%f]"%(num.min(self.dev),num.max(self.dev))
+        dev = self.devs[on] if self.varying_bg else self.dev
+        dfore[self.isarena] /= dev[self.isarena]
+        
+        if num.any(num.isnan(dfore)):
+            raise ValueError('Normalized distance between image and bg center has nan values')
+        
+        bwhigh = num.zeros(im.shape,dtype=bool)
+        bwhigh[self.isarena] = dfore[self.isarena] > params.n_bg_std_thresh
+        bwlow = None
+        if params.n_bg_std_thresh > params.n_bg_std_thresh_low:
+            bwlow = num.zeros(im.shape,dtype=bool)
+            bwlow[self.isarena] = dfore[self.isarena] > params.n_bg_std_thresh_low
+
+        return (dfore,bwhigh,bwlow)
+
+    def sub_bg_fast(self,im,on):
+        """Same as sub_bg_float, but the masks come from comparing the
+        uint8 frame with the threshold images of sub_bg_kernel(), and the
+        normalized difference is computed in float32 without masking.
+        The masks are buffers that are reused by the next call."""
+        kernel = self.sub_bg_kernel(on)
+
+        dfore = num.empty(im.shape, dtype=num.float32)
+        num.subtract(im,kernel['center'],out=dfore)
+        num.multiply(dfore,kernel['invdev'],out=dfore)
+        if self.bg_type == 'other':
+            num.abs(dfore,out=dfore)
+        else:
+            num.maximum(dfore,0,out=dfore)
+
+        def threshold(bw,name):
+            # brighter than hi or darker than lo
+            num.greater(im,kernel['hi_'+name],out=bw)
+            if self.bg_type != 'light_on_dark':
+                num.less(im,kernel['lo_'+name],out=kernel['isdarker'])
+                bw |= kernel['isdarker']
+            return bw
+
+        bwhigh = threshold(kernel['bwhigh'],'high')
+        bwlow = None
+        if params.n_bg_std_thresh > params.n_bg_std_thresh_low:
+            bwlow = threshold(kernel['bwlow'],'low')
+
+        return (dfore,bwhigh,bwlow)
+
+    def sub_bg_kernel(self,on):
+        """Return the images used by sub_bg_fast() for background state
+        on, computing them when the model, thresholds or arena changed:
+        float32 center and 1/dev, negated for dark flies and 0 outside the
+        arena, and uint8 images hi and lo for the high and low thresholds.
+        A pixel is above threshold where the frame is > hi (brighter than
+        the background) or < lo (darker); outside the arena hi is 255 and
+        lo is 0, so it never is.
+
+        The images are kept until center, dev or isarena are replaced by
+        other arrays or clear_sub_bg_kernels() is called; anything that
+        changes them in place must call it."""
+        cntr = self.centers[on] if self.varying_bg else self.center
+        dev = self.devs[on] if self.varying_bg else self.dev
+        source = (cntr, dev, self.isarena, self.bg_type,
+                  params.n_bg_std_thresh, params.n_bg_std_thresh_low)
+
+        if not hasattr(self,'sub_bg_kernels'):
+            self.sub_bg_kernels = {}
+        kernel = self.sub_bg_kernels.get(on)
+        if kernel is not None and len(kernel['source']) == len(source) and \
+                all([a is b or (num.isscalar(a) and a == b) for a, b in zip(kernel['source'],source)]):
+            return kernel
+
+        if num.any(num.isnan(cntr[self.isarena])):
+            raise ValueError('Background center has nan values')
+        if num.any(num.isnan(dev[self.isarena])) or num.any(dev[self.isarena] <= 0):
+            raise ValueError('Background dev has nan or nonpositive values')
+
+        if DEBUG: print 'computing background subtraction images'
+        kernel = {'source': source}
+        kernel['center'] = num.zeros(cntr.shape,dtype=num.float32)
+        kernel['center'][self.isarena] = cntr[self.isarena]
+        invdev = num.zeros(cntr.shape,dtype=num.float32)
+        invdev[self.isarena] = 1./dev[self.isarena]
+        if self.bg_type == 'dark_on_light':
+            invdev = -invdev
+        kernel['invdev'] = invdev
+
+        for name, thresh in (('high',params.n_bg_std_thresh),('low',params.n_bg_std_thresh_low)):
+            hi = num.empty(cntr.shape,dtype=num.uint8)
+            hi.fill(255)
+            lo = num.zeros(cntr.shape,dtype=num.uint8)
+            # integer im > c + thresh*dev iff im > floor(c + thresh*dev),
+            # and im < c - thresh*dev iff im < ceil(c - thresh*dev)
+            if self.bg_type != 'dark_on_light':
+                hi[self.isarena] = num.clip(num.floor(cntr + thresh*dev),0,255)[self.isarena]
+            if self.bg_type != 'light_on_dark':
+                lo[self.isarena] = num.clip(num.ceil(cntr - thresh*dev),0,255)[self.isarena]
+            kernel['hi_'+name] = hi
+            kernel['lo_'+name] = lo
+
+        for name in ('bwhigh','bwlow','isdarker'):
+            kernel[name] = num.zeros(cntr.shape,dtype=bool)
+
+        self.sub_bg_kernels[on] = kernel
+        return kernel
+
+    def clear_sub_bg_kernels(self):
+        """Forget the images sub_bg_kernel() derived from the model; call
+        after changing center, dev or isarena in place."""
+        self.sub_bg_kernels = {}
+
     def store_in_buffer(self,framenumber,dfore,bw):
         
         if self.buffer_maxnframes == 0:
@@ -324,6 +324,7 @@ class BackgroundSettings:
                 self.dev[self.dev < params.bg_std_min] = params.bg_std_min
                 self.dev[self.dev > params.bg_std_max] = params.bg_std_max
             self.hf_button.Enable(False)
+        self.clear_sub_bg_kernels()
             
         # get the old maxdfore
         donormalize = False
@@ -424,9 +425,11 @@ class BackgroundSettings:
         if params.do_set_circular_arena and \
                hasattr(params,'arena_center_x') and \
            (params.arena_center_x is not None):
-            self.isarena = self.isarena & ( ((params.GRID.X - params.arena_center_x)**2. + (params.GRID.Y - params.arena_center_y)**2) <= params.arena_radius**2. )
+            [Y,X] = num.ogrid[0:params.movie_size[0],0:params.movie_size[1]]
+            self.isarena = self.isarena & ( ((X - params.arena_center_x)**2. + (Y - params.arena_center_y)**2) <= params.arena_radius**2. )
         if hasattr(self,'roi'):
             self.isarena = self.isarena & self.roi
+        self.clear_sub_bg_kernels()
 
     def OnDetectArenaClick( self, evt ):
         if self.detect_arena_window_open:
@@ -602,6 +605,7 @@ class BackgroundSettings:
                 self.dev[:] = self.std
             self.dev[self.dev < params.bg_std_min] = params.bg_std_min
             self.dev[self.dev > params.bg_std_max] = params.bg_std_max
+            self.clear_sub_bg_kernels()
         except ValueError:
             # if not a number, then set the value to the previous threshold
             self.bg_minstd_textinput.SetValue(str(params.bg_std_min))
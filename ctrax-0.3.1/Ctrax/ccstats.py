@@ -0,0 +1,103 @@
+# ccstats.py
+# statistics of the connected components of a label image (areas, bounding
+# boxes, pixel lists, weighted moments), computed in one pass over the
+# foreground pixels and kept for the label image of the current frame
+
+import numpy as num
+
+
+class ComponentStats:
+    """Statistics of components 1..ncc of label image L. The foreground
+    pixels are sorted by label once; the statistics of all components are
+    read off the sorted pixel list with bincount, so their cost depends on
+    the number of foreground pixels, not on the size of the image."""
+
+    def __init__( self, L, ncc ):
+        self.L = L
+        self.ncc = ncc
+
+        # foreground pixels sorted by label, in raster order per label
+        index = num.flatnonzero( L )
+        labels = L.ravel()[index].astype( num.intp )
+        order = num.argsort( labels, kind='mergesort' )
+        self.labels = labels[order]
+        index = index[order]
+        self.r = index // L.shape[1]
+        self.c = index % L.shape[1]
+
+        # the pixels of component l are start[l]:start[l+1]
+        self.start = num.searchsorted( self.labels, num.arange( ncc + 2 ) )
+        self.area = num.diff( self.start )[1:]
+
+        # moments for the last weight image, and its sums per component
+        self.weights = None
+        self.weighted_moments = None
+        self.weight_sums = None
+
+    def pixels( self, l ):
+        """Return rows and columns of the pixels of component l."""
+        return (self.r[self.start[l]:self.start[l+1]],
+                self.c[self.start[l]:self.start[l+1]])
+
+    def boundingboxes( self ):
+        """Return first and last row and column of each component; -1 for
+        components without pixels."""
+        (r1, r2, c1, c2) = [-num.ones( self.ncc, dtype=num.intp ) for i in range( 4 )]
+        isnonempty = self.area > 0
+        if isnonempty.any():
+            starts = self.start[1:-1][isnonempty]
+            end = self.start[-1]
+            r1[isnonempty] = num.minimum.reduceat( self.r[:end], starts )
+            r2[isnonempty] = num.maximum.reduceat( self.r[:end], starts )
+            c1[isnonempty] = num.minimum.reduceat( self.c[:end], starts )
+            c2[isnonempty] = num.maximum.reduceat( self.c[:end], starts )
+        return (r1, r2, c1, c2)
+
+    def moments( self, w ):
+        """Return weight sums (1 where 0), weighted centers x and y, and
+        weighted variances xx, yy and covariance xy of the pixel
+        coordinates of each component, for weight image w. The weight sums,
+        including 0s, are kept in weight_sums."""
+        if self.weights is w:
+            return self.weighted_moments
+
+        end = self.start[-1]
+        labels = self.labels[:end]
+        x = self.c[:end].astype( num.float64 )
+        y = self.r[:end].astype( num.float64 )
+        ww = w[self.r[:end],self.c[:end]].astype( num.float64 )
+
+        def wsum( v ):
+            return num.bincount( labels, v, minlength=self.ncc + 1 )[1:self.ncc + 1]
+
+        z = wsum( ww )
+        self.weight_sums = z.copy()
+        z[z==0] = 1
+        cx = wsum( ww*x )/z
+        cy = wsum( ww*y )/z
+        cx2 = wsum( ww*x*x )/z - cx**2
+        cy2 = wsum( ww*y*y )/z - cy**2
+        cxy = wsum( ww*x*y )/z - cx*cy
+
+        self.weights = w
+        self.weighted_moments = (z, cx, cy, cx2, cy2, cxy)
+        return self.weighted_moments
+
+
+# statistics of the most recent label image
+_current = {}
+
+def get( L, ncc ):
+    """Return the statistics of label image L, reusing those of the last
+    call for the same L unless it was changed with invalidate()."""
+    stats = _current.get( 'stats' )
+    if stats is None or stats.L is not L or stats.ncc != ncc:
+        stats = ComponentStats( L, ncc )
+        _current['stats'] = stats
+    return stats
+
+def invalidate( L ):
+    """Forget the statistics of L; call after changing L in place."""
+    stats = _current.get( 'stats' )
+    if stats is not None and stats.L is L:
+        del _current['stats']
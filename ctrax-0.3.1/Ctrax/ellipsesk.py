@@ -266,10 +266,12 @@ import estconncomps as est
 #######################################################################
 # find_ellipses()
 #######################################################################
-def find_ellipses( dfore , L, ncc, dofix=True ):
+def find_ellipses( dfore , L, ncc, dofix=True, splitpred=None ):
     """Fits ellipses to connected components in image.
     Returns an EllipseList, each member representing
-    the x,y position and orientation of a single fly."""
+    the x,y position and orientation of a single fly.
+    splitpred are the predicted positions of flies that were split from
+    a connected component in the previous frame (see split_predictions)."""
 
     if DEBUG_TRACKINGSETTINGS: print 'ncc = ' + str(ncc) + ', max(L) = ' + str(num.max(L)) + ', nnz(L) = ' + str(num.flatnonzero(L).shape) + ', sum(dfore) = ' + str(num.sum(num.sum(dfore)))
 
@@ -300,7 +302,7 @@ def find_ellipses( dfore , L, ncc, dofix=True ):
         last_time = time.time()
 
         # check if any are large, and [try to] fix those
-        est.fixlarge(ellipses,L,dfore)
+        est.fixlarge(ellipses,L,dfore,splitpred)
 
         if DEBUG_TRACKINGSETTINGS:
             print 'after fixing large, ellipses ='
@@ -354,6 +356,7 @@ def est_shape( bg, tracking_settings_frame=None ):
     # which frames will we estimate size from
     framelist = num.round( num.linspace( 0, params.n_frames-1,
                                          params.n_frames_size ) ).astype( num.int )
+    framelist = params.movie.snap_to_keyframes( framelist )
 
     ellipses = []
 
@@ -527,6 +530,17 @@ def find_ellipses_display( dfore , L, ncc ):
     return (ellipsescopy,ellsmall,elllarge,didlowerthresh,didmerge,diddelete,didsplit)
 
 
+#######################################################################
+# split_predictions()
+#######################################################################
+def split_predictions( old0, old1 ):
+    """Returns the predicted positions (a list of Ellipses) of the targets
+    in old1 that were split from a larger connected component."""
+    targ = m_id.cvpred( old0, old1 )
+    return [targ[i] for i in old1.iterkeys()
+            if old1[i].issplit and targ.hasItem( i ) and not targ[i].isDummy()]
+
+
 #######################################################################
 # find_flies()
 #######################################################################
@@ -3,6 +3,8 @@ from ellipsesk import *
 #from pylab import *
 import scipy.ndimage as meas
 import kcluster2d as kcluster
+import ccstats
+import gmmbatch
 #from kcluster import gmm
 from params import params, diagnostics, diagnosticsAdd
 # this uses its own debug
@@ -73,18 +75,28 @@ def cov2ell(S):
 def ellipsepixels(ellipse,bounds):
     # convert axes to covariance matrix
     S = ell2cov(ellipse.major,ellipse.minor,ellipse.angle)
-    # get all pixels in box
-    [x,y] = num.meshgrid(num.arange(bounds[2],bounds[3],1),num.arange(bounds[0],bounds[1],1))
-    # subtract off center
-    x -= ellipse.center.x
-    y -= ellipse.center.y
-    # compute Mah distance
-    Sinv = num.linalg.inv(S)
-    d = x**2*Sinv[0,0] + 2*Sinv[0,1]*x*y + y**2*Sinv[1,1]
+    # coordinates of the pixels in box, relative to the center
+    x = num.arange(bounds[2],bounds[3],1)[num.newaxis,:] - ellipse.center.x
+    y = num.arange(bounds[0],bounds[1],1)[:,num.newaxis] - ellipse.center.y
+    # compute Mah distance, with the inverse of the 2x2 covariance
+    det = S[0,0]*S[1,1] - S[0,1]**2
+    d = (x**2*S[1,1] - 2*S[0,1]*x*y + y**2*S[0,0])/det
     # threshold at 4
     bw = d <= 4
     return bw
 
+def ellipsespixels(centerX,centerY,major,minor,angle,bounds):
+    # pixels of the box rows bounds[0]:bounds[1], columns
+    # bounds[2]:bounds[3] inside each of the ellipses with the given
+    # parameters (arrays), as in ellipsepixels
+    (S00,S11,S01) = gmmbatch.ell2cov(major,minor,angle)
+    (S00,S11,S01) = (S00[:,num.newaxis,num.newaxis],S11[:,num.newaxis,num.newaxis],S01[:,num.newaxis,num.newaxis])
+    x = num.arange(bounds[2],bounds[3],1)[num.newaxis,num.newaxis,:] - centerX[:,num.newaxis,num.newaxis]
+    y = num.arange(bounds[0],bounds[1],1)[num.newaxis,:,num.newaxis] - centerY[:,num.newaxis,num.newaxis]
+    det = S00*S11 - S01**2
+    d = (x**2*S11 - 2*S01*x*y + y**2*S00)/det
+    return d <= 4
+
 def copyellipse(ellipses,i,newellipse):
     """Should use ellipse.copy() instead."""
     import warnings
@@ -98,12 +110,16 @@ def copyellipse(ellipses,i,newellipse):
 
 
 def weightedregionpropsi(BWI,w):
+    (r,c) = num.where(BWI)
+    return weightedregionpropsrc(r,c,w)
+
+def weightedregionpropsrc(r,c,w):
+    # ellipse fit to pixels at rows r and columns c with weights w
     # normalize weights
     Z = sum(w)
     if Z == 0:
         Z = 1
     # compute mean
-    (r,c) = num.where(BWI)
     centerX = sum(c*w)/Z
     centerY = sum(r*w)/Z
     # compute variance
@@ -133,41 +149,9 @@ def weightedregionprops(L,ncc,dfore):
     if ncc == 0:
         return []
 
-    # all connected components
-    index = range(1,ncc+1)
-
-    time0 = time.time()
-
-    # create the unnormalized weight matrix
-    w = dfore
-    #w[L==0] = 0
-
-    # compute the normalization terms
-    z = num.array(meas.sum(w,L,index),ndmin=1)
-    z[z==0] = 1
-
-    # compute the unnormalized centers
-    cx = num.array(meas.sum(w*params.GRID.X,L,index),ndmin=1)
-    cy = num.array(meas.sum(w*params.GRID.Y,L,index),ndmin=1)
-
-    # normalize centers
-    cx /= z
-    cy /= z
-
-    # compute unnormalized, uncentered variances
-    cx2 = num.array(meas.sum(w*params.GRID.X2,L,index),ndmin=1)
-    cy2 = num.array(meas.sum(w*params.GRID.Y2,L,index),ndmin=1)
-    cxy = num.array(meas.sum(w*params.GRID.XY,L,index),ndmin=1)
-
-    # normalize variances
-    cx2 /= z
-    cy2 /= z
-    cxy /= z
-
-    # center variances
-    cx2 -= cx**2
-    cy2 -= cy**2
-    cxy -= cx*cy
+    # weighted centers and variances of all connected components, from
+    # the statistics of this frame's label image
+    (z,cx,cy,cx2,cy2,cxy) = ccstats.get(L,ncc).moments(dfore)
 
     # create ellipses
     ellipses = []
@@ -265,86 +249,143 @@ def trylowerthresh(ellipses,i,L,dfore):
 
     return (issmall,ellipsenew)
 
-def findclosecenters(ellipses,i):
-    # maximum distance between centers
+class CenterIndex:
+    """Uniform grid over the centers of ellipses, for finding the ellipses
+    near a point without scanning all of them. Call move(i) when the center
+    of ellipses[i] changes."""
+
+    def __init__(self,ellipses,cellsize):
+        self.ellipses = ellipses
+        self.cellsize = max(float(cellsize),1.)
+        self.cells = {}
+        self.cellof = {}
+        for i in range(len(ellipses)):
+            self.move(i)
+
+    def cell(self,x,y):
+        return (int(num.floor(x/self.cellsize)),int(num.floor(y/self.cellsize)))
+
+    def move(self,i):
+        if i in self.cellof:
+            self.cells[self.cellof[i]].remove(i)
+        self.cellof[i] = self.cell(self.ellipses[i].center.x,self.ellipses[i].center.y)
+        self.cells.setdefault(self.cellof[i],set()).add(i)
+
+    def near(self,x,y,d):
+        """Return indices of the ellipses in the cells within d of (x,y),
+        which include all ellipses with centers within d."""
+        (cx1,cy1) = self.cell(x-d,y-d)
+        (cx2,cy2) = self.cell(x+d,y+d)
+        inds = []
+        for cx in range(cx1,cx2+1):
+            for cy in range(cy1,cy2+1):
+                inds.extend(self.cells.get((cx,cy),()))
+        return inds
+
+def maxdmergecenter(ellipse):
+    # maximum distance between centers of ellipses to merge
     #if num.isinf(params.maxshape.major):
     #    maxmajor = 0.
     #    for ell in ellipses:
     #        maxmajor = max(maxmajor,ell.major)
     #else:
     #    maxmajor = params.maxshape.major
-    maxdmergecenter = ellipses[i].major*4.*(1.+params.maxdcentersextra)
+    return ellipse.major*4.*(1.+params.maxdcentersextra)
     #maxdmergecenter = maxmajor*4+ellipses[i].minor*2
-    #print 'maxdmergecenter = ' + str(maxdmergecenter)
-    
-    # indices other than i
-    isotherind = num.ones(len(ellipses),dtype=bool)
-    isotherind[i] = False
-    for j in range(len(ellipses)):
-        if ellipses[j].area == 0:
-            isotherind[j] = False
-    otherinds = num.where(isotherind)[0]
-    nother = len(otherinds)
-    #print 'otherinds: ' + str(otherinds)
-
-    # first threshold x distance
-    dx = num.zeros(nother)
-    for j in range(nother):
-        dx[j] = abs(ellipses[otherinds[j]].center.x-ellipses[i].center.x)
-    isclose = dx < maxdmergecenter
-    cannotmerge = num.any(isclose) == False
-    #print 'after thresholding x distance, isclose = ' + str(isclose)
-
-    # then threshold y distance
-    if cannotmerge == False:
-        dy = num.zeros(nother)
-        dy[:] = maxdmergecenter
-        for j in range(nother):
-            if isclose[j]:
-                dy[j] = abs(ellipses[j].center.y-ellipses[i].center.y)
-        isclose[isclose] = dy[isclose] < maxdmergecenter
-        cannotmerge = num.any(isclose) == False
-
-    # then threshold Euclidean distance
-    if cannotmerge == False:
-        maxdmergecentersquared = maxdmergecenter**2
-        d = num.zeros(nother)
-        d[:] = maxdmergecentersquared
-        d[isclose] = dx[isclose]**2 + dy[isclose]**2
-        isclose[isclose] = d[isclose] < maxdmergecentersquared
-        cannotmerge = num.any(isclose) == False
+
+def findclosecenters(ellipses,i,index=None):
+    # indices of the ellipses other than i with centers less than
+    # maxdmergecenter from the center of i, in increasing order; with an
+    # index, only the ellipses in nearby cells are looked at
+    maxd = maxdmergecenter(ellipses[i])
+    if index is None:
+        otherinds = range(len(ellipses))
+    else:
+        otherinds = index.near(ellipses[i].center.x,ellipses[i].center.y,maxd)
+    otherinds = num.array(sorted([j for j in otherinds
+                                  if j != i and ellipses[j].area != 0]),dtype=int)
+    if otherinds.size == 0:
+        return otherinds
+
+    # threshold x, y and Euclidean distance
+    dx = num.abs(num.array([ellipses[j].center.x for j in otherinds]) - ellipses[i].center.x)
+    dy = num.abs(num.array([ellipses[j].center.y for j in otherinds]) - ellipses[i].center.y)
+    isclose = (dx < maxd) & (dy < maxd) & (dx**2 + dy**2 < maxd**2)
 
     indsmerge = otherinds[isclose]
     return indsmerge
 
-def computemergepenalty(ellipses,i,j,L,dfore):
-    # compute parameters of merged component
-    BWmerge = num.logical_or(L == i+1,L == j+1)
-    if not BWmerge.any():
-        return (0.,ellipses[i])
-    ellipsemerge = weightedregionpropsi(BWmerge,dfore[BWmerge])
-    #print 'in computemergepenalty, ellipsemerge is: ' + str(ellipsemerge)
-    # see if the major, minor, area are small enough
-    if (ellipsemerge.area > params.maxshape.area) or (ellipsemerge.minor > params.maxshape.minor) or (ellipsemerge.major > params.maxshape.major):
-        #print 'merged ellipse would be too large'
-        return (params.maxpenaltymerge+1,ellipses[i])
+def mergepenalties(ellipses,i,js,L,dfore):
+    # penalties for merging ellipse i with each of the ellipses js, and the
+    # merged ellipses. the merged ellipses are fit for all js at once from
+    # the weighted moments of the connected components, and the penalties
+    # are computed for all js at once in one box around them
+    js = num.asarray(js,dtype=int)
+    stats = ccstats.get(L,len(ellipses))
+    (z,cx,cy,cx2,cy2,cxy) = stats.moments(dfore)
+
+    # moments of the union of components i and js
+    Z = stats.weight_sums[i] + stats.weight_sums[js]
+    Z[Z==0] = 1
+    def mergedsum(m):
+        return (z[i]*m[i] + z[js]*m[js])/Z
+    centerX = mergedsum(cx)
+    centerY = mergedsum(cy)
+    S00 = mergedsum(cx2 + cx**2) - centerX**2
+    S11 = mergedsum(cy2 + cy**2) - centerY**2
+    S01 = mergedsum(cxy + cx*cy) - centerX*centerY
+    (sizeH,sizeW,angle) = gmmbatch.cov2ell(S00,S11,S01)
+    # if there is only one pixel, then the variance will be 0
+    istiny = (sizeH < .125) | num.isnan(sizeH)
+    sizeH[istiny] = .125
+    sizeW[istiny | (sizeW < .125) | num.isnan(sizeW)] = .125
+    area = num.pi * sizeW * sizeH * 4
+
+    # merging with an empty component leaves ellipse i; a merged ellipse
+    # that is too large gets more than the maximum penalty
+    mergepenalty = num.zeros(len(js))
+    ellipsesmerge = [ellipses[i]]*len(js)
+    isempty = stats.area[i] + stats.area[js] == 0
+    toolarge = (area > params.maxshape.area) | (sizeW > params.maxshape.minor) | (sizeH > params.maxshape.major)
+    mergepenalty[toolarge & (isempty==False)] = params.maxpenaltymerge+1
+    ks = num.flatnonzero((isempty | toolarge)==False)
+    if ks.size == 0:
+        return (mergepenalty,ellipsesmerge)
+    for k in ks:
+        ellipsesmerge[k] = Ellipse(centerX[k],centerY[k],sizeW[k],sizeH[k],angle[k],area[k],-1)
+    (centerX,centerY,sizeW,sizeH,angle) = (centerX[ks],centerY[ks],sizeW[ks],sizeH[ks],angle[ks])
+
+    # tight bounding boxes of the merged ellipses (see getboundingboxtight);
+    # the penalties are computed in the box containing all of them
+    r1 = num.maximum(num.floor(centerY-sizeH*2),0).astype(int)
+    r2 = num.minimum(num.ceil(centerY+sizeH*2)+1,L.shape[0]).astype(int)
+    c1 = num.maximum(num.floor(centerX-sizeH*2),0).astype(int)
+    c2 = num.minimum(num.ceil(centerX+sizeH*2)+1,L.shape[1]).astype(int)
+    bounds = (r1.min(),r2.max(),c1.min(),c2.max())
+    rows = num.arange(bounds[0],bounds[1])[num.newaxis,:,num.newaxis]
+    cols = num.arange(bounds[2],bounds[3])[num.newaxis,num.newaxis,:]
+    inbox = (rows >= r1[:,num.newaxis,num.newaxis]) & (rows < r2[:,num.newaxis,num.newaxis]) & \
+            (cols >= c1[:,num.newaxis,num.newaxis]) & (cols < c2[:,num.newaxis,num.newaxis])
+
     # find pixels that should be foreground according to the ellipse parameters
-    (r1,r2,c1,c2) = getboundingboxtight(ellipsemerge,L.shape)
-    isforepredmerge = ellipsepixels(ellipsemerge,num.array([r1,r2,c1,c2]))
+    isforepredmerge = ellipsespixels(centerX,centerY,sizeH,sizeW,angle,bounds) & inbox
     # pixels that were foreground
-    isforepredi = ellipsepixels(ellipses[i],num.array([r1,r2,c1,c2]))
-    isforepredj = ellipsepixels(ellipses[j],num.array([r1,r2,c1,c2]))
-    isforepredi = num.logical_or(isforepredi, (L[r1:r2,c1:c2]==i+1))
+    ei = ellipses[i]
+    isforepredi = ellipsespixels(num.array([ei.center.x]),num.array([ei.center.y]),
+                                 num.array([ei.major]),num.array([ei.minor]),
+                                 num.array([ei.angle]),bounds)
+    isforepredi |= L[bounds[0]:bounds[1],bounds[2]:bounds[3]]==i+1
+    ej = [ellipses[j] for j in js[ks]]
+    isforepredj = ellipsespixels(num.array([e.center.x for e in ej]),num.array([e.center.y for e in ej]),
+                                 num.array([e.major for e in ej]),num.array([e.minor for e in ej]),
+                                 num.array([e.angle for e in ej]),bounds)
     # pixels that are now foreground that weren't before
-    newforemerge = num.logical_and(isforepredmerge,num.logical_or(isforepredi,isforepredj)==False)
+    newforemerge = isforepredmerge & ((isforepredi | isforepredj)==False)
     # compute the total background score for this new region that must be foreground
-    dforemerge = dfore[r1:r2,c1:c2].copy()
-    dforemerge = 1 - dforemerge[newforemerge]
-    dforemerge[dforemerge<0] = 0
-    mergepenalty = num.sum(dforemerge)
+    dforemerge = num.maximum(1 - dfore[bounds[0]:bounds[1],bounds[2]:bounds[3]],0)
+    mergepenalty[ks] = num.sum((newforemerge*dforemerge).reshape(ks.size,-1),axis=1)
     #print 'mergepenalty = ' + str(mergepenalty)
-    #print 'in computemergepenalty, ellipsemerge is: ' + str(ellipsemerge)
-    return (mergepenalty,ellipsemerge)
+    return (mergepenalty,ellipsesmerge)
 
 def hindsight_computemergepenalty(ellipses,i,j,L,dfore):
     # compute parameters of merged component
@@ -383,13 +424,15 @@ def mergeellipses(ellipses,i,j,ellipsemerge,issmall,L):
     ellipses[j].area = 0
     issmall[i] = ellipsemerge.area < params.minshape.area
     issmall[j] = False
-    L[L==j+1] = i+1
+    (rj,cj) = ccstats.get(L,len(ellipses)).pixels(j+1)
+    L[rj,cj] = i+1
+    ccstats.invalidate(L)
 
-def trymerge(ellipses,issmall,i,L,dfore):
+def trymerge(ellipses,issmall,i,L,dfore,index=None):
     # find connected components whose centers are at most maxdmergecenter
     # from the target
     #print 'trymerge: issmall = ' + str(issmall) + 'i = ' + str(i)
-    closeinds = findclosecenters(ellipses,i)
+    closeinds = findclosecenters(ellipses,i,index)
     
     # if there are no close centers, just return
     if len(closeinds) == 0:
@@ -400,12 +443,7 @@ def trymerge(ellipses,issmall,i,L,dfore):
     #    print 'ellipses[%d] = '%jtmp + str(ellipses[jtmp])
 
     # compute the penalty for each close center
-    mergepenalty = num.ones(len(closeinds))
-    mergepenalty[:] = params.maxpenaltymerge+1
-    ellipsesmerge = []
-    for j in range(len(closeinds)):
-        (mergepenalty[j],newellipse) = computemergepenalty(ellipses,i,closeinds[j],L,dfore)
-        ellipsesmerge.append(newellipse)
+    (mergepenalty,ellipsesmerge) = mergepenalties(ellipses,i,closeinds,L,dfore)
 
     #for jtmp in range(len(closeinds)):
     #    print 'mergepenalty for ellipse[%d] = '%closeinds[jtmp] + str(mergepenalty[jtmp])
@@ -423,6 +461,8 @@ def trymerge(ellipses,issmall,i,L,dfore):
     canmergewith = closeinds[bestjmerge]
     #print 'merging with ellipse[%d] = '%closeinds[bestjmerge] + str(ellipses[closeinds[bestjmerge]])
     mergeellipses(ellipses,i,canmergewith,ellipsesmerge[bestjmerge],issmall,L)
+    if index is not None:
+        index.move(i)
 
     # update diagnostics
     diagnosticsAdd('nsmall_merged')
@@ -442,18 +482,22 @@ def trydelete(ellipses,i,issmall):
     return False
 
 def deleteellipses(ellipses,L,doerase=True):
-    i = 0
-    while True:
-        if i >= len(ellipses):
-            break
-        if ellipses[i].area == 0:
-            ellipses.pop(i)
-            # fix the connected components labels
-            if doerase:
-                L[L==i+1] = 0
-                L[L>i+1] = L[L>i+1]-1
-        else:
-            i+=1
+    isdeleted = num.array([ellipse.area == 0 for ellipse in ellipses],dtype=bool)
+    if not isdeleted.any():
+        return
+    if doerase:
+        # fix the connected components labels: erase deleted components,
+        # and number the others (and any labels above them) consecutively
+        stats = ccstats.get(L,len(ellipses))
+        nlabels = max(len(ellipses),int(stats.labels.max()) if stats.labels.size else 0)
+        isdeletedlabel = num.zeros(nlabels+1,dtype=bool)
+        isdeletedlabel[1:len(ellipses)+1] = isdeleted
+        newlabel = num.arange(nlabels+1) - num.cumsum(isdeletedlabel)
+        newlabel[isdeletedlabel] = 0
+        L[stats.r,stats.c] = newlabel[stats.labels]
+        ccstats.invalidate(L)
+    for i in num.flatnonzero(isdeleted)[::-1]:
+        ellipses.pop(i)
 
 def printellipse(ellipse):
     print '[x: %f y: %f a: %f b: %f t: %f A: %f]' % (ellipse.center.x,ellipse.center.y,ellipse.major,ellipse.minor,ellipse.angle,ellipse.area)
@@ -463,6 +507,13 @@ def fixsmall(ellipses,L,dfore):
 
     for i in range(len(ellipses)):
         issmall[i] = ellipses[i].area < params.minshape.area
+
+    # grid over the ellipse centers, with cells the size of the largest
+    # distance at which a small ellipse can be merged
+    if num.any(issmall):
+        index = CenterIndex(ellipses,max([maxdmergecenter(ellipses[i])
+                                          for i in num.flatnonzero(issmall)]))
+
     while num.any(issmall):
         i = num.where(issmall)[0]
         i = i[0]
@@ -473,6 +524,7 @@ def fixsmall(ellipses,L,dfore):
 
         if issmall[i] == False:
             ellipses[i] = ellipselowerthresh
+            index.move(i)
             #print "Succeeded by lowering threshold:"
             #printellipse(ellipses[i])
         #print 'in fixsmall, after trylowerthresh, ellipses = '
@@ -482,7 +534,7 @@ def fixsmall(ellipses,L,dfore):
             
         if issmall[i]:
             #print "Could not lower threshold. Trying to merge"
-            didmerge = trymerge(ellipses,issmall,i,L,dfore)
+            didmerge = trymerge(ellipses,issmall,i,L,dfore,index)
             #print "After attempting to merge, ellipse is now:"
             #printellipse(ellipses[i])
             #print "didmerge = "
@@ -496,6 +548,7 @@ def fixsmall(ellipses,L,dfore):
             #print "Could not merge. Trying to delete."
             # set ellipses[i] to be ellipselowerthresh
             ellipses[i] = ellipselowerthresh.copy()
+            index.move(i)
             #copyellipse(ellipses,i,ellipselowerthresh)
             diddelete = trydelete(ellipses,i,issmall)
             if not diddelete:
@@ -513,20 +566,61 @@ def fixsmall(ellipses,L,dfore):
     #    print 'ellipse[%d] = '%jtmp + str(ellipses[jtmp])
 
 
-def trysplit(ellipses,i,isdone,L,dfore):
-
-    if DEBUG: print 'trying to split target i=%d: '%i
-    if DEBUG: print str(ellipses[i])
-
-    # get datapoints in this connected component
-    (r,c) = num.where(L==i+1)
-    if DEBUG: print "number of pixels in this component = %d"%len(r)
+# 4-connectivity within each slice of a stack of images, none between slices
+SLICECONNECTIVITY = num.zeros((3,3,3),dtype=bool)
+SLICECONNECTIVITY[1] = meas.generate_binary_structure(2,1)
+
+def split_threshold(dforebox,isforebox,thresholds,minarea=3):
+    """Return the first of thresholds at which the pixels of isforebox with
+    dforebox >= threshold form at least two 4-connected components of at
+    least minarea pixels, the label image of those components, with
+    smaller ones set to background, and their number. Returns
+    (None,None,0) if there is no such threshold.
+
+    The pixels above each threshold are stacked and the stack is labeled
+    in one call, without connections between thresholds, instead of
+    labeling the box once per threshold."""
+
+    thresholds = num.asarray(thresholds)
+    nthresh = len(thresholds)
+    isabove = isforebox & (dforebox >= thresholds.reshape(nthresh,1,1))
+    (Lstack,ncomponents) = meas.label(isabove,SLICECONNECTIVITY)
+    if ncomponents < 2:
+        return (None,None,0)
+
+    # threshold index of each component, and the number of components of
+    # at least minarea pixels at each threshold
+    level = num.zeros(ncomponents+1,dtype=int)
+    level[Lstack.reshape(nthresh,-1)] = num.arange(nthresh).reshape(nthresh,1)
+    keep = num.bincount(Lstack.ravel(),minlength=ncomponents+1) >= minarea
+    keep[0] = False
+    nkeep = num.bincount(level[keep],minlength=nthresh)
+    if DEBUG:
+        for (currthresh,n) in zip(thresholds,nkeep):
+            print 'for thresh = %.2f, ncomponents = %d'%(currthresh,n)
+    split = num.flatnonzero(nkeep >= 2)
+    if split.size == 0:
+        return (None,None,0)
+    k = split[0]
+
+    # set tiny areas split off to background, renumber the rest
+    keep &= level == k
+    newlabel = num.cumsum(keep).astype(Lstack.dtype)
+    newlabel[keep == False] = 0
+    return (thresholds[k],newlabel[Lstack[k]],int(nkeep[k]))
+
+def componentdata(L,ncc,i,dfore):
+    """Return rows r and columns c of the pixels of component i+1 of L,
+    as datapoints x for clustering with weights w."""
+    (r,c) = ccstats.get(L,ncc).pixels(i+1)
     x = num.hstack((c.reshape(c.size,1),r.reshape(r.size,1))).astype(kcluster.DTYPE)
-    # weights of datapoints
-    w = dfore[L==i+1].astype(kcluster.DTYPE)
-    ndata = r.size
+    w = dfore[r,c].astype(kcluster.DTYPE)
+    return (r,c,x,w)
 
-    ## try increasing threshold
+def thresholdsplitinit(r,c,i,L,dfore):
+    """Return GMM initialization (mu,S,priors) from the components that
+    component i+1 of L, with pixels r,c, splits into when raising the
+    threshold, or None if it does not split."""
 
     # get a bounding box around L == i+1
     c1 = num.min(c);
@@ -534,7 +628,6 @@ def trysplit(ellipses,i,isdone,L,dfore):
     r1 = num.min(r);
     r2 = num.max(r);
     dforebox = dfore[r1:r2+1,c1:c2+1].copy()
-    dforebox0 = dforebox.copy()
     if DEBUG: print 'range r = [%d, %d], range c = [%d, %d]'%(r1,r2,c1,c2)
 
     # only look at cc i+1
@@ -542,104 +635,177 @@ def trysplit(ellipses,i,isdone,L,dfore):
     isforebox0 = Lbox == i+1
     dforebox[Lbox!=i+1] = 0
 
-    # loop over increasing thresholds -- hard-coded to 20 iterations
-    for currthresh in num.linspace(params.n_bg_std_thresh_low,
-                                   min(params.n_bg_std_thresh,
-                                       num.max(dforebox)),20):
+    # lowest of increasing thresholds -- hard-coded to 20 -- at which the
+    # component splits into more than one component of area >= 3
+    (currthresh,Lbox,ncomponents) = \
+        split_threshold(dforebox,isforebox0,
+                        num.linspace(params.n_bg_std_thresh_low,
+                                     min(params.n_bg_std_thresh,
+                                         num.max(dforebox)),20))
+    if currthresh is None:
+        return None
+    if DEBUG: print 'found %d components at thresh %f'%(ncomponents,currthresh)
+
+    if DEBUG:
+        for j in range(ncomponents):
+            print "pixels belonging to component %d:"%j
+            [rtmp,ctmp] = num.where(Lbox==j+1)
+            rtmp = rtmp + r1
+            ctmp = ctmp + c1
+
+    # get ellipses for each connected component created by raising threshold
+    boxstats = ccstats.ComponentStats(Lbox,ncomponents)
+    (Z,centerX,centerY,S00,S11,S01) = boxstats.moments(dforebox)
+    mu = num.zeros([ncomponents,2],dtype=gmmbatch.DTYPE)
+    S = num.zeros([2,2,ncomponents],dtype=gmmbatch.DTYPE)
+    mu[:,0] = centerX + c1
+    mu[:,1] = centerY + r1
+    S[0,0,:] = S00
+    S[1,1,:] = S11
+    S[0,1,:] = S01
+    S[1,0,:] = S01
+    # fix small variances
+    gmmbatch.fixcov(S,.01)
+    priors = boxstats.area.astype(gmmbatch.DTYPE)
+    if DEBUG:
+        for j in range(ncomponents):
+            print 'fit ellipse to component %d: mu = '%j + str(mu[j,:]) + ', S = ' + str(S[:,:,j]) + ', unnormalized prior = ' + str(priors[j])
+    priors = priors / num.sum(priors)
 
-        # try raising threshold to currthresh
-        isforebox = dforebox >= currthresh
+    return (mu,S,priors)
 
-        # compute connected components
-        (Lbox,ncomponents) = meas.label(isforebox)
+def fitthresholdsplits(splits):
+    """For each of splits (x,w,mu,S,priors), label the datapoints x with
+    the GMM initialized from raising the threshold, recompute the GMM
+    from these labels and relabel. All splits are fit in one batch.
+    Returns (mu,S,priors,gamma) for each split."""
 
-        if DEBUG: print 'for thresh = %.2f, ncomponents = %d'%(currthresh,ncomponents)
+    if len(splits) == 0:
+        return []
 
-        # if no new components, increase threshold
-        if ncomponents == 1:
+    (X,W,n) = gmmbatch.pad([split[0] for split in splits],
+                           [split[1] for split in splits])
+    # pad to the largest number of components with zero-prior components
+    k = [len(split[4]) for split in splits]
+    mu = num.zeros((len(splits),max(k),2),dtype=gmmbatch.DTYPE)
+    S = num.zeros((len(splits),2,2,max(k)),dtype=gmmbatch.DTYPE)
+    S[:,0,0,:] = 1
+    S[:,1,1,:] = 1
+    priors = num.zeros((len(splits),max(k)),dtype=gmmbatch.DTYPE)
+    for (b,split) in enumerate(splits):
+        mu[b,:k[b]] = split[2]
+        S[b,:,:,:k[b]] = split[3]
+        priors[b,:k[b]] = split[4]
+
+    # label all points in the original connected components
+    (gamma,e) = gmmbatch.memberships(mu,S,priors,X,W)
+
+    # recompute ellipses based on these labels
+    gmmbatch.update(mu,S,gamma,X,W)
+
+    # relabel
+    (gamma,e) = gmmbatch.memberships(mu,S,priors,X,W)
+
+    return [(mu[b,:k[b]],S[b,:,:,:k[b]],priors[b,:k[b]],gamma[b,:n[b],:k[b]])
+            for b in range(len(splits))]
+
+def warmstartsplits(ellipses,isdone,L,dfore,splitpred):
+    """Fit GMMs, in one batch, to the large ellipses whose connected
+    components contain the predicted centers splitpred of at least two
+    flies that were split from a component in the previous frame,
+    initialized at these predictions. Returns a dict from ellipse index
+    to fit (mu,S,priors,gamma), for the fits whose components are all at
+    least minshape.area and which explain the pixels better than the
+    single ellipse does."""
+
+    # large ellipses whose component contains each predicted center
+    preds = {}
+    for pred in splitpred:
+        x = int(round(pred.center.x))
+        y = int(round(pred.center.y))
+        if x < 0 or y < 0 or y >= L.shape[0] or x >= L.shape[1]:
             continue
+        i = int(L[y,x]) - 1
+        if i >= 0 and not isdone[i] and ellipses[i].area <= params.minareaignore:
+            preds.setdefault(i,[]).append(pred)
+    inds = [i for i in sorted(preds.keys()) if len(preds[i]) > 1]
+    if len(inds) == 0:
+        return {}
+
+    # initialize at the predictions
+    data = [componentdata(L,len(ellipses),i,dfore) for i in inds]
+    (X,W,n) = gmmbatch.pad([d[2] for d in data],[d[3] for d in data])
+    k = [len(preds[i]) for i in inds]
+    mu = num.zeros((len(inds),max(k),2),dtype=gmmbatch.DTYPE)
+    S = num.zeros((len(inds),2,2,max(k)),dtype=gmmbatch.DTYPE)
+    S[:,0,0,:] = 1
+    S[:,1,1,:] = 1
+    priors = num.zeros((len(inds),max(k)),dtype=gmmbatch.DTYPE)
+    for (b,i) in enumerate(inds):
+        pred = preds[i]
+        mu[b,:k[b],0] = [e.center.x for e in pred]
+        mu[b,:k[b],1] = [e.center.y for e in pred]
+        (S[b,0,0,:k[b]],S[b,1,1,:k[b]],S[b,0,1,:k[b]]) = \
+            gmmbatch.ell2cov(num.array([e.major for e in pred]),
+                             num.array([e.minor for e in pred]),
+                             num.array([e.angle for e in pred]))
+        S[b,1,0,:k[b]] = S[b,0,1,:k[b]]
+        priors[b,:k[b]] = [e.area for e in pred]
+        priors[b] /= max(num.sum(priors[b]),1e-9)
+
+    (mu,S,priors,gamma,negloglik) = gmmbatch.gmmem(X,W,mu,S,priors,thresh=.1,mincov=.25)
+    (major,minor,angle) = gmmbatch.cov2ell(S[:,0,0,:],S[:,1,1,:],S[:,0,1,:])
+
+    fits = {}
+    for (b,i) in enumerate(inds):
+        # negative log likelihood per unit weight of the pixels under the
+        # single ellipse fit to them
+        e = ellipses[i]
+        negloglik1 = gmmbatch.LOG2PI + num.log(max(e.major*e.minor,1e-9)) + 1.
+        area = major[b,:k[b]]*minor[b,:k[b]]*num.pi*4.0
+        if negloglik[b] / max(num.sum(W[b]),1e-9) < negloglik1 and \
+               num.all(area >= params.minshape.area):
+            if DEBUG: print 'warm start split of ellipse %d into %d components'%(i,k[b])
+            fits[i] = (mu[b,:k[b]],S[b,:,:,:k[b]],priors[b,:k[b]],gamma[b,:n[b],:k[b]])
+        elif DEBUG: print 'warm start split of ellipse %d failed, areas = '%i + str(area)
+
+    return fits
+
+def trysplit(ellipses,i,isdone,L,dfore,fits=None):
 
-        # check if we just split off a tiny area. if so, just set that area to be background in Lbox
-        removed = []
-        for j in range(ncomponents):
-            areaj = num.sum(Lbox==j+1)
-            if areaj < 3:
-                Lbox[Lbox==j+1] = 0
-                removed += j,
-        if DEBUG: print 'removed = ' + str(removed)
+    if DEBUG: print 'trying to split target i=%d: '%i
+    if DEBUG: print str(ellipses[i])
 
-        # renumber connected components to account for removed components
-        for j in range(ncomponents):
-            if num.any(num.array(removed)==j):
-                continue
-            nsmaller = num.sum(num.array(removed)<j)
-            Lbox[Lbox==j+1] = j+1-nsmaller
-        ncomponents -= len(removed)
+    # get datapoints in this connected component
+    (r,c,x,w) = componentdata(L,len(ellipses),i,dfore)
+    if DEBUG: print "number of pixels in this component = %d"%len(r)
+    ndata = r.size
 
-        if DEBUG: print 'after removing small components, ncomponents = ' + str(ncomponents)
+    ## try increasing threshold
 
-        # if we've created a new connected component
-        if ncomponents > 1:
-            if DEBUG: print 'found %d components at thresh %f'%(ncomponents,currthresh)
-            break
-    # end loop trying to increase threshold
+    # fits, for initial components of fixlarge, were computed in a batch
+    # (warm started from the previous frame or by raising the threshold)
+    if fits is not None and i in fits:
+        fit = fits.pop(i)
+    else:
+        init = thresholdsplitinit(r,c,i,L,dfore)
+        fit = None
+        if init is not None:
+            fit = fitthresholdsplits([(x,w) + init])[0]
 
-    if ncomponents > 1:
+    ncomponents = 0
+    if fit is not None:
+        ncomponents = len(fit[2])
 
-        if DEBUG:
-            for j in range(ncomponents):
-                print "pixels belonging to component %d:"%j
-                [rtmp,ctmp] = num.where(Lbox==j+1)
-                rtmp = rtmp + r1
-                ctmp = ctmp + c1
+    if ncomponents > 1:
 
         # succeeded in splitting into multiple connected components 
         # by raising the threshold, use this as initialization for GMM
-
-        # get ellipses for each connected component created by raising threshold
-        mu = num.zeros([ncomponents,2],dtype=kcluster.DTYPE)
-        S = num.zeros([2,2,ncomponents],dtype=kcluster.DTYPE)
-        priors = num.zeros(ncomponents,dtype=kcluster.DTYPE)
-        for j in range(ncomponents):
-            BWI = Lbox == (j+1)
-            wj = dforebox[BWI]
-            # normalize weights
-            Z = sum(wj)
-            if Z == 0:
-                Z = 1
-            # compute mean
-            (rj,cj) = num.where(BWI)
-            centerX = sum(cj*wj)/Z
-            centerY = sum(rj*wj)/Z
-            mu[j,0] = centerX + c1
-            mu[j,1] = centerY + r1
-            # compute variance
-            S[0,0,j] = sum(wj*cj**2)/Z - centerX**2
-            S[1,1,j] = sum(wj*rj**2)/Z - centerY**2
-            S[0,1,j] = sum(wj*cj*rj)/Z - centerX*centerY
-            S[1,0,j] = S[0,1,j]
-            # fix small variances
-            [D,V] = num.linalg.eig(S[:,:,j])
-            if num.any(D<.01):
-                D[D<.01] = .01
-                S[:,:,j] = num.dot(V, num.dot(num.diag(D), V.T ))
-
-            priors[j] = rj.size
-            if DEBUG: print 'fit ellipse to component %d: mu = '%j + str(mu[j,:]) + ', S = ' + str(S[:,:,j]) + ', unnormalized prior = ' + str(priors[j])
-        priors = priors / num.sum(priors)
-
-        # label all points in the original connected component
-        (gamma,e) = kcluster.gmmmemberships(mu,S,priors,x,w)
-
-        # recompute ellipses based on these labels
-        kcluster.gmmupdate(mu,S,priors,gamma,x,w)
+        (mu,S,priors,gamma) = fit
 
         # compute areas
-        (gamma,e) = kcluster.gmmmemberships(mu,S,priors,x,w)
         idx = num.argmax(gamma,axis=1)
-        area = num.zeros(ncomponents)
-        for j in range(ncomponents):
-            area[j] = len(num.flatnonzero(idx==j))
+        area = num.bincount(idx,minlength=ncomponents).astype(float)
 
         #for j in range(ncomponents):
         #    (major,minor,angle) = cov2ell(S[:,:,j])
@@ -665,7 +831,9 @@ def trysplit(ellipses,i,isdone,L,dfore):
 
             if DEBUG: print "recomputing memberships in case we deleted any components"
             # recompute memberships
-            (gamma,e) = kcluster.gmmmemberships(mu,S,priors,x,w)
+            (gamma,e) = gmmbatch.memberships(mu[num.newaxis],S[num.newaxis],priors[num.newaxis],
+                                             x[num.newaxis],w[num.newaxis])
+            gamma = gamma[0]
             
             # store 
             mu0 = mu
@@ -792,6 +960,7 @@ def trysplit(ellipses,i,isdone,L,dfore):
             ellipses.append(ellipse)
             isdone = num.append(isdone,ellipse.area <= params.maxshape.area)
             L[r[idx==j],c[idx==j]] = len(ellipses)
+            ccstats.invalidate(L)
             if DEBUG: print "adding ellipse %d = "%(len(ellipses)-1) + str(ellipse) + " with isdone[%d] = %d"%(len(ellipses)-1,isdone[-1])
             if DEBUG: print "reset L to %d for %d pixels"%(len(ellipses),len(num.flatnonzero(idx==j)))
             if len(num.flatnonzero(idx==j)) < 1:
@@ -818,7 +987,7 @@ def trysplit(ellipses,i,isdone,L,dfore):
                 print 'ellipses[%d] = '%(len(ellipses)-j) + str(ellipses[-j])
         return isdone
 
-def fixlarge(ellipses,L,dfore):
+def fixlarge(ellipses,L,dfore,splitpred=None):
 
     if DEBUG: print "fixlarge"
 
@@ -828,13 +997,35 @@ def fixlarge(ellipses,L,dfore):
     for i in range(len(ellipses)):
         isdone[i] = ellipses[i].area <= params.maxshape.area
 
+    # start splitting components that were split in the previous frame
+    # from the predicted positions of these flies
+    fits = {}
+    if splitpred:
+        fits = warmstartsplits(ellipses,isdone,L,dfore,splitpred)
+
+    # fit the GMMs initialized by raising the threshold for all other large
+    # ellipses at once; splitting an ellipse only relabels its own pixels
+    splitinds = []
+    splits = []
+    for i in num.flatnonzero(isdone==False):
+        if ellipses[i].area > params.minareaignore or int(i) in fits:
+            continue
+        (r,c,x,w) = componentdata(L,len(ellipses),i,dfore)
+        init = thresholdsplitinit(r,c,i,L,dfore)
+        if init is None:
+            fits[int(i)] = None
+        else:
+            splitinds.append(int(i))
+            splits.append((x,w) + init)
+    fits.update(zip(splitinds,fitthresholdsplits(splits)))
+
     while True:
         # find an ellipse that is not done
         i = num.where(isdone==False)[0]
         # if there aren't any, break
         if i.size == 0:
             break
-        i = i[0]
+        i = int(i[0])
         
         # ignore really large detections
         if ellipses[i].area > params.minareaignore:
@@ -844,7 +1035,7 @@ def fixlarge(ellipses,L,dfore):
             diagnosticsAdd('nlarge_ignored')
         else:
             if DEBUG: print 'trying to split ellipse: ' + str(ellipses[i])
-            isdone = trysplit(ellipses,i,isdone,L,dfore)
+            isdone = trysplit(ellipses,i,isdone,L,dfore,fits)
     deleteellipses(ellipses,L)
 
 def trymergedisplay(ellipses,issmall,i,L,dfore):
@@ -863,12 +1054,7 @@ def trymergedisplay(ellipses,issmall,i,L,dfore):
     #    print 'ellipses[%d] = '%jtmp + str(ellipses[jtmp])
 
     # compute the penalty for each close center
-    mergepenalty = num.ones(len(closeinds))
-    mergepenalty[:] = params.maxpenaltymerge+1
-    ellipsesmerge = []
-    for j in range(len(closeinds)):
-        (mergepenalty[j],newellipse) = computemergepenalty(ellipses,i,closeinds[j],L,dfore)
-        ellipsesmerge.append(newellipse)
+    (mergepenalty,ellipsesmerge) = mergepenalties(ellipses,i,closeinds,L,dfore)
 
     #for jtmp in range(len(closeinds)):
     #    print 'mergepenalty for ellipse[%d] = '%closeinds[jtmp] + str(mergepenalty[jtmp])
@@ -0,0 +1,186 @@
+# gmmbatch.py
+# EM for weighted 2-D Gaussian mixtures of many point sets at once: the
+# point sets are padded to a common length with zero-weight points, the
+# mixtures to a common number of components with zero-prior components,
+# and all mixtures are updated together with array operations.
+#
+# Each point set gets the same estimate as kcluster2d.gmmmemberships,
+# gmmupdate and gmmem give it on its own:
+#   - probabilities are not normalized in the log domain; a point with
+#     zero probability under all components has no memberships and adds
+#     -log(1e-15) to the negative log likelihood
+#   - a covariance matrix that is not positive definite is reset to the
+#     initial one (or, without one, given determinant 1e-10)
+#   - in the update, means and covariances are divided by at least 1e-6,
+#     and a covariance matrix with an eigenvalue below mincov (or nan)
+#     is reset to the initial one; without initial covariance matrices
+#     nothing is reset
+#   - the priors are not updated (kcluster2d.gmmupdate computes them but
+#     does not store them)
+#   - gmmem raises eigenvalues of the initial covariance matrices to
+#     mincov, and stops after niters iterations or after the update
+#     following the first iteration whose negative log likelihood did not
+#     decrease by more than thresh, separately for each point set
+# kcluster2d.gmmupdate also moves components with small priors to the
+# least likely point, but the update of all components that follows
+# overwrites them, so that is not done here.
+
+import numpy as num
+
+DTYPE = num.float64
+LOG2PI = num.log(2.*num.pi)
+
+# array layout, for B point sets of at most N points and k components:
+#   X: B x N x 2 point coordinates (x,y)
+#   W: B x N point weights, 0 for padding
+#   mu: B x k x 2 means
+#   S: B x 2 x 2 x k covariance matrices
+#   priors: B x k mixture weights, 0 for padding
+#   gamma: B x N x k memberships
+
+
+def ell2cov(major,minor,angle):
+    """Return entries S00, S11, S01 of the covariance matrices of ellipses
+    with the given axis lengths and angles (arrays)."""
+    cos = num.cos(angle)
+    sin = num.sin(angle)
+    a = major**2
+    b = minor**2
+    return (cos**2*a + sin**2*b, sin**2*a + cos**2*b, sin*cos*(a-b))
+
+
+def cov2ell(S00,S11,S01):
+    """Return axis lengths major, minor and angle of the ellipses with
+    covariance matrices [[S00,S01],[S01,S11]] (arrays)."""
+    tmp1 = S00 + S11
+    tmp2 = num.sqrt(num.maximum(0,4.0*S01**2 + (S00 - S11)**2))
+    # only less than 0 because of numerical errors
+    eigA = num.maximum(0,(tmp1+tmp2)/2.0)
+    eigB = num.maximum(0,(tmp1-tmp2)/2.0)
+    angle = 0.5*num.arctan2(2.0*S01,S00 - S11)
+    return (num.sqrt(eigA),num.sqrt(eigB),angle)
+
+
+def fixcov(S,mincov):
+    """Raise eigenvalues of covariance matrices S (... x 2 x 2 x k) that
+    are smaller than mincov to mincov, in place; matrices with nans
+    become mincov times the identity."""
+    isnan = num.isnan(S).any(axis=-3).any(axis=-2)
+    if isnan.any():
+        S[...,0,0,:][isnan] = mincov
+        S[...,1,1,:][isnan] = mincov
+        S[...,0,1,:][isnan] = 0
+        S[...,1,0,:][isnan] = 0
+    (major,minor,angle) = cov2ell(S[...,0,0,:],S[...,1,1,:],S[...,0,1,:])
+    fix = minor**2 < mincov
+    if not fix.any():
+        return
+    (S00,S11,S01) = ell2cov(num.sqrt(num.maximum(major[fix]**2,mincov)),
+                            num.sqrt(mincov),angle[fix])
+    S[...,0,0,:][fix] = S00
+    S[...,1,1,:][fix] = S11
+    S[...,0,1,:][fix] = S01
+    S[...,1,0,:][fix] = S01
+
+
+def resetcov(S,initcovars,reset):
+    """Set the covariance matrices S[b,:,:,j] with reset[b,j] to
+    initcovars[b,:,:,j], in place."""
+    S.transpose(0,3,1,2)[reset] = initcovars.transpose(0,3,1,2)[reset]
+
+
+def pad(xs,ws):
+    """Return the point sets xs (n x 2) with weights ws (n) as padded
+    arrays X and W, and the number of points in each set."""
+    n = [len(w) for w in ws]
+    X = num.zeros((len(xs),max(n+[1]),2),dtype=DTYPE)
+    W = num.zeros((len(xs),max(n+[1])),dtype=DTYPE)
+    for b in range(len(xs)):
+        X[b,:n[b]] = xs[b]
+        W[b,:n[b]] = ws[b]
+    return (X,W,n)
+
+
+def memberships(mu,S,priors,X,W,initcovars=None):
+    """Return memberships gamma of the points in the mixture components,
+    and the weighted negative log likelihood of each point set.
+    Covariance matrices S that are not positive definite are reset to
+    initcovars in place."""
+    det = S[:,0,0,:]*S[:,1,1,:] - S[:,0,1,:]**2
+    if initcovars is not None and (det <= 0).any():
+        resetcov(S,initcovars,det <= 0)
+        det = S[:,0,0,:]*S[:,1,1,:] - S[:,0,1,:]**2
+    det[det <= 0] = 1e-10
+
+    S00 = S[:,0,0,num.newaxis,:]
+    S11 = S[:,1,1,num.newaxis,:]
+    S01 = S[:,0,1,num.newaxis,:]
+    dx = X[:,:,0,num.newaxis] - mu[:,num.newaxis,:,0]
+    dy = X[:,:,1,num.newaxis] - mu[:,num.newaxis,:,1]
+    d = (S11*dx**2 - 2.*S01*dx*dy + S00*dy**2)/det[:,num.newaxis,:]
+    p = num.exp(-.5*d)/(2.*num.pi*num.sqrt(det))[:,num.newaxis,:]
+    p *= priors[:,num.newaxis,:]
+
+    z = num.sum(p,axis=2)
+    negloglik = -num.sum(W*num.log(num.where(z <= 0,1e-15,z)),axis=1)
+    z[z == 0] = 1
+    gamma = p / z[:,:,num.newaxis]
+    return (gamma,negloglik)
+
+
+def update(mu,S,gamma,X,W,mincov=.01,initcovars=None):
+    """Set mu and S in place to the weighted maximum likelihood estimates
+    given memberships gamma. Covariance matrices with an eigenvalue
+    smaller than mincov are reset to initcovars, if given."""
+    wg = gamma*W[:,:,num.newaxis]
+    Z = num.maximum(num.sum(wg,axis=1),1e-6)
+
+    x = X[:,:,0,num.newaxis]
+    y = X[:,:,1,num.newaxis]
+    mu[:,:,0] = num.sum(wg*x,axis=1)/Z
+    mu[:,:,1] = num.sum(wg*y,axis=1)/Z
+    dx = x - mu[:,num.newaxis,:,0]
+    dy = y - mu[:,num.newaxis,:,1]
+    S[:,0,0,:] = num.sum(wg*dx**2,axis=1)/Z
+    S[:,1,1,:] = num.sum(wg*dy**2,axis=1)/Z
+    S[:,0,1,:] = num.sum(wg*dx*dy,axis=1)/Z
+    S[:,1,0,:] = S[:,0,1,:]
+
+    if mincov > 0 and initcovars is not None:
+        tr2 = (S[:,0,0,:] + S[:,1,1,:])/2.
+        det = S[:,0,0,:]*S[:,1,1,:] - S[:,0,1,:]**2
+        olderr = num.seterr(invalid='ignore')
+        try:
+            mineigval = tr2 - num.sqrt(tr2**2 - det)
+        finally:
+            num.seterr(**olderr)
+        resetcov(S,initcovars,num.isnan(mineigval) | (mineigval < mincov))
+
+
+def gmmem(X,W,mu0,S0,priors0,niters=100,thresh=.001,mincov=.01):
+    """Run EM from the mixtures mu0, S0, priors0 until, for each point
+    set, the negative log likelihood does not decrease by more than
+    thresh. Point sets that have converged are not updated any more.
+    Returns (mu,S,priors,gamma,negloglik)."""
+    mu = mu0.copy()
+    S = S0.copy()
+    priors = priors0.copy()
+    if mincov > 0:
+        fixcov(S,mincov)
+    initcovars = S.copy()
+
+    negloglik = num.inf + num.zeros(len(X))
+    active = num.ones(len(X),dtype=bool)
+    for iter in range(niters):
+        b = num.flatnonzero(active)
+        if b.size == 0:
+            break
+        (mub,Sb,initcovarsb) = (mu[b],S[b],initcovars[b])
+        (gammab,negloglikb) = memberships(mub,Sb,priors[b],X[b],W[b],initcovarsb)
+        update(mub,Sb,gammab,X[b],W[b],mincov,initcovarsb)
+        (mu[b],S[b]) = (mub,Sb)
+        active[b] = (negloglikb >= negloglik[b] - thresh) == False
+        negloglik[b] = negloglikb
+
+    (gamma,negloglik) = memberships(mu,S,priors,X,W,initcovars)
+    return (mu,S,priors,gamma,negloglik)
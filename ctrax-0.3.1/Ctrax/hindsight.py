@@ -8,7 +8,7 @@ import numpy as num
 from params import params, diagnostics, diagnosticsAdd
 import ellipsesk as ell
 import estconncomps as est
-import kcluster2d as kcluster
+import gmmbatch
 import matchidentities
 
 DEBUG_LEVEL = 0 # 0 == none, 1 == important, 2 == verbose
@@ -968,13 +968,12 @@ class Hindsight:
         for pair in possible:
             possibleid2s.add(pair[0])
 
-        clusterings = {}
+        # split all possible id2s at once
+        id2s = list(possibleid2s)
+        clusterings = splitobservations([(cc==(id2+1),dfore,[pred3,pred2[id2]])
+                                         for id2 in id2s],2)
 
-        for id2 in possibleid2s:
-            pred = [pred3,pred2[id2]]
-            clusterings[id2] = splitobservation(cc==(id2+1),dfore,2,pred)
-
-        return clusterings
+        return dict(zip(id2s,clusterings))
 
 
     def compute_cost_and_assignment(self,clusterings,prev,curr,next,
@@ -1066,18 +1065,21 @@ class Hindsight:
 
     def cluster_id2_t1(self,possible,pred2,pred1):
 
-        clusterings_t1 = {}
+        # split all (t1,id2) at once
+        keys = []
+        observations = []
         for pair in possible:
             id2 = pair[0]
             id1 = pair[1]
             t1 = self.milestones.getdeathframe(id1)
             if DEBUG_LEVEL > 1: print 'clustering id2=%d, id1=%d in t1=%d'%(id2,id1,t1)
-            if not clusterings_t1.has_key((t1,id2)):
+            if (t1,id2) not in keys:
                 (cc,dfore) = self.cc(t1)
                 pred = [pred2[id2],pred1[id1]]
-                clusterings_t1[(t1,id2)] = splitobservation(cc==(id2+1),dfore,2,pred)
+                keys.append((t1,id2))
+                observations.append((cc==(id2+1),dfore,pred))
 
-        return clusterings_t1
+        return dict(zip(keys,splitobservations(observations,2)))
 
 
     def compute_cost_and_assignment_t1(self,clusterings_t1,possible,
@@ -1123,52 +1125,72 @@ class Hindsight:
 
 def splitobservation(bw,dfore,k,init):
 
-    (r,c) = num.where(bw)
-
-    if DEBUG_LEVEL > 1: print 'number of pixels in component being split: %d'%len(r)
-    x = num.hstack((c.reshape(c.size,1),r.reshape(r.size,1))).astype(kcluster.DTYPE)
-    w = dfore[bw].astype(kcluster.DTYPE)
-    if DEBUG_LEVEL > 1: print 'data being clustered: '
-    if DEBUG_LEVEL > 1: print x
-    if DEBUG_LEVEL > 1: print 'with weights: '
-    if DEBUG_LEVEL > 1: print w
+    return splitobservations([(bw,dfore,init)],k)[0]
+
+
+def splitobservations(observations,k):
+    """Split each component bw of the observations (bw,dfore,init) into k
+    ellipses by fitting a Gaussian mixture to its pixels weighted by
+    dfore, initialized with the k ellipses init. The mixtures of all
+    observations are fit in one batch. Returns a list of k ellipses for
+    each observation, or None for components without pixels."""
+
+    xs = []
+    ws = []
+    inits = []
+    empty = []
+    for (bw,dfore,init) in observations:
+        (r,c) = num.where(bw)
+
+        if DEBUG_LEVEL > 1: print 'number of pixels in component being split: %d'%len(r)
+        # are there no data points?
+        empty.append(len(r) == 0)
+        if empty[-1]:
+            continue
+        xs.append(num.hstack((c.reshape(c.size,1),r.reshape(r.size,1))))
+        ws.append(dfore[bw])
+        inits.append(init)
+        if DEBUG_LEVEL > 1: print 'data being clustered: '
+        if DEBUG_LEVEL > 1: print xs[-1]
+        if DEBUG_LEVEL > 1: print 'with weights: '
+        if DEBUG_LEVEL > 1: print ws[-1]
+    if len(xs) == 0:
+        return [None for obs in observations]
 
     # create means and covariance matrices to initialize
-    mu0 = num.zeros((k,2),dtype=kcluster.DTYPE)
-    S0 = num.zeros((k,2,2),dtype=kcluster.DTYPE)
-    priors0 = num.zeros(k,dtype=kcluster.DTYPE)
-    for i in range(k):
-        if DEBUG_LEVEL > 1: print 'predicted ellipse %d: '%i + str(init[i])
-        mu0[i,0] = init[i].x
-        mu0[i,1] = init[i].y
-        S0[:,:,i] = est.ell2cov(init[i].major,init[i].minor,init[i].angle)
-        priors0[i] = init[i].area
-        (tmpmajor,tmpminor,tmpangle) = est.cov2ell(S0[:,:,i])
-    priors0 = priors0 / max( num.sum(priors0), 1e-9 )
+    (X,W,n) = gmmbatch.pad(xs,ws)
+    mu0 = num.array([[[e.x,e.y] for e in init] for init in inits],dtype=gmmbatch.DTYPE)
+    (major,minor,angle,area) = [num.array([[getattr(e,a) for e in init] for init in inits],dtype=gmmbatch.DTYPE)
+                                for a in ('major','minor','angle','area')]
+    S0 = num.zeros((len(inits),2,2,k),dtype=gmmbatch.DTYPE)
+    (S0[:,0,0,:],S0[:,1,1,:],S0[:,0,1,:]) = gmmbatch.ell2cov(major,minor,angle)
+    S0[:,1,0,:] = S0[:,0,1,:]
+    priors0 = area / num.maximum(num.sum(area,axis=1),1e-9)[:,num.newaxis]
     if DEBUG_LEVEL > 1: print 'initializing with '
     if DEBUG_LEVEL > 1: print 'mu0 = '
     if DEBUG_LEVEL > 1: print mu0
     if DEBUG_LEVEL > 1: print 'S0 = '
-    if DEBUG_LEVEL > 1:
-        for i in range(k):
-            print S0[:,:,i]
+    if DEBUG_LEVEL > 1: print S0
     if DEBUG_LEVEL > 1: print 'priors0 = '
     if DEBUG_LEVEL > 1: print priors0
- 
-   # are there no data points?
-    if len(r) == 0:
-        return None
-        
-    (mu,S,priors,gamma,negloglik) = kcluster.gmmem(x,mu0,S0,priors0,weights=w,thresh=.1,mincov=.015625)
-            
-    obs = []
-    for i in range(k):
-	(major,minor,angle) = est.cov2ell(S[:,:,i])
-        if DEBUG_LEVEL > 1 and mu[i,0] == 0 and mu[i,1] == 0: print "splitobservation returning a 0,0 ellipse"
-	obs.append(ell.Ellipse(mu[i,0],mu[i,1],minor,major,angle))
-	obs[-1].compute_area()
-
-    return obs
+
+    (mu,S,priors,gamma,negloglik) = gmmbatch.gmmem(X,W,mu0,S0,priors0,thresh=.1,mincov=.015625)
+    (major,minor,angle) = gmmbatch.cov2ell(S[:,0,0,:],S[:,1,1,:],S[:,0,1,:])
+
+    clusterings = []
+    b = 0
+    for isempty in empty:
+        if isempty:
+            clusterings.append(None)
+            continue
+        obs = []
+        for i in range(k):
+            if DEBUG_LEVEL > 1 and mu[b,i,0] == 0 and mu[b,i,1] == 0: print "splitobservation returning a 0,0 ellipse"
+            obs.append(ell.Ellipse(mu[b,i,0],mu[b,i,1],minor[b,i],major[b,i],angle[b,i]))
+            obs[-1].compute_area()
+        clusterings.append(obs)
+        b += 1
+    return clusterings
 
 
 def ellipseinterpolate(ell1,ell2,dt1,dt2):
@@ -0,0 +1,189 @@
+# moviecache.py
+# persistent per-movie metadata (frame index, frame rate, keyframes,
+# per-frame statistics) so that reopening a movie skips rediscovering it
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as num
+
+from params import params
+from version import DEBUG
+
+# increase when the stored metadata changes incompatibly
+CACHE_VERSION = 2
+CACHE_EXTENSION = '.ctraxcache'
+
+
+def cache_filename( moviepath ):
+    """Return name of the cache file for the given movie: next to the
+    movie, or in params.movie_metadata_dir if set."""
+    moviepath = os.path.abspath( moviepath )
+    if not params.movie_metadata_dir:
+        return moviepath + CACHE_EXTENSION
+    # the directory holds caches of movies from many directories
+    key = hashlib.md5( moviepath ).hexdigest()[:16]
+    return os.path.join( params.movie_metadata_dir,
+                         "%s_%s%s"%(os.path.basename( moviepath ),key,CACHE_EXTENSION) )
+
+
+def movie_signature( moviepath ):
+    st = os.stat( moviepath )
+    return [CACHE_VERSION, st.st_size, st.st_mtime]
+
+
+# The cache is an npz file: the nesting of dictionaries, lists and tuples
+# and the scalars are stored as JSON in its 'structure' member, each
+# array in a member of its own. Nothing in it is unpickled, so a cache
+# file cannot run code when it is read.
+
+def encode( value, arrays ):
+    """Return value as JSON-compatible object, appending its arrays to
+    arrays and referring to them by index."""
+    if isinstance( value, num.ndarray ):
+        if value.dtype.hasobject:
+            raise TypeError( "cannot cache object arrays" )
+        arrays.append( value )
+        return {'array': len( arrays ) - 1}
+    if isinstance( value, dict ):
+        return {'dict': [[encode( k, arrays ), encode( v, arrays )]
+                         for k, v in value.iteritems()]}
+    if isinstance( value, tuple ):
+        return {'tuple': [encode( v, arrays ) for v in value]}
+    if isinstance( value, list ):
+        return {'list': [encode( v, arrays ) for v in value]}
+    if isinstance( value, num.generic ):
+        return value.item()
+    if value is None or isinstance( value, (bool, int, long, float, basestring) ):
+        return value
+    raise TypeError( "cannot cache %s"%type( value ) )
+
+
+def decode( value, arrays ):
+    """Inverse of encode."""
+    if not isinstance( value, dict ):
+        return value
+    (kind, items), = value.items()
+    if kind == 'array':
+        return arrays['a%d'%items]
+    if kind == 'dict':
+        return dict( [(decode( k, arrays ), decode( v, arrays )) for k, v in items] )
+    if kind == 'tuple':
+        return tuple( [decode( v, arrays ) for v in items] )
+    if kind == 'list':
+        return [decode( v, arrays ) for v in items]
+    raise ValueError( "unknown cache entry " + kind )
+
+
+def load( moviepath ):
+    """Return the cached metadata dictionary for the movie, or an empty
+    one if there is none, it cannot be read, or the movie has changed
+    since it was stored."""
+    if not params.use_movie_metadata_cache:
+        return {}
+    filename = cache_filename( moviepath )
+    if not os.path.exists( filename ):
+        return {}
+    try:
+        npz = num.load( filename, allow_pickle=False )
+        try:
+            arrays = dict( [(name, npz[name]) for name in npz.files] )
+        finally:
+            npz.close()
+        signature, metadata = decode( json.loads( str( arrays.pop( 'structure' ) ) ), arrays )
+        if not isinstance( metadata, dict ):
+            raise ValueError( "cached metadata is not a dictionary" )
+        if signature != movie_signature( moviepath ):
+            if DEBUG: print "movie changed, ignoring metadata cache " + filename
+            return {}
+        # mark as recently used for evict()
+        os.utime( filename, None )
+    except Exception, details:
+        # a damaged or foreign cache file is ignored, and replaced when
+        # the metadata is saved
+        if DEBUG: print "could not read movie metadata cache %s:"%filename, details
+        return {}
+    if DEBUG: print "read movie metadata from " + filename
+    return metadata
+
+
+def save( moviepath, metadata ):
+    """Store the metadata dictionary for the movie. The cache file is
+    written under a temporary name and renamed, so readers never see a
+    partly written file. Failing to write the cache (e.g. in a read-only
+    directory) is not an error. A cache file larger than
+    params.movie_metadata_maxbytes is not kept."""
+    if not params.use_movie_metadata_cache:
+        return
+    filename = cache_filename( moviepath )
+    dirname = os.path.dirname( filename )
+    arrays = []
+    structure = json.dumps( encode( (movie_signature( moviepath ), metadata), arrays ) )
+    tmpname = None
+    try:
+        if not os.path.isdir( dirname ):
+            os.makedirs( dirname )
+        fd, tmpname = tempfile.mkstemp( suffix='.tmp', dir=dirname,
+                                        prefix=os.path.basename( filename ) + '.' )
+        f = os.fdopen( fd, 'wb' )
+        try:
+            num.savez( f, structure=num.array( structure ),
+                       **dict( [('a%d'%i, a) for i, a in enumerate( arrays )] ) )
+        finally:
+            f.close()
+        if os.path.getsize( tmpname ) > params.movie_metadata_maxbytes:
+            if DEBUG: print "movie metadata is larger than movie_metadata_maxbytes, not caching it"
+            os.remove( tmpname )
+            tmpname = None
+            if os.path.exists( filename ):
+                os.remove( filename )
+            return
+        try:
+            os.rename( tmpname, filename )
+        except OSError:
+            # Windows does not rename onto an existing file
+            os.remove( filename )
+            os.rename( tmpname, filename )
+        tmpname = None
+    except (IOError, OSError), details:
+        if DEBUG: print "could not write movie metadata cache:", details
+        return
+    finally:
+        if tmpname is not None:
+            try:
+                os.remove( tmpname )
+            except OSError:
+                pass
+    evict( dirname, params.movie_metadata_maxbytes, keep=filename )
+
+
+def evict( dirname, maxbytes, keep=None ):
+    """Delete least recently used cache files in dirname (the cache
+    directory, or the directory of the movies) until they take at most
+    maxbytes, never deleting keep."""
+    files = []
+    for name in os.listdir( dirname ):
+        if not name.endswith( CACHE_EXTENSION ):
+            continue
+        filename = os.path.join( dirname, name )
+        try:
+            st = os.stat( filename )
+        except OSError:
+            continue
+        files.append( (st.st_mtime, st.st_size, filename) )
+
+    nbytes = sum( [size for mtime, size, filename in files] )
+    files.sort()
+    for mtime, size, filename in files:
+        if nbytes <= maxbytes:
+            break
+        if filename == keep:
+            continue
+        try:
+            os.remove( filename )
+            nbytes -= size
+            if DEBUG: print "evicted movie metadata cache " + filename
+        except OSError:
+            pass
@@ -1,17 +1,26 @@
 # movies.py
 # KMB 11/06/2008
 
+import bisect
 import chunk
+import collections
+import ctypes
+import mmap
+import multiprocessing
+import Queue
 import struct
+import threading
 import traceback
 import os
 import sys
 
+import cv2
 import numpy as num
 import wx
 
 from params import params
 from ellipsesk import annotate_bmp
+import moviecache
 from version import USE_AVBIN
 if USE_AVBIN:
     import pyglet.media as media
@@ -40,6 +49,65 @@ if not DEBUG:
     DEBUG_MOVIES = False
 
 
+# AVI index types (OpenDML)
+AVI_INDEX_OF_INDEXES = 0x00
+AVI_INDEX_OF_CHUNKS = 0x01
+# set in the size of a standard index entry for a non-keyframe
+AVISTDINDEX_DELTAFRAME = 0x80000000
+
+# entry of the AVI 1.0 idx1 chunk
+AVI_IDX1_DTYPE = num.dtype([('ckid','S4'),('flags','<u4'),
+                            ('offset','<u4'),('size','<u4')])
+AVIIF_KEYFRAME = 0x10
+
+# intensity histogram bins of the frame statistics (see get_frame_stats),
+# and frames read at a time while collecting them
+FRAME_STATS_NBINS = 16
+FRAME_STATS_CHUNK = 32
+
+
+# integer weights of red, green, and blue for conversion to gray;
+# they sum to 256, so the weighted sum is divided by shifting
+RGB2GRAY_WEIGHTS = (77, 151, 28)
+
+
+class GrayConverter:
+    """Convert 8-bit color images to 8-bit grayscale, reusing scratch
+    buffers between calls. If params.movie_single_channel is set to 0, 1,
+    or 2, that channel (red, green, or blue) is used as the gray value,
+    e.g. for infrared cameras recorded as RGB."""
+    def __init__( self ):
+        self.acc = None
+        self.tmp = None
+
+    def convert( self, red, green, blue, out=None ):
+        """Return gray image from the uint8 channel arrays red, green, and
+        blue (which may be strided views), written into out if given."""
+        if out is None:
+            out = num.empty( red.shape, num.uint8 )
+
+        if params.movie_single_channel is not None:
+            out[...] = (red, green, blue)[params.movie_single_channel]
+            return out
+
+        if self.acc is None or self.acc.shape != red.shape:
+            self.acc = num.empty( red.shape, num.uint16 )
+            self.tmp = num.empty( red.shape, num.uint16 )
+        acc = self.acc
+        tmp = self.tmp
+        acc[...] = red
+        acc *= RGB2GRAY_WEIGHTS[0]
+        tmp[...] = green
+        tmp *= RGB2GRAY_WEIGHTS[1]
+        acc += tmp
+        tmp[...] = blue
+        tmp *= RGB2GRAY_WEIGHTS[2]
+        acc += tmp
+        acc >>= 8
+        out[...] = acc
+        return out
+
+
 def known_extensions():
     return ['.fmf', '.avi', '.sbfmf', '.ufmf'] # must sync with line 75
 
@@ -112,6 +180,9 @@ If initpath is a directory and not in interactive mode, it's an error."""
         if ext not in known_extensions():
             print "unknown file extension; will try AVbin to open"
 
+        # what we know about the movie from previous runs
+        self.metadata = moviecache.load( self.fullpath )
+
         # read FlyMovieFormat
         if ext == '.fmf':
             self.type = 'fmf'
@@ -167,31 +238,114 @@ If initpath is a directory and not in interactive mode, it's an error."""
         elif ext == '.avi':
             try:
                 print "YL: trying Avi()"
-                self.h_mov = Avi( self.fullpath )
+                self.h_mov = Avi( self.fullpath,
+                                  self.reader_metadata( Avi ) )
                 self.type = 'avi'
             except:
                 try:
-                    print "YL: trying CompressedAvi()"
-                    self.h_mov = CompressedAvi( self.fullpath )
-                    self.type = 'avbin'
+                    print "YL: trying CvCompressedAvi()"
+                    self.h_mov = CvCompressedAvi( self.fullpath,
+                                                  self.reader_metadata( CvCompressedAvi ) )
+                    self.type = 'cv'
                 except:
-                    if self.interactive:
-                        if USE_AVBIN and not media.have_avbin:
-                            msgtxt = "Failed opening file \"%s\". AVbin could not be loaded, and compressed AVIs cannot be read."%( self.fullpath )
-                        else:
-                            msgtxt = "Failed opening file \"%s\". AVbin was successfully loaded, but could not read the AVI."%( self.fullpath )
-                        wx.MessageBox( msgtxt, "Error", wx.ICON_ERROR )
-                    raise
-                else:
-                    if params.interactive:
-                        wx.MessageBox("Your movie is most likely compressed. Out-of-order frame access (e.g. dragging the frame slider toolbars around) will be slow. At this time, the frame chosen to be displayed may be off by one or two frames, i.e. may not line up perfectly with computed trajectories.","Warning",wx.ICON_WARNING)
+                    self.open_avbin()
             if params.interactive and self.h_mov.bits_per_pixel == 24 and not DEBUG_MOVIES and False:
                 wx.MessageBox( "Currently, RGB movies are immediately converted to grayscale. All color information is ignored.", "Warning", wx.ICON_WARNING )
 
         # unknown movie type
         else:
             try:
-                self.h_mov = CompressedAvi( self.fullpath )
+                self.h_mov = CvCompressedAvi( self.fullpath,
+                                              self.reader_metadata( CvCompressedAvi ) )
+                self.type = 'cv'
+            except:
+                self.open_avbin()
+
+        # cache of recently read frames, least recently used first
+        self.frame_cache = collections.OrderedDict()
+        self.frame_cache_nbytes = 0
+        self.frame_cache_hits = 0
+        self.frame_cache_misses = 0
+
+        # read-ahead of sequential frames, see start_prefetch()
+        self.prefetch_end = None
+        self.prefetch_next = None
+        self.prefetch_thread = None
+
+        # processes decoding sampled frames, see get_decode_pool()
+        self.decode_pool = None
+
+    def reader_metadata( self, reader_class ):
+        """Return the part of the movie's metadata cache kept by the
+given reader class; the reader reads and fills in this dictionary."""
+        return self.metadata.setdefault( reader_class.__name__, {} )
+
+    def save_metadata( self ):
+        """Write the movie's metadata to its cache file."""
+        if hasattr( self, 'metadata' ):
+            moviecache.save( self.fullpath, self.metadata )
+
+    def get_frame_stats( self, stride, firstframe=0, lastframe=None ):
+        """Return frame numbers, mean intensities, and FRAME_STATS_NBINS-bin
+intensity histograms of every stride-th frame of frames firstframe to
+lastframe (moved to keyframes for compressed movies), collected in one
+pass over the window. The statistics are kept per window in the metadata
+cache, separately for each params.movie_single_channel; a cached window
+containing this one with the same or a finer stride is reused, so later
+calls and later runs read no frames."""
+        if lastframe is None:
+            lastframe = self.get_n_frames() - 1
+        lastframe = min( lastframe, self.get_n_frames() - 1 )
+        windows = self.metadata.setdefault( 'frame_stats_windows', {} )
+        channel = params.movie_single_channel
+        for (ff, lf, ch), stats in windows.iteritems():
+            if ch == channel and ff <= firstframe and lf >= lastframe and \
+                    stats['stride'] <= stride:
+                inwindow = (stats['frames'] >= firstframe) & (stats['frames'] <= lastframe)
+                return stats['frames'][inwindow], stats['means'][inwindow], stats['hists'][inwindow]
+
+        frames = self.snap_to_keyframes( range( firstframe, lastframe + 1, stride ),
+                                         firstframe, lastframe )
+        means = num.empty( len( frames ), dtype=num.float64 )
+        hists = num.empty( (len( frames ), FRAME_STATS_NBINS), dtype=num.int32 )
+        shift = 8 - int( num.log2( FRAME_STATS_NBINS ) )
+        for i0 in range( 0, len( frames ), FRAME_STATS_CHUNK ):
+            i1 = min( i0 + FRAME_STATS_CHUNK, len( frames ) )
+            print "Collecting statistics of frames %d - %d (%d / %d)"%(frames[i0],frames[i1-1],i1,len( frames ))
+            chunk = self.get_frames( frames[i0:i1] )
+            means[i0:i1] = chunk.reshape( (i1 - i0, -1) ).mean( axis=1 )
+            for i, frame in enumerate( chunk ):
+                hists[i0 + i] = num.bincount( (frame >> shift).ravel(),
+                                              minlength=FRAME_STATS_NBINS )
+        windows[(firstframe, lastframe, channel)] = \
+            dict( stride=stride, frames=frames, means=means, hists=hists )
+        return frames, means, hists
+
+    def open_avbin( self ):
+        """Open compressed movie with AVbin, if OpenCV could not read it."""
+
+        (front, ext) = os.path.splitext( self.fullpath )
+        if ext == '.avi':
+            try:
+                print "YL: trying CompressedAvi()"
+                self.h_mov = CompressedAvi( self.fullpath,
+                                            self.reader_metadata( CompressedAvi ) )
+                self.type = 'avbin'
+            except:
+                if self.interactive:
+                    if USE_AVBIN and not media.have_avbin:
+                        msgtxt = "Failed opening file \"%s\". AVbin could not be loaded, and compressed AVIs cannot be read."%( self.fullpath )
+                    else:
+                        msgtxt = "Failed opening file \"%s\". AVbin was successfully loaded, but could not read the AVI."%( self.fullpath )
+                    wx.MessageBox( msgtxt, "Error", wx.ICON_ERROR )
+                raise
+            else:
+                if params.interactive:
+                    wx.MessageBox("Your movie is most likely compressed. Out-of-order frame access (e.g. dragging the frame slider toolbars around) will be slow. At this time, the frame chosen to be displayed may be off by one or two frames, i.e. may not line up perfectly with computed trajectories.","Warning",wx.ICON_WARNING)
+        else:
+            try:
+                self.h_mov = CompressedAvi( self.fullpath,
+                                            self.reader_metadata( CompressedAvi ) )
                 self.type = 'avbin'
             except:
                 if self.interactive:
@@ -200,20 +354,43 @@ If initpath is a directory and not in interactive mode, it's an error."""
             else:
                 if params.interactive:
                     wx.MessageBox("Your movie is most likely compressed. Out-of-order frame access (e.g. dragging the frame slider toolbars around) will be slow. At this time, the frame chosen to be displayed may be off by one or two frames, i.e. may not line up perfectly with computed trajectories.","Warning",wx.ICON_WARNING)
-                    
-        # add a buffer of the current frame
-        self.bufferedframe_im = None
-        self.bufferedframe_stamp = None
-        self.bufferedframe_num = None
 
     def get_frame( self, framenumber ):
-        """Return numpy array containing frame data."""
-        # check to see if we have buffered this frame
-        if framenumber == self.bufferedframe_num:
-            return (self.bufferedframe_im.copy(),self.bufferedframe_stamp)
+        """Return numpy array containing frame data. The array is
+read-only; copy it before modifying it."""
+        # check to see if we have cached this frame
+        if framenumber in self.frame_cache:
+            self.frame_cache_hits += 1
+            frame, stamp = self.frame_cache.pop( framenumber )
+            self.frame_cache[framenumber] = (frame, stamp)
+            # keep the read-ahead in step
+            if self.prefetch_end is not None and \
+                    framenumber == self.prefetch_next:
+                self.get_prefetched_frame( framenumber )
+            return frame, stamp
+        self.frame_cache_misses += 1
+
+        if self.prefetch_end is not None:
+            prefetched = self.get_prefetched_frame( framenumber )
+            if prefetched is not None:
+                frame, stamp = prefetched
+                self.cache_frame( framenumber, frame, stamp )
+                return frame, stamp
+
+        frame, stamp = self.read_frame( framenumber )
+        self.cache_frame( framenumber, frame, stamp )
 
+        # while prefetching, read ahead from here, also after a seek
+        if self.prefetch_end is not None:
+            self.start_prefetch_thread( framenumber + 1 )
+
+        return frame, stamp
+
+
+    def read_frame( self, framenumber ):
+        """Read frame from the movie file, bypassing cache and read-ahead."""
         try:
-            frame, stamp = self.h_mov.get_frame( framenumber )
+            return self.h_mov.get_frame( framenumber )
         except (IndexError, NoMoreFramesException):
             if self.interactive:
                 wx.MessageBox( "Frame number %d out of range"%(framenumber), "Error", wx.ICON_ERROR )
@@ -222,16 +399,227 @@ If initpath is a directory and not in interactive mode, it's an error."""
             if self.interactive:
                 wx.MessageBox( "Error reading frame %d"%(framenumber), "Error", wx.ICON_ERROR )
             raise
-        else:
-            # store the current frame in the buffer
-            self.bufferedframe_im = frame.copy()
-            self.bufferedframe_stamp = stamp
-            self.bufferedframe_num = framenumber
 
-            return frame, stamp
+
+    def snap_to_keyframes( self, frames, firstframe=0, lastframe=None ):
+        """Return sorted sample frames, moved to the nearest keyframe in
+[firstframe,lastframe] for compressed movies so that each costs one
+decode instead of up to a keyframe interval. Samples that meet at a
+keyframe are spread over the frames right after it. Frames of other
+movies are returned sorted and unchanged."""
+        frames = num.sort( num.asarray( frames, dtype=int ).ravel() )
+        keyframes = self.get_keyframes()
+        if keyframes is None or len( keyframes ) < 2 or len( frames ) == 0:
+            return frames
+        if lastframe is None:
+            lastframe = self.get_n_frames() - 1
+        keyframes = num.asarray( keyframes, dtype=int )
+        keyframes = keyframes[(keyframes >= firstframe) & (keyframes <= lastframe)]
+        if len( keyframes ) == 0:
+            return frames
+
+        # nearest keyframe
+        i = num.searchsorted( keyframes, frames, side='right' )
+        prevkey = keyframes[num.maximum( i - 1, 0 )]
+        nextkey = keyframes[num.minimum( i, len( keyframes ) - 1 )]
+        snapped = num.where( num.abs( frames - prevkey ) <= num.abs( nextkey - frames ),
+                             prevkey, nextkey )
+
+        # keep samples distinct: k, k+1, k+2, ... for repeats of keyframe k
+        snapped.sort()
+        isrepeat = num.r_[False, snapped[1:] == snapped[:-1]]
+        runstart = num.maximum.accumulate( num.where( isrepeat, 0, num.arange( len( snapped ) ) ) )
+        snapped += num.arange( len( snapped ) ) - runstart
+        snapped = num.minimum( snapped, lastframe )
+
+        return num.unique( snapped )
+
+    def get_frames( self, frames, out=None ):
+        """Return (N,height,width) uint8 array with the given N frames, in
+the given order, filling out if given. The frames are read in file order,
+each only once, so compressed movies are decoded in one forward pass per
+keyframe interval. Frames read here are not added to the cache."""
+        frames = num.asarray( frames, dtype=int ).ravel()
+        if out is None:
+            out = num.empty( (len( frames ), self.get_height(), self.get_width()),
+                             dtype=num.uint8 )
+        elif out.shape[0] != len( frames ):
+            raise ValueError( "out has room for %d frames, %d requested"%(out.shape[0],len( frames )) )
+
+        # the reader's position is changed below, and the decoding
+        # processes must not be forked while the read-ahead thread runs
+        self.stop_prefetch_thread()
+
+        # decode compressed movies in several processes
+        unique_frames, inverse = num.unique( frames, return_inverse=True )
+        nprocesses = get_decode_nprocesses()
+        if self.type in ('cv', 'avbin') and nprocesses > 1 and \
+                len( unique_frames ) >= 2*nprocesses:
+            stack = read_frames_parallel( self.get_decode_pool( len( unique_frames ), nprocesses ),
+                                          unique_frames )
+            out[:] = stack[inverse]
+            return out
+
+        order = num.argsort( frames, kind='mergesort' )
+        i = 0
+        while i < len( order ):
+            framenumber = frames[order[i]]
+            if framenumber in self.frame_cache:
+                self.frame_cache_hits += 1
+                frame = self.frame_cache[framenumber][0]
+            else:
+                self.frame_cache_misses += 1
+                frame = self.read_frame( framenumber )[0]
+            # copy to all requests for this frame
+            while i < len( order ) and frames[order[i]] == framenumber:
+                out[order[i]] = frame
+                i += 1
+
+        return out
+
+
+    def get_decode_pool( self, nframes, nprocesses ):
+        """Return the pool of nprocesses frame-reading processes, each
+with its own reader of this movie, and the shared stack they read
+frames into, with room for at least nframes frames. The pool is
+started on first use and kept until close_decode_pool(), so that
+sampling passes reading a chunk of frames at a time do not start
+processes and reopen the movie per chunk."""
+        pool = self.decode_pool
+        if pool is not None and (pool['nprocesses'] != nprocesses or
+                                 len( pool['stack'] ) < nframes):
+            self.close_decode_pool()
+            pool = None
+        if pool is None:
+            # readers are forked from this process; no thread may be
+            # holding the movie file
+            self.stop_prefetch_thread()
+            shape = (nframes, self.get_height(), self.get_width())
+            shared = multiprocessing.RawArray( ctypes.c_uint8,
+                                              shape[0]*shape[1]*shape[2] )
+            pool = {'nprocesses': nprocesses,
+                    'stack': num.frombuffer( shared, dtype=num.uint8 ).reshape( shape ),
+                    'pool': multiprocessing.Pool( nprocesses,
+                                                  initializer=init_frame_reader,
+                                                  initargs=(self.fullpath, shared, shape) )}
+            self.decode_pool = pool
+        return pool
+
+    def close_decode_pool( self ):
+        """Stop the frame-reading processes of get_decode_pool()."""
+        if getattr( self, 'decode_pool', None ) is not None:
+            self.decode_pool['pool'].terminate()
+            self.decode_pool['pool'].join()
+            self.decode_pool = None
+
+    def cache_frame( self, framenumber, frame, stamp ):
+        """Store frame in the cache, dropping least recently used frames
+to stay within params.movie_cache_maxbytes. The most recent frame is
+always kept."""
+        frame.flags.writeable = False
+        self.frame_cache[framenumber] = (frame, stamp)
+        self.frame_cache_nbytes += frame.nbytes
+        while self.frame_cache_nbytes > params.movie_cache_maxbytes and \
+                len( self.frame_cache ) > 1:
+            oldframe, oldstamp = self.frame_cache.popitem( last=False )[1]
+            self.frame_cache_nbytes -= oldframe.nbytes
+
+    def clear_frame_cache( self ):
+        if DEBUG_MOVIES: print "frame cache: %d hits, %d misses"%(self.frame_cache_hits,self.frame_cache_misses)
+        self.frame_cache.clear()
+        self.frame_cache_nbytes = 0
+
+    def start_prefetch( self, firstframe, lastframe ):
+        """Read frames firstframe+1..lastframe-1 ahead in a background
+thread, up to params.movie_prefetch_depth frames, while the caller is
+processing frames in order starting with firstframe. A request for
+another frame stops the read-ahead, is read directly, and the read-ahead
+restarts after it."""
+        self.stop_prefetch()
+        if params.movie_prefetch_depth <= 0:
+            return
+        self.prefetch_end = int( min( lastframe, self.get_n_frames() ) )
+        self.prefetch_next = firstframe
+
+    def stop_prefetch( self ):
+        """Stop reading ahead."""
+        self.stop_prefetch_thread()
+        self.prefetch_end = None
+        self.prefetch_next = None
+
+    def start_prefetch_thread( self, framenumber ):
+        """Read ahead from framenumber on. Frames queued by the previous
+thread are dropped with its queue; it is stopped first, so prefetch_next
+and the queue are only changed while no thread is reading."""
+        self.stop_prefetch_thread()
+        self.prefetch_next = framenumber
+        if framenumber >= self.prefetch_end:
+            return
+        self.prefetch_queue = Queue.Queue( params.movie_prefetch_depth )
+        self.prefetch_stop = threading.Event()
+        self.prefetch_thread = threading.Thread( target=self.prefetch_frames,
+                                                 args=(framenumber,
+                                                       self.prefetch_queue,
+                                                       self.prefetch_stop) )
+        self.prefetch_thread.daemon = True
+        self.prefetch_thread.start()
+
+    def stop_prefetch_thread( self ):
+        if self.prefetch_thread is None:
+            return
+        self.prefetch_stop.set()
+        self.prefetch_thread.join()
+        self.prefetch_thread = None
+        self.prefetch_queue = None
+
+    def prefetch_frames( self, framenumber, frame_queue, stop ):
+        """Thread target: read frames in order into frame_queue. A None
+item marks the end of the read-ahead or a read error."""
+        while framenumber < self.prefetch_end and not stop.is_set():
+            try:
+                item = self.h_mov.get_frame( framenumber )
+            except Exception:
+                # leave it to get_frame() to read and report the error
+                if DEBUG_MOVIES: print "prefetching frame %d failed"%framenumber
+                break
+            if not self.put_prefetched_frame( frame_queue, item, stop ):
+                return
+            framenumber += 1
+        self.put_prefetched_frame( frame_queue, None, stop )
+
+    def put_prefetched_frame( self, frame_queue, item, stop ):
+        while not stop.is_set():
+            try:
+                frame_queue.put( item, timeout=0.1 )
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def get_prefetched_frame( self, framenumber ):
+        """Return prefetched (frame,stamp) for framenumber, or None if it
+must be read directly."""
+        if framenumber != self.prefetch_next:
+            # not sequential; the reader's state is changed by direct reads
+            self.stop_prefetch_thread()
+            return None
+        if self.prefetch_thread is None:
+            return None
+        item = self.prefetch_queue.get()
+        if item is None:
+            self.stop_prefetch_thread()
+            return None
+        self.prefetch_next += 1
+        return item
 
 
     def get_n_frames( self ): return self.h_mov.get_n_frames()
+    def get_keyframes( self ):
+        """Return sorted keyframe numbers of a compressed movie, or None if
+any frame can be read without decoding others (or they are unknown)."""
+        if hasattr( self.h_mov, 'get_keyframes' ):
+            return self.h_mov.get_keyframes()
+        return None
     def get_width( self ): return self.h_mov.get_width()
     def get_height( self ): return self.h_mov.get_height()
     def get_fps(self): return self.h_mov.fps
@@ -435,6 +823,12 @@ If initpath is a directory and not in interactive mode, it's an error."""
         
 
     def close(self):
+        if hasattr(self,'prefetch_thread'):
+            self.stop_prefetch()
+        self.close_decode_pool()
+        self.save_metadata()
+        if hasattr(self,'frame_cache'):
+            self.clear_frame_cache()
         if hasattr(self,'h_mov'):
             try:
                 self.h_mov.close()
@@ -442,6 +836,54 @@ If initpath is a directory and not in interactive mode, it's an error."""
                 print "Could not close"
 
 
+def get_decode_nprocesses():
+    """Number of processes to decode sampled frames of compressed movies.
+By default, one per CPU when tracking from the command line, and none
+besides this one in the GUI: the readers are forked, and a forked copy
+of the wx application is not safe to run."""
+    if params.movie_decode_nprocesses > 0:
+        return params.movie_decode_nprocesses
+    if params.interactive:
+        return 1
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def read_frames_parallel( pool, frames ):
+    """Return (N,height,width) uint8 array with the given N sorted frames,
+    read by the processes of pool (see Movie.get_decode_pool), each
+    decoding a contiguous part of the frame list with its own reader.
+    Frames are passed back through the pool's shared stack; the returned
+    array is part of it and is overwritten by the next call."""
+
+    n = len( frames )
+    bounds = num.linspace( 0, n, pool['nprocesses'] + 1 ).astype( int )
+    pool['pool'].map( read_frames_into_shared,
+                      [(frames[i0:i1], i0) for i0, i1 in zip( bounds[:-1], bounds[1:] )
+                       if i1 > i0] )
+
+    return pool['stack'][:n]
+
+
+# movie and shared stack of a frame-reading process
+_frame_reader = {}
+
+def init_frame_reader( fullpath, shared, shape ):
+    params.interactive = False
+    params.movie_prefetch_depth = 0
+    _frame_reader['movie'] = Movie( fullpath, interactive=False )
+    _frame_reader['stack'] = num.frombuffer( shared, dtype=num.uint8 ).reshape( shape )
+
+def read_frames_into_shared( args ):
+    frames, offset = args
+    movie = _frame_reader['movie']
+    stack = _frame_reader['stack']
+    for i, framenumber in enumerate( frames ):
+        stack[offset + i] = movie.read_frame( int( framenumber ) )[0]
+
+
 """
 AVI class; written by JAB and KMB, altered by Don Olbris.
 
@@ -463,14 +905,18 @@ important alterations from version I received:
 
 class Avi:
     """Read uncompressed AVI movies."""
-    def __init__( self, filename ):
+    def __init__( self, filename, metadata=None ):
 
         print "YL: Avi __init__"
 
         self.issbfmf = False
+        self.gray = GrayConverter()
  
         # need to open in binary mode to support Windows:
         self.file = open( filename, 'rb' )
+        # file locations of each frame's chunk, read from the AVI index
+        self.frame_offsets = None
+        self.super_index = None
         try:
             self.read_header()
             self.postheader_calculations()
@@ -492,6 +938,14 @@ class Avi:
         #self.bits_per_pixel = 8 
 
         self.frame_index = {} # file locations of each frame
+        self.frame_index_keys = [] # sorted keys of frame_index
+
+        # without an AVI index, keep the locations found by seeking
+        if metadata is not None and self.frame_offsets is None:
+            self.frame_index = metadata.setdefault( 'frame_index', {} )
+            self.frame_index_keys = sorted( self.frame_index.keys() )
+
+        self.open_mmap()
 
 
     def get_all_timestamps( self ):
@@ -520,6 +974,7 @@ class Avi:
         print "YL: read_header"
 
         # read RIFF then riffsize
+        riff_start = self.file.tell()
         RIFF, riff_size, AVI = struct.unpack( '4sI4s', self.file.read( 12 ) )
         if not RIFF == 'RIFF':
             print "movie header RIFF error at", RIFF, riff_size, AVI
@@ -563,6 +1018,7 @@ class Avi:
 
             LIST, stream_listsize, strl = \
                   struct.unpack( '4sI4s', self.file.read( 12 ) )
+            strlstart = self.file.tell() - 4
 
             if not LIST == 'LIST' or not strl == 'strl':
                 print "movie header LIST 2 error at", LIST, strl
@@ -613,12 +1069,28 @@ class Avi:
                 self.colormap = num.frombuffer(self.file.read(4*colormapsize),num.uint8)
                 self.colormap = self.colormap.reshape((colormapsize,4))
                 self.colormap = self.colormap[:,:-1]
+                self.colormap_gray = self.gray.convert( self.colormap[:,0],
+                                                        self.colormap[:,1],
+                                                        self.colormap[:,2] )
             else:
                 self.isindexed = False
 
             if self.bits_per_pixel == 24:
                 self.isindexed = False
 
+            # look for an OpenDML super index in the rest of the stream list
+            pos = strfstart + strf_size + (strf_size % 2)
+            try:
+                while pos + 8 <= strlstart + stream_listsize:
+                    self.file.seek(pos,0)
+                    fourcc, chunksize = struct.unpack( '4sI', self.file.read( 8 ) )
+                    if fourcc == 'indx':
+                        self.read_super_index()
+                        break
+                    pos += 8 + chunksize + (chunksize % 2)
+            except struct.error:
+                self.super_index = None
+
             # skip the rest of the strf
             self.file.seek(hdrlstart+hdrl_size,0)
 
@@ -634,6 +1106,9 @@ class Avi:
                 movi, = struct.unpack('4s',self.file.read(4))
                 if DEBUG_MOVIES: print 'looking for movi, found ' + movi
                 if movi == 'movi':
+                    if hdrl == 'hdrl':
+                        self.read_index( self.file.tell() - 4, movilist_size,
+                                         riff_start + 8 + riff_size )
                     break
                 else:
                     self.file.seek(-4,1)
@@ -661,13 +1136,125 @@ class Avi:
         real_file_len = self.file.tell()
         self.file.seek( cur_pos )
 
-        if real_file_len > approx_file_len*1.1:
+        if self.frame_offsets is not None:
+            if self.n_frames != len( self.frame_offsets ):
+                print "index lists %d frames, although header said %d"%(len( self.frame_offsets ),self.n_frames)
+            self.n_frames = len( self.frame_offsets )
+        elif real_file_len > approx_file_len*1.1:
             print "approximate file length %ld bytes, real length %ld"%(approx_file_len, real_file_len)
             old_n_frames = self.n_frames
             self.n_frames = int( num.floor( (real_file_len - cur_pos)/self.buf_size ) )
             print "guessing %d frames in movie, although header said %d"%(self.n_frames,old_n_frames)
 
 
+    ###################################################################
+    # read_super_index()
+    ###################################################################
+    def read_super_index( self ):
+        """Read OpenDML super index ('indx' chunk data) at the current file
+        location; it lists the standard index chunks (ix00) of the stream."""
+
+        longsperentry, subtype, indextype, nentries, chunkid = \
+            struct.unpack( '<HBBI4s12x', self.file.read( 24 ) )
+        if indextype != AVI_INDEX_OF_INDEXES or longsperentry != 4:
+            if DEBUG_MOVIES: print "ignoring indx of type %d"%indextype
+            return
+
+        self.super_index = []
+        for i in range( nentries ):
+            offset, size, duration = struct.unpack( '<QII', self.file.read( 16 ) )
+            if offset > 0:
+                self.super_index.append( (offset, size, duration) )
+        if DEBUG_MOVIES: print "read super index with %d entries"%len( self.super_index )
+
+
+    ###################################################################
+    # read_index()
+    ###################################################################
+    def read_index( self, movi_start, movi_size, riff_end ):
+        """Set self.frame_offsets to the file locations of all frame chunks,
+        read from the OpenDML index or else the idx1 chunk. movi_start is
+        the location of the 'movi' fourcc. Leaves frame_offsets None if
+        there is no usable index; frames are then found by seeking."""
+
+        cur_pos = self.file.tell()
+        try:
+            if self.super_index:
+                offsets = self.read_opendml_index()
+            else:
+                offsets = self.read_idx1( movi_start, movi_size, riff_end )
+        except (struct.error, ValueError, IOError), details:
+            print "could not read AVI index:", details
+            offsets = None
+        self.file.seek( cur_pos, os.SEEK_SET )
+
+        if offsets is None or offsets.size == 0:
+            if DEBUG_MOVIES: print "no AVI index, will locate frames by seeking"
+            return
+        if num.any( num.diff( offsets ) <= 0 ):
+            print "AVI index is not in file order, will locate frames by seeking"
+            return
+
+        self.frame_offsets = offsets
+        if DEBUG_MOVIES: print "read AVI index with %d frames"%offsets.size
+
+
+    def read_opendml_index( self ):
+        """Return chunk locations from the standard indexes listed in the
+        super index."""
+
+        offsets = []
+        for index_offset, size, duration in self.super_index:
+            self.file.seek( index_offset, os.SEEK_SET )
+            fourcc, chunksize = struct.unpack( '4sI', self.file.read( 8 ) )
+            longsperentry, subtype, indextype, nentries, chunkid, base_offset = \
+                struct.unpack( '<HBBI4sQ4x', self.file.read( 24 ) )
+            if not fourcc.startswith( 'ix' ) or indextype != AVI_INDEX_OF_CHUNKS:
+                raise ValueError( "invalid standard index %s at %d"%(fourcc,index_offset) )
+            entries = num.fromstring( self.file.read( 4*longsperentry*nentries ), '<u4' )
+            entries = entries.reshape( (nentries,longsperentry) )
+            # entries point to the chunk data, after the 8-byte chunk header
+            offsets.append( entries[:,0].astype( num.int64 ) + base_offset - 8 )
+        if len( offsets ) == 0:
+            return None
+        return num.concatenate( offsets )
+
+
+    def read_idx1( self, movi_start, movi_size, riff_end ):
+        """Return chunk locations from the idx1 chunk following the movi list."""
+
+        # find idx1, skipping e.g. JUNK
+        pos = movi_start + movi_size + (movi_size % 2)
+        while True:
+            if pos + 8 > riff_end:
+                return None
+            self.file.seek( pos, os.SEEK_SET )
+            fourcc, chunksize = struct.unpack( '4sI', self.file.read( 8 ) )
+            if fourcc == 'idx1':
+                break
+            pos += 8 + chunksize + (chunksize % 2)
+
+        nentries = chunksize / AVI_IDX1_DTYPE.itemsize
+        entries = num.fromstring( self.file.read( nentries*AVI_IDX1_DTYPE.itemsize ),
+                                  AVI_IDX1_DTYPE )
+        isvideo = (entries['ckid'] == '00db') | (entries['ckid'] == '00dc')
+        offsets = entries['offset'][isvideo].astype( num.int64 )
+        if offsets.size == 0:
+            return offsets
+
+        # offsets are usually relative to the 'movi' fourcc, but some
+        # writers store absolute file locations
+        ckid = entries['ckid'][isvideo][0]
+        self.file.seek( movi_start + offsets[0], os.SEEK_SET )
+        if self.file.read( 4 ) == ckid:
+            offsets += movi_start
+        else:
+            self.file.seek( offsets[0], os.SEEK_SET )
+            if self.file.read( 4 ) != ckid:
+                raise ValueError( "idx1 offsets do not point to frame chunks" )
+        return offsets
+
+
     ###################################################################
     # postheader_calculations()
     ###################################################################
@@ -714,20 +1301,19 @@ class Avi:
 
     def nearest_indexed_frame( self, framenumber ):
         """Return nearest known frame index less than framenumber."""
-        keys = self.frame_index.keys()
-        keys.sort()
-        nearest = None
-        for key in keys:
-            if framenumber > key:
-                nearest = key
-            else:
-                break
-        return nearest
+        i = bisect.bisect_left( self.frame_index_keys, framenumber )
+        if i == 0:
+            return None
+        return self.frame_index_keys[i-1]
 
 
     def build_index( self, to_fr ):
         """Build index successively up to a selected frame."""
 
+        if self.frame_offsets is not None:
+            # read from the AVI index
+            return
+
         # find frame to start from
         near_idx = self.nearest_indexed_frame( to_fr )
         if near_idx is None:
@@ -813,22 +1399,33 @@ class Avi:
         
         self.framenumber = framenumber
 
-        # read frame from file
-        if framenumber in self.frame_index:
+        # find file location of frame
+        if self.frame_offsets is not None:
+            loc = int( self.frame_offsets[framenumber] )
+        elif framenumber in self.frame_index:
             if DEBUG_MOVIES: print "calling frame %d from index at %d"%(framenumber,self.frame_index[framenumber])
-            self.file.seek( self.frame_index[framenumber], os.SEEK_SET )
-            return self.get_next_frame()
-        
+            loc = self.frame_index[framenumber]
         else:
             near_idx = self.nearest_indexed_frame( framenumber )
             if near_idx is not None:
                 # offset from nearest indexed frame
                 offset = framenumber - near_idx
-                self.file.seek( (self.buf_size + 8)*offset + self.frame_index[near_idx], os.SEEK_SET )
+                loc = (self.buf_size + 8)*offset + self.frame_index[near_idx]
             else:
                 # offset from beginning of file
-                self.file.seek( self.data_start + (self.buf_size+8)*framenumber )
+                loc = self.data_start + (self.buf_size+8)*framenumber
 
+        # regular chunk: return view into memory-mapped file
+        frame = self.get_frame_mmap( loc )
+        if frame is not None:
+            return frame, self.make_timestamp( framenumber )
+
+        # read frame from file
+        self.file.seek( loc, os.SEEK_SET )
+        if self.frame_offsets is not None or framenumber in self.frame_index:
+            return self.get_next_frame()
+        
+        else:
             try:
                 return self.get_next_frame()
             except ValueError:
@@ -898,27 +1495,9 @@ class Avi:
         # reshape...
         width = self.width + self.padwidth
         height = self.height + self.padheight
-        if self.isindexed:
-            frame = self.colormap[frame,:]
-            frame.resize((width,height,3))
-            frame = frame[:self.width,:self.height,:]
-            tmp = frame.astype(float)
-            tmp = tmp[:,:,0]*.3 + tmp[:,:,1]*.59 + tmp[:,:,2]*.11 # RGB -> L
-            tmp = tmp.T
-            frame = tmp.astype(num.uint8)
-        elif frame.size == width*height:
-            frame.resize( (height, width) )
-            frame = frame[:self.height,:self.width]
-        elif frame.size == width*height*3:
-            frame.resize( (height, width*3) )
-            tmp = frame.astype(float)
-            tmp = tmp[:,2:width*3:3]*.3 + \
-                tmp[:,1:width*3:3]*.59 + \
-                tmp[:,0:width*3:3]*.11 # RGB -> L
-            tmp = tmp[:self.height,:self.width]
-            frame = tmp.astype(num.uint8)
-            #frame = imops.to_mono8( 'RGB24', frame )
-            #raise TypeError( "movie must be grayscale" )
+        if self.isindexed or frame.size == width*height or \
+               frame.size == width*height*3:
+            frame = self.reshape_frame( frame )
         else:
             # frame size doesn't match; for this exercise, pretend the height is 
             #   right and see if width is integral and within 10 of expected;
@@ -940,11 +1519,89 @@ class Avi:
             
         if self.framenumber not in self.frame_index:
             self.frame_index[self.framenumber] = self.file.tell() - frame_size - 8
+            bisect.insort( self.frame_index_keys, self.framenumber )
             if DEBUG_MOVIES: print "added frame %d to index at %d"%(self.framenumber,self.frame_index[self.framenumber])
         
         return frame, self.make_timestamp( self.framenumber )
         
         # end get_next_frame()
+
+    def reshape_frame( self, frame ):
+        """Turn flat frame data into a 2-D grayscale image. If frame is a
+        read-only view into the memory map, 8-bit frames stay views."""
+        width = self.width + self.padwidth
+        height = self.height + self.padheight
+        if self.isindexed:
+            frame = self.colormap_gray[frame] # RGB -> L
+            frame.resize( (width,height) )
+            frame = frame[:self.width,:self.height].T
+        elif frame.size == width*height:
+            frame = frame.reshape( (height, width) )
+            frame = frame[:self.height,:self.width]
+        else:
+            frame = frame.reshape( (height, width*3) )
+            frame = frame[:self.height,:self.width*3]
+            frame = self.gray.convert( frame[:,2::3], frame[:,1::3],
+                                       frame[:,0::3] ) # RGB -> L
+            #frame = imops.to_mono8( 'RGB24', frame )
+            #raise TypeError( "movie must be grayscale" )
+        return frame
+
+    ###################################################################
+    # memory-mapped frame access
+    ###################################################################
+    def open_mmap( self ):
+        """Memory-map the file so that frames can be read without copying."""
+        self.mmap = None
+        self.mmap_data = None
+        if not params.movie_use_mmap:
+            return
+        try:
+            self.mmap = mmap.mmap( self.file.fileno(), 0, access=mmap.ACCESS_READ )
+        except (EnvironmentError, ValueError, OverflowError), details:
+            # e.g., file too large for the address space
+            print "could not memory-map AVI, reading frames from file:", details
+            self.mmap = None
+            return
+        # read-only, since the map is read-only
+        self.mmap_data = num.frombuffer( self.mmap, num.uint8 )
+        if DEBUG_MOVIES: print "memory-mapped %d bytes"%self.mmap_data.size
+
+    def get_frame_mmap( self, offset ):
+        """Return the frame in the chunk at offset as a view into the
+        memory-mapped file, or None if there is no regular frame chunk
+        at offset (caller should then fall back to reading the file)."""
+        if self.mmap_data is None or offset < 0 or \
+               offset + 8 + self.buf_size > self.mmap_data.size:
+            return None
+
+        this_frame_id, frame_size = struct.unpack( '4sI', self.mmap[offset:offset+8] )
+        if frame_size != self.buf_size:
+            return None
+        if hasattr( self, 'frame_id' ):
+            if this_frame_id != self.frame_id:
+                return None
+        elif this_frame_id != '00db' and this_frame_id != '00dc':
+            return None
+
+        width = self.width + self.padwidth
+        height = self.height + self.padheight
+        if not self.isindexed and frame_size != width*height and \
+               frame_size != width*height*3:
+            # irregular frame size, needs get_next_frame()
+            return None
+
+        if not hasattr( self, 'frame_id' ):
+            self.frame_id = this_frame_id
+
+        return self.reshape_frame( self.mmap_data[offset+8:offset+8+frame_size] )
+
+    def close( self ):
+        # the map is not closed explicitly since frames handed out may
+        # still be views into it; it is closed once they are gone
+        self.mmap_data = None
+        self.mmap = None
+        self.file.close()
     
     def get_n_frames( self ): 
         return self.n_frames
@@ -961,7 +1618,9 @@ class Avi:
     def seek(self,framenumber):
         if framenumber < 0:
             framenumber = self.n_frames + framenumber
-        if framenumber in self.frame_index:
+        if self.frame_offsets is not None:
+            seek_to = int( self.frame_offsets[framenumber] )
+        elif framenumber in self.frame_index:
             seek_to = self.frame_index[framenumber]
         else:
             seek_to = self.chunk_start + self.bytes_per_chunk*framenumber
@@ -970,16 +1629,296 @@ class Avi:
     # end class Avi
 
 
+def iter_riff_chunks( f, start, end ):
+    """Yield (fourcc, data location, data size) of the RIFF chunks of file
+    f from location start to end. For a LIST, fourcc is the list type
+    and the data follows it."""
+    pos = start
+    while pos + 8 <= end:
+        f.seek( pos, os.SEEK_SET )
+        fourcc, chunksize = struct.unpack( '4sI', f.read( 8 ) )
+        if fourcc == 'LIST':
+            yield (f.read( 4 ), pos + 12, chunksize - 4)
+        else:
+            yield (fourcc, pos + 8, chunksize)
+        pos += 8 + chunksize + (chunksize % 2)
+
+
+def read_avi_opendml_keyframe_flags( f, hdrl_start, hdrl_end ):
+    """Return whether each frame of the first video stream is a keyframe,
+    read from the standard indexes (ix##) listed in the stream's OpenDML
+    super index (indx), or None if it has none."""
+    for fourcc, start, size in iter_riff_chunks( f, hdrl_start, hdrl_end ):
+        if fourcc != 'strl':
+            continue
+        fcctype = None
+        indx = None
+        for fourcc, pos, chunksize in iter_riff_chunks( f, start, start + size ):
+            if fourcc == 'strh':
+                f.seek( pos, os.SEEK_SET )
+                fcctype = f.read( 4 )
+            elif fourcc == 'indx':
+                indx = pos
+        if fcctype == 'vids':
+            break
+    else:
+        return None
+    if indx is None:
+        return None
+
+    f.seek( indx, os.SEEK_SET )
+    longsperentry, subtype, indextype, nentries, chunkid = \
+        struct.unpack( '<HBBI4s12x', f.read( 24 ) )
+    if indextype != AVI_INDEX_OF_INDEXES or longsperentry != 4:
+        return None
+    index_offsets = [struct.unpack( '<QII', f.read( 16 ) )[0] for i in range( nentries )]
+
+    iskey = []
+    for index_offset in index_offsets:
+        if index_offset == 0:
+            continue
+        f.seek( index_offset, os.SEEK_SET )
+        fourcc, chunksize = struct.unpack( '4sI', f.read( 8 ) )
+        longsperentry, subtype, indextype, nentries, chunkid, base_offset = \
+            struct.unpack( '<HBBI4sQ4x', f.read( 24 ) )
+        if not fourcc.startswith( 'ix' ) or indextype != AVI_INDEX_OF_CHUNKS:
+            raise ValueError( "invalid standard index %s at %d"%(fourcc,index_offset) )
+        entries = num.fromstring( f.read( 4*longsperentry*nentries ), '<u4' )
+        entries = entries.reshape( (nentries,longsperentry) )
+        iskey.append( (entries[:,1] & AVISTDINDEX_DELTAFRAME) == 0 )
+    if len( iskey ) == 0:
+        return None
+    return num.concatenate( iskey )
+
+
+def read_avi_idx1_keyframe_flags( f, idx1_start, idx1_size ):
+    """Return whether each video frame listed in the idx1 index is a
+    keyframe."""
+    nentries = idx1_size / AVI_IDX1_DTYPE.itemsize
+    f.seek( idx1_start, os.SEEK_SET )
+    entries = num.fromstring( f.read( nentries*AVI_IDX1_DTYPE.itemsize ),
+                              AVI_IDX1_DTYPE )
+    isvideo = (entries['ckid'] == '00db') | (entries['ckid'] == '00dc')
+    return (entries['flags'][isvideo] & AVIIF_KEYFRAME) != 0
+
+
+def read_avi_keyframes( filename, n_frames ):
+    """Return numbers of the keyframes of an AVI's video stream, read from
+    its OpenDML index (indx and ix## chunks) or else its idx1 index.
+    Returns None if the file is not an AVI. Raises ValueError for an AVI
+    without an index listing n_frames frames starting with a keyframe,
+    since then frames could only be found by OpenCV's own seeking, which
+    is not frame accurate in such files."""
+
+    try:
+        f = open( filename, 'rb' )
+    except IOError:
+        return None
+    try:
+        try:
+            RIFF, riff_size, AVI = struct.unpack( '4sI4s', f.read( 12 ) )
+        except struct.error:
+            return None
+        if RIFF != 'RIFF' or AVI != 'AVI ':
+            return None
+
+        hdrl = None
+        idx1 = None
+        iskey = None
+        try:
+            for fourcc, pos, size in iter_riff_chunks( f, 12, 8 + riff_size ):
+                if fourcc == 'hdrl':
+                    hdrl = (pos, pos + size)
+                elif fourcc == 'idx1':
+                    idx1 = (pos, size)
+            if hdrl is not None:
+                iskey = read_avi_opendml_keyframe_flags( f, *hdrl )
+            if iskey is None and idx1 is not None:
+                iskey = read_avi_idx1_keyframe_flags( f, *idx1 )
+        except (struct.error, ValueError), details:
+            print "could not read AVI index:", details
+            iskey = None
+    finally:
+        f.close()
+
+    if iskey is None or iskey.size != n_frames or not iskey[0]:
+        raise ValueError( "%s has no usable keyframe index"%filename )
+    return num.flatnonzero( iskey )
+
+
+def cv_cap_prop( name ):
+    """Return the OpenCV video capture property named e.g. 'FPS'."""
+    try:
+        return getattr( cv2, 'CAP_PROP_' + name )
+    except AttributeError:
+        # OpenCV 2
+        return getattr( cv2.cv, 'CV_CAP_PROP_' + name )
+
+
+class CvCompressedAvi:
+    """Use OpenCV to read compressed movies. A frame is read by seeking to
+    the nearest keyframe at or before it and decoding forward, with the
+    keyframes taken from the AVI index; AVIs without one are not opened.
+    Other containers are left to OpenCV's own seeking."""
+
+    def __init__( self, filename, metadata=None ):
+
+        if DEBUG_MOVIES: print 'Trying to read compressed movie with OpenCV'
+        self.issbfmf = False
+        self.gray = GrayConverter()
+        self.filename = filename
+
+        self.capture = cv2.VideoCapture( filename )
+        if not self.capture.isOpened():
+            raise IOError( "OpenCV could not open %s"%filename )
+
+        self.fps = self.capture.get( cv_cap_prop( 'FPS' ) )
+        if not self.fps > 0:
+            self.fps = params.DEFAULT_FRAME_RATE
+        self.n_frames = int( self.capture.get( cv_cap_prop( 'FRAME_COUNT' ) ) )
+        self.width = int( self.capture.get( cv_cap_prop( 'FRAME_WIDTH' ) ) )
+        self.height = int( self.capture.get( cv_cap_prop( 'FRAME_HEIGHT' ) ) )
+        if self.n_frames <= 0:
+            raise ValueError( "OpenCV could not read the number of frames" )
+
+        # compute the bits per pixel
+        retval, im = self.capture.read()
+        if not retval:
+            raise IOError( "OpenCV could not read the first frame of %s"%filename )
+        if im.ndim == 2:
+            self.color_depth = 1
+        else:
+            self.color_depth = im.shape[2]
+        self.bits_per_pixel = self.color_depth * 8
+        self.currframe = 1 # next frame to be decoded
+
+        if metadata is not None and metadata.get( 'keyframes' ) is not None:
+            self.keyframes = metadata['keyframes']
+        else:
+            self.keyframes = read_avi_keyframes( filename, self.n_frames )
+            if metadata is not None:
+                metadata['keyframes'] = self.keyframes
+        if DEBUG_MOVIES:
+            if self.keyframes is None:
+                print "not an AVI, OpenCV will seek"
+            else:
+                print "read %d keyframes from index"%self.keyframes.size
+
+        if metadata is not None and 'flipud' in metadata:
+            self.flipud = metadata['flipud']
+        else:
+            self.flipud = self.check_flipud( filename, self.to_gray( im ) )
+            if metadata is not None:
+                metadata['flipud'] = self.flipud
+
+        if DEBUG_MOVIES: print "Done initializing CvCompressedAvi"
+
+    def get_all_timestamps( self ):
+        return num.arange( self.n_frames )/self.fps
+
+    def make_timestamp( self, fr ):
+        return fr/self.fps
+
+    def get_frame( self, framenumber ):
+        """Read frame from file and return as NumPy array."""
+
+        if framenumber < 0 or framenumber >= self.n_frames:
+            raise IndexError( "frame %d out of range"%framenumber )
+
+        if framenumber != self.currframe:
+            self.seek( framenumber )
+
+        # decode forward to the frame
+        while self.currframe < framenumber:
+            if not self.capture.grab():
+                raise NoMoreFramesException( "could not decode frame %d"%self.currframe )
+            self.currframe += 1
+
+        retval, im = self.capture.read()
+        if not retval:
+            raise NoMoreFramesException( "could not decode frame %d"%framenumber )
+        self.currframe += 1
+
+        frame = self.to_gray( im )
+        # same orientation as the other readers
+        if self.flipud:
+            frame = num.flipud( frame )
+
+        return frame, self.make_timestamp( framenumber )
+
+    def to_gray( self, im ):
+        if im.ndim == 2:
+            return im
+        return self.gray.convert( im[:,:,2], im[:,:,1], im[:,:,0] )
+
+    def check_flipud( self, filename, frame ):
+        """Return whether frame 0, as decoded by OpenCV, must be flipped
+        to match the Avi reader, which keeps the stored row order of the
+        AVI (usually bottom-up; OpenCV returns rows top-down). The frames
+        are compared if the Avi reader can decode the file; otherwise
+        bottom-up storage is assumed, as for AVbin."""
+        try:
+            avi = Avi( filename )
+        except Exception:
+            return True
+        try:
+            ref = avi.get_frame( 0 )[0].astype( num.float64 )
+        except Exception:
+            return True
+        finally:
+            avi.close()
+        if ref.shape != frame.shape:
+            return True
+        flipped = num.abs( ref - frame[::-1] ).mean()
+        unflipped = num.abs( ref - frame ).mean()
+        if min( flipped, unflipped ) > 1.:
+            # compressed; the Avi reader returned the coded data
+            return True
+        return flipped <= unflipped
+
+    def get_keyframes( self ):
+        return self.keyframes
+
+    def seek( self, framenumber ):
+        """Position the decoder so that framenumber can be reached by
+        decoding forward."""
+        if self.keyframes is None:
+            # OpenCV seeks to the preceding keyframe itself
+            keyframe = framenumber
+        else:
+            i = num.searchsorted( self.keyframes, framenumber, side='right' )
+            keyframe = int( self.keyframes[i-1] )
+            if keyframe <= self.currframe <= framenumber:
+                # already in the right keyframe interval
+                return
+        if DEBUG_MOVIES: print "seeking to keyframe %d for frame %d"%(keyframe,framenumber)
+        self.capture.set( cv_cap_prop( 'POS_FRAMES' ), keyframe )
+        self.currframe = keyframe
+
+    def get_n_frames( self ):
+        return self.n_frames
+
+    def get_width( self ):
+        return self.width
+
+    def get_height( self ):
+        return self.height
+
+    def close( self ):
+        self.capture.release()
+
+
 class CompressedAvi:
 
     """Use pyglet.media to read compressed avi files"""
-    def __init__(self,filename):
+    def __init__(self,filename,metadata=None):
 
         if not USE_AVBIN:
             raise Exception, 'Trying to read compressed AVI, but USE_AVBIN flag set to False'
 
         if DEBUG_MOVIES: print 'Trying to read compressed AVI'
         self.issbfmf = False
+        self.gray = GrayConverter()
         self.source = media.load(filename)
         self.ZERO = 1./1000000.
         # for some video types, if we don't do a read before 
@@ -997,13 +1936,25 @@ class CompressedAvi:
         # these estimates are
         self.duration_seconds = self.source.duration
         if DEBUG_MOVIES: print 'duration_seconds = ' + str(self.duration_seconds)
-        self._estimate_fps()
-        if DEBUG_MOVIES: print 'fps estimated to be' + str(self.fps)
-        self.n_frames = int(num.floor(self.duration_seconds * self.fps))
-        if DEBUG_MOVIES: print "n_frames estimated to be %d"%self.n_frames
-        self.frame_delay_us = 1e6 / self.fps
-        self._estimate_keyframe_period()
-        if DEBUG_MOVIES: print 'keyframe period estimate to be ' + str(self.keyframe_period_s) + ' s, ' + str(self.keyframe_period) + ' frames'
+        if metadata is not None and 'keyframe_period' in metadata:
+            # estimated when the movie was opened before
+            self.fps = metadata['fps']
+            self.n_frames = metadata['n_frames']
+            self.keyframe_period = metadata['keyframe_period']
+            self.keyframe_period_s = metadata['keyframe_period_s']
+            self.frame_delay_us = 1e6 / self.fps
+        else:
+            self._estimate_fps()
+            if DEBUG_MOVIES: print 'fps estimated to be' + str(self.fps)
+            self.n_frames = int(num.floor(self.duration_seconds * self.fps))
+            if DEBUG_MOVIES: print "n_frames estimated to be %d"%self.n_frames
+            self.frame_delay_us = 1e6 / self.fps
+            self._estimate_keyframe_period()
+            if DEBUG_MOVIES: print 'keyframe period estimate to be ' + str(self.keyframe_period_s) + ' s, ' + str(self.keyframe_period) + ' frames'
+            if metadata is not None:
+                metadata.update( fps=self.fps, n_frames=self.n_frames,
+                                 keyframe_period=self.keyframe_period,
+                                 keyframe_period_s=self.keyframe_period_s )
         
         # added to help masquerade as FMF file:
         self.filename = filename
@@ -1198,11 +2149,8 @@ class CompressedAvi:
             frame.resize((im.height,im.width))
         else: # color_depth == 3
             frame.resize( (self.height, self.width*3) )
-            tmp = frame.astype(float)
-            tmp = tmp[:,2:self.width*3:3]*.3 + \
-                tmp[:,1:self.width*3:3]*.59 + \
-                tmp[:,0:self.width*3:3]*.11
-            frame = tmp.astype(num.uint8)
+            frame = self.gray.convert( frame[:,2::3], frame[:,1::3],
+                                       frame[:,0::3] )
 
         frame = num.flipud(frame)
 
@@ -1247,6 +2195,10 @@ class CompressedAvi:
 
         return (frame,ts)
 
+    def get_keyframes( self ):
+        # keyframes are assumed to be evenly spaced, see get_frame()
+        return num.arange( 0, self.n_frames, self.keyframe_period )
+
     def _estimate_fps(self):
 
         if DEBUG_MOVIES: print 'Estimating fps'
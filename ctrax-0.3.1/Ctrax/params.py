@@ -41,21 +41,6 @@ def averageshape(shape1,shape2):
     shape3.ecc = (shape1.ecc+shape2.ecc)/2.
     return shape3
 
-class Grid:
-    def __init__(self):
-        self.X = None
-        self.Y = None
-        self.X2 = None
-        self.Y2 = None
-        self.XY = None
-    def setsize(self,sz):
-        [self.Y,self.X] = num.mgrid[0:sz[0],0:sz[1]]
-        self.Y2 = self.Y**2
-        self.X2 = self.X**2
-        self.XY = self.X*self.Y
-    def __eq__(self,other):
-        return True
-
 class Parameters:
     def __init__(self):
 
@@ -69,9 +54,6 @@ class Parameters:
         # default frame rate
         self.DEFAULT_FRAME_RATE = 25.
 
-        # for fast computation of weighted region props
-        self.GRID = Grid()
-
         # max frac above-threshold points in a frame
         self.max_n_points_ratio = 1./250.
         # max n objects per frame to return
@@ -193,12 +175,56 @@ class Parameters:
         self.movie = None
         self.movie_name = ''
         self.annotation_movie_name = ''
+        # read uncompressed AVI frames as views into the memory-mapped file
+        self.movie_use_mmap = True
+        # number of frames to read ahead while tracking (0 to disable)
+        self.movie_prefetch_depth = 8
+        # memory used to cache recently read frames
+        self.movie_cache_maxbytes = 200000000
+        # for color movies, use only this channel (0, 1, 2 for red, green,
+        # blue) as the gray value instead of the luminance (--SingleChannel)
+        self.movie_single_channel = None
+        # processes decoding sampled frames of compressed movies
+        # (0 for one per CPU in non-interactive mode and 1 in the GUI,
+        # 1 to decode in this process only)
+        self.movie_decode_nprocesses = 0
+        # store movie metadata (frame index, frame rate, keyframes, frame
+        # statistics) in a cache file next to the movie, or in
+        # movie_metadata_dir if set; the cache files in either directory
+        # are kept below movie_metadata_maxbytes
+        self.use_movie_metadata_cache = True
+        self.movie_metadata_dir = ''
+        self.movie_metadata_maxbytes = 100000000
 
         ## Background Estimation Parameters ###
 
         # maximum number of pixels (should = bytes?) to allocate for temporary storage while computing the bg median
         # equivalent to 100 x (480x640) images
         self.bg_median_maxbytesallocate = 30720000
+        # processes computing the median background model, each working
+        # on a band of rows (0 for one per CPU, 1 to compute in this
+        # process only)
+        self.bg_nworkers = 1
+        # with recalc_bg_minutes, estimate each next background segment in
+        # another process while the current segment is being tracked
+        self.bg_lookahead = False
+        # with recalc_bg_minutes, update the median background from the
+        # background pixels of the frames being tracked (the last
+        # recalc_bg_minutes) instead of re-estimating it from sampled frames.
+        # memory: 256 uint16 histogram counts per pixel plus 2 bytes per
+        # pixel for each of the n_bg_frames frames in the window, twice for
+        # a varying background -- about 220 MB at 640x480 and 1.5 GB at
+        # 1920x1080 with 100 frames (see bg.rolling_bg_nbytes)
+        self.bg_rolling_update = False
+        # bytes the rolling background update may use; it is not started
+        # for larger movies, which are re-estimated from sampled frames
+        self.bg_rolling_maxbytes = 500000000
+        # background subtraction thresholds the uint8 frame with per-pixel
+        # threshold images and computes the normalized difference in float32
+        self.bg_sub_fast = True
+        # hysteresis keeps the connected components of the low-threshold
+        # foreground that contain high-threshold pixels, labeled once
+        self.bg_label_hysteresis = True
         # Background Subtraction Parameters
 
         # homomorphic filtering constants
@@ -262,6 +288,11 @@ class Parameters:
         self.minbackthresh = 1.
         # maximum number of clusters to split a foreground connected component into during the forward pass
         self.maxclustersperblob = 5
+        # start splitting a connected component containing the predicted
+        # positions of flies split in the previous frame from these
+        # predictions, skipping the threshold search; its splits can differ
+        # from those of the threshold search
+        self.split_warmstart = False
         # maximum penalty for merging together two ccs
         self.maxpenaltymerge = 40
         # maximum area of deleted target
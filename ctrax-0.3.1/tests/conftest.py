@@ -0,0 +1,44 @@
+# the Ctrax modules import each other by name
+import os
+import sys
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ),
+                                  os.pardir, 'Ctrax' ) )
+
+import numpy as num
+import pytest
+
+
+@pytest.fixture( autouse=True )
+def restore_params():
+    """Restore the parameters and diagnostics that the code under test
+    sets, such as the movie opened or the counts of split flies."""
+    from params import params, diagnostics
+    saved = (dict( params.__dict__ ), dict( diagnostics ))
+    yield
+    params.__dict__.clear()
+    params.__dict__.update( saved[0] )
+    diagnostics.clear()
+    diagnostics.update( saved[1] )
+
+
+NFRAMES = 24
+
+@pytest.fixture
+def compressed_movie( tmpdir ):
+    """Path of a small MJPG AVI whose frames all differ."""
+    cv2 = pytest.importorskip( 'cv2' )
+    try:
+        fourcc = cv2.VideoWriter_fourcc( *'MJPG' )
+    except AttributeError:
+        fourcc = cv2.cv.CV_FOURCC( *'MJPG' )
+    path = str( tmpdir.join( 'movie.avi' ) )
+    writer = cv2.VideoWriter( path, fourcc, 30., (64, 48) )
+    if not writer.isOpened():
+        pytest.skip( "cannot write MJPG movies" )
+    y, x = num.mgrid[:48,:64]
+    for i in range( NFRAMES ):
+        im = ((x*3 + y*2 + i*9)%256).astype( num.uint8 )
+        writer.write( num.dstack( (im, im, im) ) )
+    writer.release()
+    return path
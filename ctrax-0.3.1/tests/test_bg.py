@@ -0,0 +1,195 @@
+# tests of the background model and background subtraction in bg.py
+
+import types
+
+import numpy as num
+import pytest
+
+import bg
+import movies
+from params import params
+
+
+def make_bg( center, dev, bg_type='other', isarena=None ):
+    """Return a BackgroundCalculator with just the model used by
+    sub_bg_float and sub_bg_fast (its constructor needs a movie)."""
+    bgc = types.InstanceType( bg.BackgroundCalculator )
+    bgc.center = center
+    bgc.dev = dev
+    if isarena is None:
+        isarena = num.ones( center.shape, dtype=bool )
+    bgc.isarena = isarena
+    bgc.bg_type = bg_type
+    bgc.varying_bg = False
+    bgc.sub_bg_kernels = {}
+    return bgc
+
+
+def random_model( shape=(40,60), seed=0 ):
+    rng = num.random.RandomState( seed )
+    center = rng.uniform( 20., 230., shape )
+    dev = rng.uniform( 1., 8., shape )
+    isarena = num.ones( shape, dtype=bool )
+    isarena[:5,:] = False
+    im = num.clip( center + rng.normal( 0., 20., shape ), 0, 255 ).astype( num.uint8 )
+    return (center, dev, isarena, im)
+
+
+@pytest.fixture
+def thresholds( monkeypatch ):
+    monkeypatch.setattr( params, 'n_bg_std_thresh', 4. )
+    monkeypatch.setattr( params, 'n_bg_std_thresh_low', 2. )
+
+
+def test_sub_bg_fast_matches_float( thresholds ):
+    (center, dev, isarena, im) = random_model()
+    for bg_type in ('light_on_dark', 'dark_on_light', 'other'):
+        bgc = make_bg( center, dev, bg_type, isarena )
+        (dfore0,bwhigh0,bwlow0) = bgc.sub_bg_float( im, None )
+        (dfore,bwhigh,bwlow) = bgc.sub_bg_fast( im, None )
+        assert num.array_equal( bwhigh, bwhigh0 ), bg_type
+        assert num.array_equal( bwlow, bwlow0 ), bg_type
+        assert num.allclose( dfore, dfore0, rtol=1e-5, atol=1e-4 ), bg_type
+
+
+def test_sub_bg_kernel_follows_inplace_dev_change( thresholds ):
+    (center, dev, isarena, im) = random_model( seed=1 )
+    bgc = make_bg( center, dev, 'other', isarena )
+    bgc.sub_bg_fast( im, None )
+    hi0 = bgc.sub_bg_kernel( None )['hi_high'].copy()
+
+    # as the bg settings handlers do
+    bgc.dev[:] = bgc.dev*2.
+    bgc.clear_sub_bg_kernels()
+
+    hi = bgc.sub_bg_kernel( None )['hi_high']
+    assert not num.array_equal( hi, hi0 )
+    (dfore0,bwhigh0,bwlow0) = bgc.sub_bg_float( im, None )
+    (dfore,bwhigh,bwlow) = bgc.sub_bg_fast( im, None )
+    assert num.array_equal( bwhigh, bwhigh0 )
+    assert num.array_equal( bwlow, bwlow0 )
+
+
+def test_bg_segment_matches_est_bg( compressed_movie, tmpdir, monkeypatch ):
+    monkeypatch.setattr( params, 'interactive', False )
+    monkeypatch.setattr( params, 'feedback_enabled', False )
+    # no background images saved with the movie (set per movie by Ctrax)
+    monkeypatch.setattr( params, 'bgs_file', str( tmpdir.join( 'movie_bg.data' ) ), raising=False )
+    movie = movies.Movie( compressed_movie, interactive=False )
+    bgc = bg.BackgroundCalculator( movie )
+    bgc.n_bg_frames = 6
+    bgc.start_bg_segment( 12, 23 )
+    assert bgc.finish_bg_segment( 12, 23 )
+
+    inprocess = bg.BackgroundCalculator( movie )
+    inprocess.n_bg_frames = 6
+    inprocess.bg_firstframe = 12
+    inprocess.bg_lastframe = 23
+    assert inprocess.est_bg( reestimate=True )
+    movie.close()
+
+    assert bgc.varying_bg == inprocess.varying_bg
+    for attr in ('center', 'dev', 'thresh', 'thresh_low', 'hfnorm'):
+        assert num.array_equal( getattr( bgc, attr ), getattr( inprocess, attr ) ), attr
+
+
+def test_rolling_bg_respects_memory_limit( monkeypatch ):
+    (center, dev, isarena, im) = random_model()
+    bgc = make_bg( center, dev )
+    monkeypatch.setattr( params, 'movie_size', center.shape )
+    nbytes = bg.rolling_bg_nbytes( center.shape, 10 )
+    monkeypatch.setattr( params, 'bg_rolling_maxbytes', nbytes )
+    assert bgc.start_rolling_bg( 10, 1 )
+    assert bgc.rolling[None].hist.counts.nbytes < nbytes
+
+    monkeypatch.setattr( params, 'bg_rolling_maxbytes', nbytes - 1 )
+    assert not bgc.start_rolling_bg( 10, 1 )
+    assert bgc.rolling is None
+
+
+def test_histogram_bg_matches_numpy_median():
+    rng = num.random.RandomState( 2 )
+    shape = (6,7)
+    for nframes in (9, 10):
+        ims = rng.randint( 0, 256, (nframes,) + shape ).astype( num.uint8 )
+        hist = bg.HistogramBg( shape )
+        hist.add( ims )
+        med = num.median( ims.astype( float ), axis=0 )
+        assert num.array_equal( hist.median(), med ), nframes
+        mad = num.median( num.abs( ims - med ), axis=0 )
+        assert num.array_equal( hist.mad( med ), mad ), nframes
+
+        # the same order statistic as the band computation for a percentile
+        k = int( bg.percentile_order( nframes, 20 ) )
+        assert num.array_equal( hist.order_statistic( k ), num.sort( ims, axis=0 )[k] )
+
+
+def test_histogram_bg_masked_add_remove():
+    rng = num.random.RandomState( 3 )
+    shape = (5,8)
+    ims = rng.randint( 0, 256, (12,) + shape ).astype( num.uint8 )
+    masks = rng.uniform( size=ims.shape ) < .7
+    hist = bg.HistogramBg( shape )
+    for im, mask in zip( ims, masks ):
+        hist.add( im, mask )
+    # take the first three out again
+    for im, mask in zip( ims[:3], masks[:3] ):
+        hist.remove( im, mask )
+    (ims, masks) = (ims[3:], masks[3:])
+
+    med = hist.median()
+    mad = hist.mad( med )
+    for (r,c) in num.ndindex( *shape ):
+        values = ims[masks[:,r,c],r,c].astype( float )
+        if values.size == 0:
+            continue
+        assert hist.n.reshape( shape )[r,c] == values.size
+        assert med[r,c] == num.median( values ), (r,c)
+        assert mad[r,c] == num.median( num.abs( values - med[r,c] ) ), (r,c)
+
+
+
+def test_histogram_bg_pixels_without_values():
+    shape = (3,4)
+    hist = bg.HistogramBg( shape )
+    ims = num.array( [num.full( shape, 7 ), num.full( shape, 254 ), num.full( shape, 255 )], dtype=num.uint8 )
+    masks = num.ones( ims.shape, dtype=bool )
+    # no values at pixel (0,0), only 255 at (0,1)
+    masks[:,0,0] = False
+    masks[:2,0,1] = False
+    hist.add( ims, masks )
+
+    for k in range( 3 ):
+        value = hist.order_statistic( k )
+        assert value[0,0] == 255, k
+        assert value[0,1] == 255, k
+        assert num.all( value.ravel()[2:] == ims[k].ravel()[2:] ), k
+    # pixels with at most k values
+    assert num.all( hist.order_statistic( 3 ) == 255 )
+    assert hist.median()[0,0] == 255
+    assert hist.mad( hist.median() )[0,0] == 255
+    assert num.all( hist.median().ravel()[2:] == 254 )
+
+class FakeStatsMovie:
+    """Frame statistics of a movie with the lights on in frames ison."""
+    def __init__( self, ison ):
+        self.ison = ison
+    def get_frame_stats( self, stride, firstframe=0, lastframe=None ):
+        frames = num.arange( firstframe, lastframe + 1, stride )
+        return frames, num.where( self.ison[frames], 150., 60. ), None
+
+
+def test_varying_bg_samples_rare_lights_on( monkeypatch ):
+    # lights on in 20 of every 400 frames
+    ison = num.arange( 4000 )%400 < 20
+    monkeypatch.setattr( params, 'movie', FakeStatsMovie( ison ), raising=False )
+    monkeypatch.setattr( params, 'n_frames', ison.size )
+    bgc = types.InstanceType( bg.BackgroundCalculator )
+    (bgc.bg_firstframe, bgc.bg_lastframe, bgc.n_bg_frames) = (0, ison.size - 1, 50)
+    bgc.bg_frames = 2*[None]
+    bgc.checkForVaryingBg()
+
+    assert bgc.varying_bg
+    for on in (False, True):
+        assert len( bgc.bg_frames[on] ) == 50, on
+        assert num.all( ison[bgc.bg_frames[on]] == on ), on
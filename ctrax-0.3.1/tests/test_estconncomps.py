@@ -0,0 +1,244 @@
+# tests of splitting and merging connected components in estconncomps.py
+
+import numpy as num
+import scipy.ndimage as meas
+
+import estconncomps
+from ellipsesk import Ellipse
+from params import params
+
+
+def baseline_split_threshold( dforebox, thresholds ):
+    """The threshold loop trysplit used before split_threshold; dforebox
+    is 0 outside the component. Returns (threshold,Lbox,ncomponents)."""
+    for currthresh in thresholds:
+        isforebox = dforebox >= currthresh
+        (Lbox,ncomponents) = meas.label(isforebox)
+        if ncomponents == 1:
+            continue
+        removed = []
+        for j in range(ncomponents):
+            areaj = num.sum(Lbox==j+1)
+            if areaj < 3:
+                Lbox[Lbox==j+1] = 0
+                removed += j,
+        for j in range(ncomponents):
+            if num.any(num.array(removed)==j):
+                continue
+            nsmaller = num.sum(num.array(removed)<j)
+            Lbox[Lbox==j+1] = j+1-nsmaller
+        ncomponents -= len(removed)
+        if ncomponents > 1:
+            return (currthresh,Lbox,ncomponents)
+    return (None,None,0)
+
+
+def touching_blobs( seed, shape=(30,40), nblobs=3 ):
+    """Return dfore of a box with nblobs overlapping bright blobs plus
+    noise, the mask of its largest component above 1, and 20 thresholds
+    as trysplit chooses them."""
+    rng = num.random.RandomState( seed )
+    (r,c) = num.mgrid[:shape[0],:shape[1]]
+    dfore = rng.uniform( 0., .5, shape )
+    for k in range( nblobs ):
+        (r0,c0) = rng.uniform( 8., shape[0]-8. ), rng.uniform( 8., shape[1]-8. )
+        (sr,sc) = rng.uniform( 2., 5., 2 )
+        dfore += rng.uniform( 5., 15. )*num.exp( -.5*((r-r0)**2/sr**2 + (c-c0)**2/sc**2) )
+    (L,ncc) = meas.label( dfore >= 1. )
+    largest = num.argmax( num.bincount( L.ravel() )[1:] ) + 1
+    isforebox = L == largest
+    dfore[~isforebox] = 0
+    thresholds = num.linspace( 1., min( 10., dfore.max() ), 20 )
+    return (dfore,isforebox,thresholds)
+
+
+def test_split_threshold_matches_baseline():
+    nsplit = 0
+    for seed in range( 40 ):
+        (dfore,isforebox,thresholds) = touching_blobs( seed )
+        (t0,L0,n0) = baseline_split_threshold( dfore.copy(), thresholds )
+        (t,L,n) = estconncomps.split_threshold( dfore, isforebox, thresholds )
+        assert t == t0, seed
+        assert n == n0, seed
+        if t is not None:
+            assert num.array_equal( L, L0 ), seed
+            nsplit += 1
+    assert nsplit > 0
+
+
+def baseline_thresholdsplitinit( dforebox, thresholds, r1, c1 ):
+    """GMM initialization from the components trysplit found by raising
+    the threshold before thresholdsplitinit, or None."""
+    (currthresh,Lbox,ncomponents) = baseline_split_threshold( dforebox.copy(), thresholds )
+    if currthresh is None:
+        return None
+    mu = num.zeros([ncomponents,2])
+    S = num.zeros([2,2,ncomponents])
+    priors = num.zeros(ncomponents)
+    for j in range(ncomponents):
+        BWI = Lbox == (j+1)
+        wj = dforebox[BWI]
+        Z = sum(wj)
+        (rj,cj) = num.where(BWI)
+        centerX = sum(cj*wj)/Z
+        centerY = sum(rj*wj)/Z
+        mu[j,0] = centerX + c1
+        mu[j,1] = centerY + r1
+        S[0,0,j] = sum(wj*cj**2)/Z - centerX**2
+        S[1,1,j] = sum(wj*rj**2)/Z - centerY**2
+        S[0,1,j] = sum(wj*cj*rj)/Z - centerX*centerY
+        S[1,0,j] = S[0,1,j]
+        [D,V] = num.linalg.eig(S[:,:,j])
+        if num.any(D<.01):
+            D[D<.01] = .01
+            S[:,:,j] = num.dot(V, num.dot(num.diag(D), V.T ))
+        priors[j] = rj.size
+    return (mu,S,priors/num.sum(priors))
+
+
+def two_flies( shape=(40,60), centers=((22.,20.),(38.,21.)) ):
+    """Return dfore of two elongated blobs touching end to end, joined
+    by a dimmer neck, and the blob centers (x,y)."""
+    (r,c) = num.mgrid[:shape[0],:shape[1]]
+    dfore = num.zeros( shape )
+    for (x0,y0) in centers:
+        dfore += 12.*num.exp( -.5*((c-x0)**2/4.**2 + (r-y0)**2/2.**2) )
+    return (dfore,centers)
+
+
+def test_thresholdsplitinit_splits_two_flies( monkeypatch ):
+    monkeypatch.setattr( params, 'n_bg_std_thresh_low', 1. )
+    monkeypatch.setattr( params, 'n_bg_std_thresh', 10. )
+    (dfore,centers) = two_flies()
+    (L,ncc) = meas.label( dfore >= params.n_bg_std_thresh_low )
+    assert ncc == 1
+    (r,c) = num.nonzero( L == 1 )
+    (mu,S,priors) = estconncomps.thresholdsplitinit( r, c, 0, L, dfore )
+    assert len( priors ) == 2
+    assert num.allclose( num.sort( mu, axis=0 ), num.sort( centers, axis=0 ), atol=.5 )
+
+    (r1,r2,c1,c2) = (r.min(), r.max()+1, c.min(), c.max()+1)
+    dforebox = dfore[r1:r2,c1:c2].copy()
+    dforebox[L[r1:r2,c1:c2] != 1] = 0
+    thresholds = num.linspace( params.n_bg_std_thresh_low,
+                               min( params.n_bg_std_thresh, dforebox.max() ), 20 )
+    (mu0,S0,priors0) = baseline_thresholdsplitinit( dforebox, thresholds, r1, c1 )
+    assert num.allclose( mu, mu0, rtol=1e-5 )
+    assert num.allclose( S, S0, rtol=1e-4, atol=1e-4 )
+    assert num.allclose( priors, priors0, rtol=1e-6 )
+
+
+def split_two_flies( splitpred=None ):
+    """Return the ellipses fixlarge splits the merged blob of two_flies
+    into, warm started from splitpred, and the warm start fits."""
+    (dfore,centers) = two_flies()
+    (L,ncc) = meas.label( dfore >= params.n_bg_std_thresh_low )
+    ellipses = estconncomps.weightedregionprops( L, ncc, dfore )
+    assert ellipses[0].area > params.maxshape.area
+    fits = {}
+    if splitpred:
+        fits = estconncomps.warmstartsplits( ellipses, num.zeros( ncc, dtype=bool ),
+                                             L.copy(), dfore, splitpred )
+    estconncomps.fixlarge( ellipses, L, dfore, splitpred )
+    return (sorted( ellipses, key=lambda e: e.center.x ),fits)
+
+
+def test_warmstart_splits_two_flies( monkeypatch ):
+    monkeypatch.setattr( params, 'n_bg_std_thresh_low', 1. )
+    monkeypatch.setattr( params, 'n_bg_std_thresh', 10. )
+    monkeypatch.setattr( params.maxshape, 'area', 150. )
+    (split0,fits) = split_two_flies()
+    assert len( split0 ) == 2
+
+    # predictions near the flies: the warm started fit is used, and gives
+    # the ellipses of the threshold search
+    centers = two_flies()[1]
+    good = [Ellipse( x+.7, y-.5, 1.8, 3.5, .1, 80. ) for (x,y) in centers]
+    (split,fits) = split_two_flies( good )
+    assert fits.keys() == [0]
+    assert len( split ) == 2
+    for (e,e0) in zip( split, split0 ):
+        assert num.allclose( [e.center.x, e.center.y], [e0.center.x, e0.center.y], atol=.2 )
+        assert num.allclose( [e.major, e.minor, e.angle], [e0.major, e0.minor, e0.angle], atol=.15 )
+        assert num.allclose( e.area, e0.area, rtol=.05 )
+        assert e.issplit
+
+    # predictions collapsed onto one point, or off the blob: no warm
+    # started fit, and the threshold search splits the blob as before
+    collapsed = [Ellipse( 30., 21., 1.8, 3.5, 0., 80. ) for (x,y) in centers]
+    offblob = [Ellipse( x, y+15., 1.8, 3.5, 0., 80. ) for (x,y) in centers]
+    for bad in (collapsed, offblob):
+        (split,fits) = split_two_flies( bad )
+        assert fits == {}
+        assert [(e.center.x,e.center.y,e.major,e.minor,e.angle,e.area) for e in split] == \
+               [(e.center.x,e.center.y,e.major,e.minor,e.angle,e.area) for e in split0]
+
+
+def baseline_ellipsepixels(ellipse,bounds):
+    S = estconncomps.ell2cov(ellipse.major,ellipse.minor,ellipse.angle)
+    bounds = num.asarray(bounds,dtype=float)
+    [x,y] = num.meshgrid(num.arange(bounds[2],bounds[3],1),num.arange(bounds[0],bounds[1],1))
+    x -= ellipse.center.x
+    y -= ellipse.center.y
+    Sinv = num.linalg.inv(S)
+    d = x**2*Sinv[0,0] + 2*Sinv[0,1]*x*y + y**2*Sinv[1,1]
+    return d <= 4
+
+
+def baseline_computemergepenalty(ellipses,i,j,L,dfore):
+    """The per-pair merge penalty fixsmall used before mergepenalties."""
+    BWmerge = num.logical_or(L == i+1,L == j+1)
+    if not BWmerge.any():
+        return (0.,ellipses[i])
+    ellipsemerge = estconncomps.weightedregionpropsi(BWmerge,dfore[BWmerge])
+    if (ellipsemerge.area > params.maxshape.area) or (ellipsemerge.minor > params.maxshape.minor) or (ellipsemerge.major > params.maxshape.major):
+        return (params.maxpenaltymerge+1,ellipses[i])
+    (r1,r2,c1,c2) = estconncomps.getboundingboxtight(ellipsemerge,L.shape)
+    isforepredmerge = baseline_ellipsepixels(ellipsemerge,num.array([r1,r2,c1,c2]))
+    isforepredi = baseline_ellipsepixels(ellipses[i],num.array([r1,r2,c1,c2]))
+    isforepredj = baseline_ellipsepixels(ellipses[j],num.array([r1,r2,c1,c2]))
+    (r1,r2,c1,c2) = (int(r1),int(r2),int(c1),int(c2))
+    isforepredi = num.logical_or(isforepredi, (L[r1:r2,c1:c2]==i+1))
+    newforemerge = num.logical_and(isforepredmerge,num.logical_or(isforepredi,isforepredj)==False)
+    dforemerge = dfore[r1:r2,c1:c2].copy()
+    dforemerge = 1 - dforemerge[newforemerge]
+    dforemerge[dforemerge<0] = 0
+    return (num.sum(dforemerge),ellipsemerge)
+
+
+def synthetic_components( seed, shape=(60,80), nblobs=8 ):
+    """Return label image, number of components and dfore of a frame with
+    small elliptical blobs, some of them close together."""
+    rng = num.random.RandomState( seed )
+    (r,c) = num.mgrid[:shape[0],:shape[1]]
+    bw = num.zeros( shape, dtype=bool )
+    for k in range( nblobs ):
+        (r0,c0) = rng.uniform( 5., shape[0]-5. ), rng.uniform( 5., shape[1]-5. )
+        (sr,sc) = rng.uniform( 1., 4., 2 )
+        bw |= (r-r0)**2/sr**2 + (c-c0)**2/sc**2 <= 1.
+    (L,ncc) = meas.label( bw )
+    dfore = num.where( bw, rng.uniform( 1., 10., shape ), rng.uniform( 0., 1., shape ) )
+    return (L,ncc,dfore)
+
+
+def test_mergepenalties_match_per_pair():
+    npairs = 0
+    for seed in range( 5 ):
+        (L,ncc,dfore) = synthetic_components( seed )
+        ellipses = estconncomps.weightedregionprops( L, ncc, dfore )
+        for i in range( ncc ):
+            js = [j for j in range( ncc ) if j != i]
+            (penalties,merged) = estconncomps.mergepenalties( ellipses, i, js, L, dfore )
+            for (k,j) in enumerate( js ):
+                (penalty0,merged0) = baseline_computemergepenalty( ellipses, i, j, L, dfore )
+                assert num.allclose( penalties[k], penalty0, rtol=1e-6, atol=1e-6 ), (seed,i,j)
+                # covariances, as the angle of a round ellipse is arbitrary
+                S = estconncomps.ell2cov( merged[k].major, merged[k].minor, merged[k].angle )
+                S0 = estconncomps.ell2cov( merged0.major, merged0.minor, merged0.angle )
+                assert num.allclose( S, S0, rtol=1e-6, atol=1e-9 ), (seed,i,j)
+                assert num.allclose( merged[k].area, merged0.area, rtol=1e-6 ), (seed,i,j)
+                assert num.allclose( [merged[k].center.x, merged[k].center.y],
+                                     [merged0.center.x, merged0.center.y],
+                                     rtol=1e-6, atol=1e-9 ), (seed,i,j)
+                npairs += 1
+    assert npairs > 0
@@ -0,0 +1,96 @@
+# tests of batched Gaussian mixture fitting in gmmbatch.py against the
+# per-point-set fits of kcluster2d
+
+import numpy as num
+import pytest
+
+import gmmbatch
+
+kcluster = pytest.importorskip( 'kcluster2d' )
+
+
+def synthetic_blobs( seed, nsets=8 ):
+    """Return point sets x with weights w of two or three touching
+    elliptical blobs of pixels, and a perturbed initialization
+    (mu,S,priors) in kcluster2d's layout for each."""
+    rng = num.random.RandomState( seed )
+    sets = []
+    for b in range( nsets ):
+        k = rng.randint( 2, 4 )
+        (r,c) = num.mgrid[:30,:40]
+        w = num.zeros( r.shape )
+        mu = num.zeros( (k,2) )
+        major = rng.uniform( 3., 6., k )
+        minor = rng.uniform( 1.5, 3., k )
+        angle = rng.uniform( -num.pi/2, num.pi/2, k )
+        for j in range( k ):
+            mu[j] = (rng.uniform( 12., 28. ), rng.uniform( 10., 20. ))
+            (S00,S11,S01) = gmmbatch.ell2cov( major[j], minor[j], angle[j] )
+            Sinv = num.linalg.inv( [[S00,S01],[S01,S11]] )
+            (dx,dy) = (c - mu[j,0], r - mu[j,1])
+            w += rng.uniform( 5., 10. )*num.exp( -.5*(Sinv[0,0]*dx**2 + 2*Sinv[0,1]*dx*dy + Sinv[1,1]*dy**2) )
+        isfore = w > 1.
+        x = num.hstack( (c[isfore].reshape(-1,1), r[isfore].reshape(-1,1)) ).astype( gmmbatch.DTYPE )
+        w = w[isfore].astype( gmmbatch.DTYPE )
+
+        mu0 = (mu + rng.normal( 0., 1., mu.shape )).astype( gmmbatch.DTYPE )
+        S0 = num.zeros( (2,2,k), dtype=gmmbatch.DTYPE )
+        (S0[0,0],S0[1,1],S0[0,1]) = gmmbatch.ell2cov( major*1.3, minor, angle + .2 )
+        S0[1,0] = S0[0,1]
+        # one degenerate initial covariance for the mincov floor
+        S0[:,:,0] = [[4.,0.],[0.,0.]]
+        priors0 = num.ones( k, dtype=gmmbatch.DTYPE )/k
+        sets.append( (x,w,mu0,S0,priors0) )
+    return sets
+
+
+def batch( sets ):
+    """Pad kcluster2d-layout initializations to gmmbatch arrays."""
+    (X,W,n) = gmmbatch.pad( [s[0] for s in sets], [s[1] for s in sets] )
+    k = [len( s[4] ) for s in sets]
+    mu = num.zeros( (len( sets ),max( k ),2), dtype=gmmbatch.DTYPE )
+    S = num.zeros( (len( sets ),2,2,max( k )), dtype=gmmbatch.DTYPE )
+    S[:,0,0,:] = 1
+    S[:,1,1,:] = 1
+    priors = num.zeros( (len( sets ),max( k )), dtype=gmmbatch.DTYPE )
+    for (b,s) in enumerate( sets ):
+        mu[b,:k[b]] = s[2]
+        S[b,:,:,:k[b]] = s[3]
+        priors[b,:k[b]] = s[4]
+    return (X,W,n,k,mu,S,priors)
+
+
+@pytest.mark.parametrize( 'mincov', [.25, .015625] )
+def test_gmmem_matches_kcluster( mincov ):
+    sets = synthetic_blobs( 0 )
+    (X,W,n,k,mu0,S0,priors0) = batch( sets )
+    (mu,S,priors,gamma,negloglik) = gmmbatch.gmmem( X, W, mu0, S0, priors0, thresh=.1, mincov=mincov )
+
+    for (b,(x,w,mu1,S1,priors1)) in enumerate( sets ):
+        (muk,Sk,priorsk,gammak,ek) = kcluster.gmmem( x, mu1, S1, priors1, w, 100, .1, mincov )
+        assert num.allclose( mu[b,:k[b]], muk, rtol=1e-6, atol=1e-6 ), b
+        assert num.allclose( S[b,:,:,:k[b]], Sk, rtol=1e-6, atol=1e-6 ), b
+        assert num.allclose( priors[b,:k[b]], priorsk ), b
+        assert num.allclose( gamma[b,:n[b],:k[b]], gammak, rtol=1e-6, atol=1e-8 ), b
+        assert num.allclose( negloglik[b], ek, rtol=1e-8 ), b
+
+
+def test_update_matches_kcluster():
+    # the single update trysplit makes from the threshold initialization
+    sets = synthetic_blobs( 1 )
+    (X,W,n,k,mu,S,priors) = batch( sets )
+    gmmbatch.fixcov( S, .01 )
+    (gamma,e) = gmmbatch.memberships( mu, S, priors, X, W )
+    gmmbatch.update( mu, S, gamma, X, W )
+    (gamma,e) = gmmbatch.memberships( mu, S, priors, X, W )
+
+    for (b,(x,w,muk,Sk,priorsk)) in enumerate( sets ):
+        gmmbatch.fixcov( Sk[num.newaxis], .01 )
+        (gammak,ek) = kcluster.gmmmemberships( muk, Sk, priorsk, x, w )
+        kcluster.gmmupdate( muk, Sk, priorsk, gammak, x, w )
+        (gammak,ek) = kcluster.gmmmemberships( muk, Sk, priorsk, x, w )
+        assert num.allclose( mu[b,:k[b]], muk, rtol=1e-6, atol=1e-6 ), b
+        assert num.allclose( S[b,:,:,:k[b]], Sk, rtol=1e-6, atol=1e-6 ), b
+        assert num.allclose( priors[b,:k[b]], priorsk ), b
+        assert num.allclose( gamma[b,:n[b],:k[b]], gammak, rtol=1e-6, atol=1e-8 ), b
+        assert num.allclose( e[b], ek, rtol=1e-8 ), b
@@ -0,0 +1,97 @@
+# tests of the movie metadata cache in moviecache.py
+
+import cPickle
+import os
+
+import numpy as num
+import pytest
+
+import moviecache
+from params import params
+
+
+@pytest.fixture
+def movie( tmpdir, monkeypatch ):
+    """Path of a stand-in movie file, with the cache next to it."""
+    monkeypatch.setattr( params, 'use_movie_metadata_cache', True )
+    monkeypatch.setattr( params, 'movie_metadata_dir', '' )
+    path = tmpdir.join( 'movie.avi' )
+    path.write( 'not really a movie' )
+    return str( path )
+
+
+def sample_metadata():
+    rng = num.random.RandomState( 0 )
+    return {'Avi': {'frame_index': {0: 4096, 7: 120000}},
+            'CvCompressedAvi': {'keyframes': num.arange( 0, 300, 25 ), 'flipud': False},
+            'CompressedAvi': {'fps': 29.97, 'n_frames': 300, 'keyframe_period': None},
+            'frame_stats_windows': {(0, 299, None): {'stride': 4,
+                                                     'frames': num.arange( 0, 300, 4 ),
+                                                     'means': rng.uniform( 0, 255, 75 ),
+                                                     'hists': rng.randint( 0, 100, (75, 16) ).astype( num.int32 )}}}
+
+
+def test_save_load_round_trip( movie ):
+    metadata = sample_metadata()
+    moviecache.save( movie, metadata )
+    # no temporary file is left behind
+    assert sorted( os.listdir( os.path.dirname( movie ) ) ) == ['movie.avi', 'movie.avi' + moviecache.CACHE_EXTENSION]
+
+    loaded = moviecache.load( movie )
+    assert sorted( loaded.keys() ) == sorted( metadata.keys() )
+    assert loaded['Avi']['frame_index'] == {0: 4096, 7: 120000}
+    assert num.array_equal( loaded['CvCompressedAvi']['keyframes'], metadata['CvCompressedAvi']['keyframes'] )
+    assert loaded['CvCompressedAvi']['flipud'] is False
+    assert loaded['CompressedAvi'] == metadata['CompressedAvi']
+    (window, stats), = loaded['frame_stats_windows'].items()
+    assert window == (0, 299, None)
+    for name in ('frames', 'means', 'hists'):
+        assert stats[name].dtype == metadata['frame_stats_windows'][window][name].dtype
+        assert num.array_equal( stats[name], metadata['frame_stats_windows'][window][name] ), name
+
+
+class Planted( object ):
+    def __reduce__( self ):
+        return (os.mkdir, (self.path,))
+
+
+def test_load_ignores_damaged_and_pickled_files( movie, tmpdir ):
+    filename = moviecache.cache_filename( movie )
+    for contents in ('', 'garbage', cPickle.dumps( 12 )):
+        open( filename, 'wb' ).write( contents )
+        assert moviecache.load( movie ) == {}
+
+    # a pickle is not unpickled
+    planted = Planted()
+    planted.path = str( tmpdir.join( 'planted' ) )
+    open( filename, 'wb' ).write( cPickle.dumps( (moviecache.movie_signature( movie ), planted), -1 ) )
+    assert moviecache.load( movie ) == {}
+    assert not os.path.exists( planted.path )
+
+    # a valid npz whose structure is not what save writes
+    num.savez( open( filename, 'wb' ), structure=num.array( '{"dict": [[1]]}' ) )
+    assert moviecache.load( movie ) == {}
+
+    # the damaged file is replaced by the next save
+    moviecache.save( movie, {'CompressedAvi': {'fps': 25.}} )
+    assert moviecache.load( movie ) == {'CompressedAvi': {'fps': 25.}}
+
+
+def test_sidecar_caches_are_bounded( movie, tmpdir, monkeypatch ):
+    metadata = sample_metadata()
+    moviecache.save( movie, metadata )
+    nbytes = os.path.getsize( moviecache.cache_filename( movie ) )
+
+    # another movie in the same directory evicts the older cache
+    other = str( tmpdir.join( 'other.avi' ) )
+    open( other, 'w' ).write( 'not a movie either' )
+    monkeypatch.setattr( params, 'movie_metadata_maxbytes', nbytes + nbytes//2 )
+    os.utime( moviecache.cache_filename( movie ), (1, 1) )
+    moviecache.save( other, metadata )
+    assert os.path.exists( moviecache.cache_filename( other ) )
+    assert not os.path.exists( moviecache.cache_filename( movie ) )
+
+    # a cache larger than the bound is not kept
+    monkeypatch.setattr( params, 'movie_metadata_maxbytes', nbytes//2 )
+    moviecache.save( other, metadata )
+    assert sorted( os.listdir( str( tmpdir ) ) ) == ['movie.avi', 'other.avi']
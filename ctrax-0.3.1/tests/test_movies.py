@@ -0,0 +1,204 @@
+# tests of frame reading in movies.py
+
+import struct
+
+import numpy as num
+import pytest
+
+import movies
+from params import params
+
+
+def chunk( fourcc, data ):
+    return struct.pack( '<4sI', fourcc, len( data ) ) + data + '\0'*(len( data ) % 2)
+
+
+def riff_list( listtype, data ):
+    return chunk( 'LIST', listtype + data )
+
+
+def write_raw_avi( path, frames, index='idx1', keyframes=None ):
+    """Write (N,height,width) uint8 frames to an uncompressed 24-bit AVI,
+    rows in the order given (bottom-up, as the header says). index is
+    'idx1', 'opendml' (indx and ix00) or None; keyframes lists the frames
+    flagged as keyframes in it (all by default)."""
+    (n, height, width) = frames.shape
+    framesize = height*width*3
+    if keyframes is None:
+        keyframes = range( n )
+    iskey = [i in keyframes for i in range( n )]
+
+    avih = struct.pack( '<14I', 33333, 0, 0, 0x10, n, 0, 1, framesize,
+                        width, height, 0, 0, 0, 0 )
+    strh = struct.pack( '<4s4sIHHIIIIIIII4h', 'vids', 'DIB ', 0, 0, 0, 0, 1, 30,
+                        0, n, framesize, 0, 0, 0, 0, width, height )
+    strf = struct.pack( '<IiiHHIIiiII', 40, width, height, 1, 24, 0, framesize,
+                        0, 0, 0, 0 )
+
+    def header( indx ):
+        strl = chunk( 'strh', strh ) + chunk( 'strf', strf )
+        if indx is not None:
+            strl += chunk( 'indx', indx )
+        return riff_list( 'hdrl', chunk( 'avih', avih ) + riff_list( 'strl', strl ) )
+
+    indx = '\0'*40 if index == 'opendml' else None
+    movi_start = 12 + len( header( indx ) )
+    chunk_pos = [movi_start + 12 + i*(8 + framesize) for i in range( n )]
+    movi = ''.join( [chunk( '00db', num.repeat( frame[:,:,num.newaxis], 3, axis=2 ).tostring() )
+                     for frame in frames] )
+    if index == 'opendml':
+        ix00 = struct.pack( '<HBBI4sQI', 2, 0, 1, n, '00db', 0, 0 ) + \
+            ''.join( [struct.pack( '<II', pos + 8, framesize | (0 if key else 0x80000000) )
+                      for pos, key in zip( chunk_pos, iskey )] )
+        indx = struct.pack( '<HBBI4s3I', 4, 0, 0, 1, '00db', 0, 0, 0 ) + \
+            struct.pack( '<QII', movi_start + 12 + len( movi ), 8 + len( ix00 ), n )
+        movi += chunk( 'ix00', ix00 )
+    data = header( indx ) + riff_list( 'movi', movi )
+    if index == 'idx1':
+        data += chunk( 'idx1', ''.join( [struct.pack( '<4sIII', '00db', 0x10 if key else 0,
+                                                      pos - (movi_start + 8), framesize )
+                                         for pos, key in zip( chunk_pos, iskey )] ) )
+    f = open( path, 'wb' )
+    f.write( struct.pack( '<4sI4s', 'RIFF', 4 + len( data ), 'AVI ' ) + data )
+    f.close()
+
+
+def raw_frames( n=8 ):
+    y, x = num.mgrid[:48,:64]
+    return num.array( [(x + y*4 + i*7)%256 for i in range( n )], dtype=num.uint8 )
+
+
+@pytest.fixture
+def open_movie( monkeypatch ):
+    """Function opening a movie as Ctrax does from the command line."""
+    monkeypatch.setattr( params, 'interactive', False )
+    return lambda path: movies.Movie( path, interactive=False )
+
+
+def test_get_frames_parallel_matches_serial( compressed_movie, open_movie, monkeypatch ):
+    frames = [17, 3, 3, 0, 22, 9, 12, 5, 20, 8]
+    monkeypatch.setattr( params, 'movie_decode_nprocesses', 1 )
+    movie = open_movie( compressed_movie )
+    serial = movie.get_frames( frames )
+    movie.close()
+
+    monkeypatch.setattr( params, 'movie_decode_nprocesses', 2 )
+    movie = open_movie( compressed_movie )
+    parallel = movie.get_frames( frames )
+    assert movie.decode_pool is not None
+    # the pool is kept for the next chunk of the sampling pass
+    pool = movie.decode_pool
+    again = movie.get_frames( frames[:5] )
+    assert movie.decode_pool is pool
+    movie.close()
+    assert movie.decode_pool is None
+
+    assert num.array_equal( serial, parallel )
+    assert num.array_equal( serial[:5], again )
+    assert not num.array_equal( serial[0], serial[1] )
+
+
+def test_decode_nprocesses( monkeypatch ):
+    monkeypatch.setattr( params, 'movie_decode_nprocesses', 0 )
+    monkeypatch.setattr( movies.multiprocessing, 'cpu_count', lambda: 6 )
+    monkeypatch.setattr( params, 'interactive', False )
+    assert movies.get_decode_nprocesses() == 6
+    # the GUI is not forked unless asked to
+    monkeypatch.setattr( params, 'interactive', True )
+    assert movies.get_decode_nprocesses() == 1
+    monkeypatch.setattr( params, 'movie_decode_nprocesses', 3 )
+    assert movies.get_decode_nprocesses() == 3
+
+
+def test_read_avi_keyframes( tmpdir ):
+    frames = raw_frames()
+    for index in ('idx1', 'opendml'):
+        path = str( tmpdir.join( index + '.avi' ) )
+        write_raw_avi( path, frames, index, keyframes=[0, 3, 6] )
+        keyframes = movies.read_avi_keyframes( path, len( frames ) )
+        assert list( keyframes ) == [0, 3, 6], index
+
+    # without an index OpenCV cannot seek to keyframes
+    path = str( tmpdir.join( 'noindex.avi' ) )
+    write_raw_avi( path, frames, None )
+    with pytest.raises( ValueError ):
+        movies.read_avi_keyframes( path, len( frames ) )
+
+    # not an AVI
+    path = str( tmpdir.join( 'movie.mp4' ) )
+    tmpdir.join( 'movie.mp4' ).write( '\0\0\0\x18ftypmp42' )
+    assert movies.read_avi_keyframes( path, len( frames ) ) is None
+
+
+def test_cv_frames_match_avi( tmpdir ):
+    frames = raw_frames()
+    path = str( tmpdir.join( 'raw.avi' ) )
+    write_raw_avi( path, frames )
+    avi = movies.Avi( path )
+    try:
+        cv = movies.CvCompressedAvi( path )
+    except IOError:
+        pytest.skip( "OpenCV cannot read uncompressed AVIs" )
+    # OpenCV returns the rows top-down, the Avi reader as stored
+    assert cv.flipud
+    for i in (0, 5, 2, 7):
+        expected = avi.get_frame( i )[0].astype( int )
+        assert num.abs( cv.get_frame( i )[0].astype( int ) - expected ).max() <= 1, i
+    avi.close()
+    cv.close()
+
+
+def test_frame_stats_scan_only_the_window( compressed_movie, open_movie ):
+    movie = open_movie( compressed_movie )
+    requested = []
+    get_frames = movie.get_frames
+    def recording_get_frames( frames, out=None ):
+        requested.extend( frames )
+        return get_frames( frames, out )
+    movie.get_frames = recording_get_frames
+
+    (frames,means,hists) = movie.get_frame_stats( 2, 8, 15 )
+    assert len( requested ) > 0
+    assert min( requested ) >= 8 and max( requested ) <= 15
+    assert list( frames ) == sorted( set( requested ) )
+    for i, framenumber in enumerate( frames ):
+        frame = movie.get_frame( int( framenumber ) )[0]
+        assert abs( means[i] - frame.mean() ) < 1e-6
+        assert hists[i].sum() == frame.size
+
+    # a window inside it at the same or a coarser stride is cached
+    del requested[:]
+    (frames2,means2,hists2) = movie.get_frame_stats( 4, 10, 15 )
+    assert requested == []
+    assert list( frames2 ) == [f for f in frames if 10 <= f <= 15]
+
+    # a finer stride is read again
+    movie.get_frame_stats( 1, 8, 15 )
+    assert len( requested ) > 0
+    movie.close()
+
+
+def test_prefetch_resumes_after_seek( compressed_movie, open_movie, monkeypatch ):
+    reference = open_movie( compressed_movie )
+    expected = reference.get_frames( range( 24 ) )
+    reference.close()
+
+    monkeypatch.setattr( params, 'movie_prefetch_depth', 4 )
+    movie = open_movie( compressed_movie )
+    direct = []
+    read_frame = movie.read_frame
+    def recording_read_frame( framenumber ):
+        direct.append( framenumber )
+        return read_frame( framenumber )
+    movie.read_frame = recording_read_frame
+
+    movie.start_prefetch( 0, 24 )
+    for framenumber in [0, 1, 2, 15, 16, 17, 18, 5, 6]:
+        frame = movie.get_frame( framenumber )[0]
+        assert num.array_equal( frame, expected[framenumber] ), framenumber
+    # the first frame and each seek are read directly, the frames
+    # after them come from the read-ahead
+    assert direct == [0, 15, 5]
+    assert movie.prefetch_next == 7
+    assert movie.prefetch_thread is not None
+    movie.close()